@@ -0,0 +1,171 @@
+"""Нагрузочный прогон EditLimiter против фейкового Bot API.
+
+Поднимает на localhost HTTP-сервер, который отвечает на любой POST через RTT секунд, и гоняет
+через EditLimiter партии: GAMES групп одновременно, в каждой спин = 4 кадра анимации и итог.
+Печатает темп применённых правок и задержку итоговых правок (p50/p95/max).
+
+casino.bot.py при импорте поднимает бота, поэтому из него исполняется только блок лимитера
+(от "# Global edit limiter" до "# Global instance"). Версию можно взять из git:
+
+    python bench/edit_limiter_bench.py --rtt 0.3 --workers 1 4
+    python bench/edit_limiter_bench.py --rtt 0.3 --rev 316aa69~1   # до пула воркеров
+"""
+import argparse
+import bisect
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import threading
+import time
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+ROOT = Path(__file__).resolve().parent.parent
+SRC_PATH = ROOT / "casino.bot.py"
+
+GLOBAL_GAP_SEC = 0.12
+PER_TARGET_GAP_SEC = 1.05
+FRAMES = 4
+FRAME_SEC = 0.35
+
+
+def load_source(rev: Optional[str]) -> str:
+    if not rev:
+        return SRC_PATH.read_text(encoding="utf-8")
+    return subprocess.run(
+        ["git", "show", f"{rev}:casino.bot.py"], cwd=ROOT, check=True, capture_output=True
+    ).stdout.decode("utf-8")
+
+
+def load_limiter(src: str) -> dict:
+    a = src.index("# Global edit limiter")
+    b = src.index("# Global instance", a)
+    g = {
+        "__name__": "edit_limiter_bench",
+        "os": os, "re": re, "time": time, "threading": threading, "random": random,
+        "bisect": bisect, "OrderedDict": OrderedDict, "InputMediaPhoto": object,
+        "Optional": Optional, "List": List, "Tuple": Tuple, "Dict": Dict,
+    }
+    exec(compile(src[a:b], "casino.bot.py[edit limiter]", "exec"), g)
+    return g
+
+
+def start_fake_api(rtt: float) -> str:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", "0")))
+            time.sleep(rtt)
+            body = b'{"ok":true,"result":true}'
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{srv.server_address[1]}/botTEST/editMessageText"
+
+
+class FakeBot:
+    """Только edit_message_text: настоящий HTTP-запрос на фейковый сервер."""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.lock = threading.Lock()
+        self.applied: List[Tuple[float, str]] = []
+
+    def edit_message_text(self, text, **kw):
+        body = json.dumps({"text": text, **{k: v for k, v in kw.items() if k != "reply_markup"}}).encode()
+        req = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"})
+        urllib.request.urlopen(req).read()
+        with self.lock:
+            self.applied.append((time.time(), text))
+
+
+def run(g: dict, url: str, workers: Optional[int], dur: float, games: int, drain: float) -> dict:
+    bot = FakeBot(url)
+    kw = dict(global_gap_sec=GLOBAL_GAP_SEC, per_target_gap_sec=PER_TARGET_GAP_SEC)
+    if workers is not None:
+        kw["workers"] = workers
+    lim = g["EditLimiter"](bot, **kw)
+    has_prio = "EDIT_PRIO_ANIM" in g
+    enq: Dict[str, float] = {}
+    stop = time.time() + dur
+
+    def edit(text: str, prio_name: str, chat_id: int):
+        enq[text] = time.time()
+        extra = {"priority": g[prio_name]} if has_prio else {}
+        lim.edit_text(text=text, chat_id=chat_id, msg_id=1, **extra)
+
+    def game(i: int):
+        rnd = random.Random(i)
+        chat_id = -1000 - i
+        n = 0
+        time.sleep(rnd.random() * 2)
+        while time.time() < stop:
+            for f in range(FRAMES):
+                edit(f"g{i}:{n}:a{f}", "EDIT_PRIO_ANIM", chat_id)
+                time.sleep(FRAME_SEC)
+            edit(f"g{i}:{n}:F", "EDIT_PRIO_FINAL", chat_id)
+            n += 1
+            time.sleep(2.0 + rnd.random())
+
+    threads = [threading.Thread(target=game, args=(i,)) for i in range(games)]
+    t0 = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    time.sleep(drain)  # даём очереди дойти
+    lim.stop()
+
+    applied = list(bot.applied)
+    fin = sorted(ts - enq[x] for ts, x in applied if x.endswith(":F"))
+    n_fin = sum(1 for x in enq if x.endswith(":F"))
+    in_window = sum(1 for ts, _x in applied if ts <= t0 + dur)
+    return {
+        "applied": len(applied),
+        "rate": round(in_window / dur, 2),
+        "finals": f"{len(fin)}/{n_fin}",
+        "fin_p50": round(statistics.median(fin), 2) if fin else None,
+        "fin_p95": round(fin[max(0, int(len(fin) * 0.95) - 1)], 2) if fin else None,
+        "fin_max": round(fin[-1], 2) if fin else None,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--rtt", type=float, default=0.08, help="задержка ответа фейкового API, с")
+    ap.add_argument("--workers", type=int, nargs="*", default=[],
+                    help="числа воркеров; без значения — конструктор по умолчанию")
+    ap.add_argument("--rev", default=None, help="взять casino.bot.py из git-ревизии")
+    ap.add_argument("--duration", type=float, default=20.0, help="сколько секунд идут спины")
+    ap.add_argument("--games", type=int, default=50, help="одновременных групп")
+    ap.add_argument("--drain", type=float, default=8.0, help="сколько ждать очередь после спинов, с")
+    args = ap.parse_args()
+
+    g = load_limiter(load_source(args.rev))
+    url = start_fake_api(args.rtt)
+    print(f"rtt={args.rtt}s games={args.games} duration={args.duration}s "
+          f"global_gap={GLOBAL_GAP_SEC}s per_target_gap={PER_TARGET_GAP_SEC}s src={args.rev or 'worktree'}")
+    for workers in (args.workers or [None]):
+        res = run(g, url, workers, args.duration, args.games, args.drain)
+        label = "default" if workers is None else f"workers={workers}"
+        print(f"{label:>12}: " + " ".join(f"{k}={v}" for k, v in res.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,16 @@ import re
 import time
 import uuid
 import base64
+import bisect
+import gzip
 import sqlite3
 import shutil
 import random
 import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from contextlib import contextmanager
 from dataclasses import dataclass
 from html import escape as html_escape
 from typing import Optional, List, Tuple, Dict
@@ -114,8 +120,7 @@ def _maintenance_gate_message(message):
             return ContinueHandling()
         if getattr(getattr(message, "chat", None), "type", "") == "private":
             try:
-                rs = db_one("SELECT 1 FROM report_state WHERE user_id=? LIMIT 1", (uid,))
-                if rs:
+                if report_get_state(uid)[0] is not None:
                     return ContinueHandling()
             except Exception:
                 pass
@@ -240,12 +245,101 @@ def _sys_excepthook(exc_type, exc_value, exc_tb):
 sys.excepthook = _sys_excepthook
 
 # Global edit limiter
+import hashlib
 import heapq
 import itertools as _itertools
 
+# Приоритеты правок: меньше = важнее
+EDIT_PRIO_FINAL = 0   # итоги хода / партии
+EDIT_PRIO_MENU = 1    # интерактивные меню, лобби, статистика
+EDIT_PRIO_ANIM = 2    # кадры анимации спина
+
+# Бюджеты Telegram: ~20 сообщений в минуту на группу, ~1 в секунду на личку
+EDIT_GROUP_PER_MIN = float(os.environ.get("EDIT_GROUP_PER_MIN", "20"))
+EDIT_PRIVATE_PER_SEC = float(os.environ.get("EDIT_PRIVATE_PER_SEC", "1"))
+EDIT_BUCKET_BURST = float(os.environ.get("EDIT_BUCKET_BURST", "4"))
+EDIT_FINAL_RESERVE = float(os.environ.get("EDIT_FINAL_RESERVE", "1"))
+EDIT_WORKERS = max(1, int(os.environ.get("EDIT_WORKERS", "4")))
+EDIT_DEDUP_SIZE = max(1, int(os.environ.get("EDIT_DEDUP_SIZE", "4096")))
+EDIT_PRUNE_SEC = max(5, int(os.environ.get("EDIT_PRUNE_SEC", "60")))
+
+class _LatencyHist:
+    """Гистограмма задержек с фиксированными корзинами (секунды)."""
+    BOUNDS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0)
+    __slots__ = ("counts", "n", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, sec: float):
+        sec = max(0.0, float(sec))
+        self.counts[bisect.bisect_left(self.BOUNDS, sec)] += 1
+        self.n += 1
+        self.total += sec
+        if sec > self.max:
+            self.max = sec
+
+    def quantile(self, q: float) -> float:
+        """Верхняя граница корзины, в которую попал q-квантиль."""
+        if not self.n:
+            return 0.0
+        need = q * self.n
+        acc = 0
+        for i, c in enumerate(self.counts):
+            acc += c
+            if acc >= need and c:
+                return min(self.BOUNDS[i], self.max) if i < len(self.BOUNDS) else self.max
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "n": self.n,
+            "avg_ms": round(self.total * 1000 / max(1, self.n), 1),
+            "p50_ms": round(self.quantile(0.5) * 1000, 1),
+            "p95_ms": round(self.quantile(0.95) * 1000, 1),
+            "max_ms": round(self.max * 1000, 1),
+            "buckets": [(b, c) for b, c in zip(self.BOUNDS + (None,), self.counts) if c],
+        }
+
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "ts", "blocked_until")
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.tokens = self.burst
+        self.ts = time.time()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float) -> float:
+        if now > self.ts:
+            self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+            self.ts = now
+        return self.tokens
+
+    def ready_at(self, now: float, need: float) -> float:
+        """Когда в ведре наберётся need токенов."""
+        t = max(now, self.blocked_until)
+        have = self.refill(now)
+        if have >= need:
+            return t
+        return max(t, now + (need - have) / max(self.rate, 1e-6))
+
+    def take(self, now: float):
+        self.refill(now)
+        self.tokens -= 1.0
+
+    def block(self, until: float):
+        self.blocked_until = max(self.blocked_until, until)
+        self.tokens = min(self.tokens, 0.0)
+
 class _EditJob:
-    __slots__ = ("due", "target", "req_id", "text", "reply_markup", "parse_mode", "inline_id", "chat_id", "msg_id")
-    def __init__(self, due, target, req_id, text, reply_markup, parse_mode, inline_id, chat_id, msg_id):
+    __slots__ = ("due", "target", "req_id", "text", "reply_markup", "parse_mode", "inline_id", "chat_id", "msg_id", "prio", "digest",
+                 "kind", "media", "fallback", "enq_ts")
+    def __init__(self, due, target, req_id, text, reply_markup, parse_mode, inline_id, chat_id, msg_id, prio=EDIT_PRIO_MENU, digest=b"",
+                 kind="text", media=None, fallback=False):
         self.due = due
         self.target = target
         self.req_id = req_id
@@ -255,36 +349,141 @@ class _EditJob:
         self.inline_id = inline_id
         self.chat_id = chat_id
         self.msg_id = msg_id
+        self.prio = prio
+        self.digest = digest
+        self.kind = kind          # text | caption | media
+        self.media = media        # file_id фото для kind=media
+        self.fallback = fallback  # при ошибке caption/media повторить как текст
+        self.enq_ts = time.time()
 
 class EditLimiter:
-    """Serializes + rate-limits edit_message_text globally and per-message.
+    """Serializes + rate-limits message edits (text, caption, media) globally, per chat and per message.
 
     Key features:
     - Global gap between edits (avoids overall flood).
     - Per-target gap (avoids 'message is not modified' / 'too frequent' issues).
-    - Coalescing: if many edits queued for the same target (animation), only the latest is applied.
-    - Handles 429 retry_after by rescheduling the same edit.
+    - Per-chat token buckets (group ~20/min, private ~1/s); every inline message gets
+      its own bucket at the group rate, since its chat is unknown.
+    - Priority classes: final > menu > animation. Among due jobs the most important
+      goes first; the last EDIT_FINAL_RESERVE tokens of a bucket are kept for final
+      edits, and animation frames that would dip into the reserve are dropped.
+    - Coalescing: if many edits queued for the same target (animation), only the latest
+      is applied; it inherits the highest priority of the jobs it replaced.
+    - Handles 429 retry_after by rescheduling the same edit and freezing its bucket.
+    - A pool of workers sends edits to different targets in parallel; a target never
+      has two edits in flight, and the global gap is kept between request starts.
+    - Dedup: a bounded LRU keeps a hash of the last applied text+markup per target;
+      an edit identical to it is skipped without a request ('message is not modified').
+    - Caption and media edits share the queue, budgets and coalescing with text edits;
+      a failed caption/media edit can fall back to a text edit of the same message.
+    - Metrics (stats()): queue depth, coalesced/skipped/dropped jobs, 429s, enqueue->apply
+      latency per priority class and API call time; idle per-target state is pruned.
     """
-    def __init__(self, bot_obj, global_gap_sec=0.12, per_target_gap_sec=1.05):
+    def __init__(self, bot_obj, global_gap_sec=0.12, per_target_gap_sec=1.05,
+                 group_per_min=EDIT_GROUP_PER_MIN, private_per_sec=EDIT_PRIVATE_PER_SEC,
+                 bucket_burst=EDIT_BUCKET_BURST, final_reserve=EDIT_FINAL_RESERVE,
+                 workers=EDIT_WORKERS, dedup_size=EDIT_DEDUP_SIZE):
         self.bot = bot_obj
         self.global_gap = float(global_gap_sec)
         self.per_target_gap = float(per_target_gap_sec)
+        self.group_rate = float(group_per_min) / 60.0
+        self.private_rate = float(private_per_sec)
+        self.bucket_burst = float(bucket_burst)
+        self.final_reserve = max(0.0, min(float(final_reserve), self.bucket_burst - 1.0))
         self._lock = threading.RLock()
         self._cv = threading.Condition(self._lock)
         self._pq = []  
         self._counter = _itertools.count()
         self._latest_req = {} 
+        self._pending = {}
+        self._buckets = {}
         self._last_global = 0.0
         self._last_target = {}
+        self._inflight = set()
+        self._parked = {}
+        self._applied = OrderedDict()
+        self.dedup_size = max(1, int(dedup_size))
+        self._next_prune = time.time() + EDIT_PRUNE_SEC
+        self.reset_stats()
         self._running = True
-        self._thr = threading.Thread(target=self._run, daemon=True)
-        self._thr.start()
+        self._threads = []
+        for i in range(max(1, int(workers))):
+            thr = threading.Thread(target=self._run, name=f"edit-limiter-{i}", daemon=True)
+            thr.start()
+            self._threads.append(thr)
 
     def stop(self):
         with self._lock:
             self._running = False
             self._cv.notify_all()
 
+    def reset_stats(self):
+        with self._lock:
+            self.since = time.time()
+            self.enqueued = 0
+            self.applied = 0
+            self.coalesced = 0
+            self.skipped_same = 0
+            self.dropped_anim = 0
+            self.deferred = 0
+            self.retry_after = 0
+            self.retry_after_sec = 0.0
+            self.not_modified = 0
+            self.errors = 0
+            self.fallbacks = 0
+            self.pruned = 0
+            self.max_queue = 0
+            self.lat = {p: _LatencyHist() for p in (EDIT_PRIO_FINAL, EDIT_PRIO_MENU, EDIT_PRIO_ANIM)}
+            self.api = _LatencyHist()
+
+    def _prune_locked(self, now: float):
+        """Чистит состояние целей, которые давно не правились."""
+        n = 0
+        for target in list(self._latest_req):
+            if target not in self._pending and target not in self._inflight:
+                del self._latest_req[target]
+        for target, t in list(self._last_target.items()):
+            if now - t > self.per_target_gap and target not in self._inflight:
+                del self._last_target[target]
+                n += 1
+        for key, b in list(self._buckets.items()):
+            if b.blocked_until <= now and b.refill(now) >= b.burst:
+                del self._buckets[key]
+        self.pruned += n
+        self._next_prune = now + EDIT_PRUNE_SEC
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "since": self.since,
+                "workers": len(self._threads),
+                "global_gap": self.global_gap,
+                "per_target_gap": self.per_target_gap,
+                "queue": len(self._pq),
+                "max_queue": self.max_queue,
+                "pending": len(self._pending),
+                "parked": len(self._parked),
+                "inflight": len(self._inflight),
+                "targets": len(self._latest_req),
+                "last_target": len(self._last_target),
+                "buckets": len(self._buckets),
+                "dedup": len(self._applied),
+                "enqueued": self.enqueued,
+                "applied": self.applied,
+                "coalesced": self.coalesced,
+                "skipped_same": self.skipped_same,
+                "dropped_anim": self.dropped_anim,
+                "deferred": self.deferred,
+                "retry_after": self.retry_after,
+                "retry_after_sec": round(self.retry_after_sec, 1),
+                "not_modified": self.not_modified,
+                "errors": self.errors,
+                "fallbacks": self.fallbacks,
+                "pruned": self.pruned,
+                "lat": {p: h.summary() for p, h in self.lat.items()},
+                "api": self.api.summary(),
+            }
+
     def _parse_retry_after(self, exc: Exception) -> float:
         s = str(exc) # pyTelegramBotAPI often includes 'retry after X' in text
         m = re.search(r"retry after (\d+(?:\.\d+)?)", s, re.IGNORECASE)
@@ -302,82 +501,286 @@ class EditLimiter:
         due = max(due, self._last_target.get(target, 0.0) + self.per_target_gap)
         return due
 
+    def _bucket_key(self, target: tuple) -> tuple:
+        if target[0] == "inline":
+            return target
+        return ("chat", target[1])
+
+    def _bucket(self, target: tuple) -> _TokenBucket:
+        key = self._bucket_key(target)
+        b = self._buckets.get(key)
+        if b is None:
+            if key[0] == "chat" and int(key[1]) > 0:
+                rate = self.private_rate
+            else:
+                rate = self.group_rate
+            b = _TokenBucket(rate, self.bucket_burst)
+            self._buckets[key] = b
+        return b
+
+    @staticmethod
+    def _digest(text: str, reply_markup, parse_mode, kind: str = "text", media=None) -> bytes:
+        if reply_markup is None:
+            mk = ""
+        else:
+            try:
+                mk = reply_markup.to_json()
+            except Exception:
+                mk = repr(reply_markup)
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{kind}:{media or ''}:".encode("utf-8"))
+        h.update(str(parse_mode or "").encode("utf-8"))
+        h.update(b"\0")
+        h.update(str(text or "").encode("utf-8"))
+        h.update(b"\0")
+        h.update(str(mk).encode("utf-8"))
+        return h.digest()
+
+    def _is_applied_locked(self, target: tuple, digest: bytes) -> bool:
+        if self._applied.get(target) != digest:
+            return False
+        self._applied.move_to_end(target)
+        return True
+
+    def _remember_locked(self, target: tuple, digest: bytes):
+        self._applied[target] = digest
+        self._applied.move_to_end(target)
+        while len(self._applied) > self.dedup_size:
+            self._applied.popitem(last=False)
+
+    def forget(self, *, inline_id: str = None, chat_id: int = None, msg_id: int = None):
+        """Сообщение изменено в обход лимитера — его содержимое больше не известно."""
+        if inline_id:
+            target = ("inline", inline_id)
+        else:
+            target = ("chat", int(chat_id), int(msg_id))
+        with self._lock:
+            self._applied.pop(target, None)
+
+    def _need_tokens(self, prio: int) -> float:
+        return 1.0 if prio == EDIT_PRIO_FINAL else 1.0 + self.final_reserve
+
     def edit_text(self, *, text: str, reply_markup=None, parse_mode: str = None,
-                  inline_id: str = None, chat_id: int = None, msg_id: int = None):
+                  inline_id: str = None, chat_id: int = None, msg_id: int = None,
+                  priority: int = EDIT_PRIO_MENU):
+        return self.edit("text", text=text, reply_markup=reply_markup, parse_mode=parse_mode,
+                         inline_id=inline_id, chat_id=chat_id, msg_id=msg_id, priority=priority)
+
+    def edit_caption(self, *, caption: str, reply_markup=None, parse_mode: str = None,
+                     inline_id: str = None, chat_id: int = None, msg_id: int = None,
+                     priority: int = EDIT_PRIO_MENU, fallback_text: bool = False):
+        return self.edit("caption", text=caption, reply_markup=reply_markup, parse_mode=parse_mode,
+                         inline_id=inline_id, chat_id=chat_id, msg_id=msg_id, priority=priority,
+                         fallback=fallback_text)
+
+    def edit_media(self, *, file_id: str, caption: str, reply_markup=None, parse_mode: str = None,
+                   inline_id: str = None, chat_id: int = None, msg_id: int = None,
+                   priority: int = EDIT_PRIO_MENU, fallback_text: bool = False):
+        return self.edit("media", text=caption, reply_markup=reply_markup, parse_mode=parse_mode,
+                         inline_id=inline_id, chat_id=chat_id, msg_id=msg_id, priority=priority,
+                         media=file_id, fallback=fallback_text)
+
+    def edit(self, kind: str, *, text: str, reply_markup=None, parse_mode: str = None,
+             inline_id: str = None, chat_id: int = None, msg_id: int = None,
+             priority: int = EDIT_PRIO_MENU, media=None, fallback: bool = False):
         if inline_id:
             target = ("inline", inline_id)
         else:
             target = ("chat", int(chat_id), int(msg_id))
 
         with self._lock:
+            prio = min(max(int(priority), EDIT_PRIO_FINAL), EDIT_PRIO_ANIM)
+            prev = self._pending.get(target)
+            if prev is not None and prev.kind == "media" and kind == "caption":
+                # фото ещё не поставлено — новая подпись едет вместе с ним
+                kind, media, fallback = "media", prev.media, (fallback or prev.fallback)
+            digest = self._digest(text, reply_markup, parse_mode, kind, media)
+            busy = prev is not None or target in self._inflight
+            self.enqueued += 1
+            if not busy and self._is_applied_locked(target, digest):
+                self.skipped_same += 1
+                return True
+            # новая правка вытесняет ожидающую, но не понижает её класс
+            if prev is not None:
+                prio = min(prio, prev.prio)
+                self.coalesced += 1
             due = self._compute_due(target)
             req_id = next(self._counter)
             self._latest_req[target] = req_id
-            job = _EditJob(due, target, req_id, text, reply_markup, parse_mode, inline_id, chat_id, msg_id)
+            job = _EditJob(due, target, req_id, text, reply_markup, parse_mode, inline_id, chat_id, msg_id, prio, digest,
+                           kind, media, fallback)
+            self._pending[target] = job
             heapq.heappush(self._pq, (job.due, next(self._counter), job))
+            if len(self._pq) > self.max_queue:
+                self.max_queue = len(self._pq)
             self._cv.notify()
         return True
 
+    def _pick_locked(self, now: float):
+        """Выбирает самую важную из созревших правок; остальные возвращает в очередь."""
+        ready = []
+        while self._pq and self._pq[0][0] <= now:
+            _, _, job = heapq.heappop(self._pq)
+            if self._latest_req.get(job.target) != job.req_id:
+                continue
+            if job.target in self._inflight:
+                # дождётся завершения текущей правки этого сообщения
+                self._parked[job.target] = job
+                continue
+            if self._is_applied_locked(job.target, job.digest):
+                self.skipped_same += 1
+                self._pending.pop(job.target, None)
+                continue
+            ready.append(job)
+        if not ready:
+            return None
+
+        ready.sort(key=lambda j: (j.prio, j.due, j.req_id))
+        picked = None
+        for job in ready:
+            if picked is not None:
+                heapq.heappush(self._pq, (job.due, next(self._counter), job))
+                continue
+            b = self._bucket(job.target)
+            at = b.ready_at(now, self._need_tokens(job.prio))
+            if at <= now:
+                b.take(now)
+                picked = job
+                continue
+            if job.prio == EDIT_PRIO_ANIM:
+                # кадр устареет раньше, чем освободится бюджет чата
+                self.dropped_anim += 1
+                self._pending.pop(job.target, None)
+                continue
+            self.deferred += 1
+            job.due = at
+            heapq.heappush(self._pq, (job.due, next(self._counter), job))
+        if picked is not None:
+            self._pending.pop(picked.target, None)
+            self._inflight.add(picked.target)
+            self._last_global = now
+        return picked
+
+    def _send(self, job: _EditJob):
+        if job.inline_id:
+            where = {"inline_message_id": job.inline_id}
+        else:
+            where = {"chat_id": job.chat_id, "message_id": job.msg_id}
+        if job.kind == "media":
+            media = InputMediaPhoto(media=job.media, caption=job.text, parse_mode=job.parse_mode)
+            self.bot.edit_message_media(media=media, reply_markup=job.reply_markup, **where)
+        elif job.kind == "caption":
+            self.bot.edit_message_caption(caption=job.text, parse_mode=job.parse_mode,
+                                          reply_markup=job.reply_markup, **where)
+        else:
+            self.bot.edit_message_text(job.text, reply_markup=job.reply_markup,
+                                       parse_mode=job.parse_mode, **where)
+
+    def _retype_pending_caption_locked(self, target: tuple, kind: str, media, fallback: bool) -> bool:
+        """Ждущая подпись к неудавшейся правке: превращается в фото (media) или в текст."""
+        nxt = self._pending.get(target)
+        if nxt is None or nxt.kind != "caption":
+            return False
+        nxt.kind, nxt.media = kind, media
+        nxt.fallback = (nxt.fallback or fallback) if kind != "text" else False
+        nxt.digest = self._digest(nxt.text, nxt.reply_markup, nxt.parse_mode, kind, media)
+        return True
+
+    def _release_locked(self, job: _EditJob, t: float):
+        self._inflight.discard(job.target)
+        parked = self._parked.pop(job.target, None)
+        if parked is not None and self._latest_req.get(parked.target) == parked.req_id:
+            parked.due = max(parked.due, t + self.per_target_gap)
+            heapq.heappush(self._pq, (parked.due, next(self._counter), parked))
+        self._cv.notify_all()
+
     def _run(self):
         while True:
             with self._lock:
                 if not self._running:
                     return
+                if time.time() >= self._next_prune:
+                    self._prune_locked(time.time())
                 if not self._pq:
                     self._cv.wait(timeout=0.5)
                     continue
-                due, _, job = self._pq[0]
+                due = self._pq[0][0]
                 now = time.time()
+                due = max(due, self._last_global + self.global_gap)
                 if due > now:
                     self._cv.wait(timeout=min(0.5, due - now))
                     continue
-                heapq.heappop(self._pq)
-
-                if self._latest_req.get(job.target) != job.req_id:
+                job = self._pick_locked(now)
+                if job is None:
                     continue
 
+            t0 = time.time()
             try:
-                if job.inline_id:
-                    self.bot.edit_message_text(
-                        job.text,
-                        inline_message_id=job.inline_id,
-                        reply_markup=job.reply_markup,
-                        parse_mode=job.parse_mode
-                    )
-                else:
-                    self.bot.edit_message_text(
-                        job.text,
-                        chat_id=job.chat_id,
-                        message_id=job.msg_id,
-                        reply_markup=job.reply_markup,
-                        parse_mode=job.parse_mode
-                    )
+                self._send(job)
 
                 with self._lock:
                     t = time.time()
-                    self._last_global = t
+                    self.applied += 1
+                    self.api.add(t - t0)
+                    self.lat[job.prio].add(t - job.enq_ts)
                     self._last_target[job.target] = t
+                    self._remember_locked(job.target, job.digest)
+                    self._release_locked(job, t)
 
             except Exception as e:
                 ra = self._parse_retry_after(e)
-                if ra > 0:
-                    with self._lock:
-                        self._latest_req[job.target] = job.req_id
-                        job.due = time.time() + ra + 0.15
-                        heapq.heappush(self._pq, (job.due, next(self._counter), job))
-                        self._cv.notify()
+                with self._lock:
+                    t = time.time()
+                    self.api.add(t - t0)
+                    not_modified = "message is not modified" in str(e).lower()
+                    if not_modified:
+                        self.not_modified += 1
+                        self._remember_locked(job.target, job.digest)
+                    else:
+                        self._applied.pop(job.target, None)
+                    if ra > 0:
+                        self.retry_after += 1
+                        self.retry_after_sec += ra
+                    elif not not_modified:
+                        self.errors += 1
+                    if ra > 0:
+                        job.due = t + ra + 0.15
+                        self._bucket(job.target).block(job.due)
+                        if self._latest_req.get(job.target) == job.req_id:
+                            self._pending[job.target] = job
+                            heapq.heappush(self._pq, (job.due, next(self._counter), job))
+                        elif job.kind == "media":
+                            # фото не встало — ждущая за ним подпись должна его поставить
+                            self._retype_pending_caption_locked(job.target, "media", job.media, job.fallback)
+                    elif job.fallback and job.kind != "text" and not not_modified:
+                        # подписи нет (сообщение текстовое) — как раньше, правим текст
+                        if self._latest_req.get(job.target) == job.req_id:
+                            self.fallbacks += 1
+                            job.kind, job.media, job.fallback = "text", None, False
+                            job.digest = self._digest(job.text, job.reply_markup, job.parse_mode)
+                            job.due = t
+                            self._pending[job.target] = job
+                            heapq.heappush(self._pq, (job.due, next(self._counter), job))
+                        elif self._retype_pending_caption_locked(job.target, "text", None, False):
+                            self.fallbacks += 1
+                    self._release_locked(job, t)
                 continue
 
 # Global instance
 EDIT_LIMITER = EditLimiter(bot, global_gap_sec=0.12, per_target_gap_sec=1.05)
 
 def limited_edit_message_text(*, text: str, reply_markup=None, parse_mode: str = None,
-                              inline_id: str = None, chat_id: int = None, msg_id: int = None):
+                              inline_id: str = None, chat_id: int = None, msg_id: int = None,
+                              priority: int = EDIT_PRIO_MENU):
     """Enqueue an edit_message_text through the global limiter."""
     try:
         EDIT_LIMITER.edit_text(text=text, reply_markup=reply_markup, parse_mode=parse_mode,
-                               inline_id=inline_id, chat_id=chat_id, msg_id=msg_id)
+                               inline_id=inline_id, chat_id=chat_id, msg_id=msg_id, priority=priority)
     except Exception:
+        try:
+            EDIT_LIMITER.forget(inline_id=inline_id, chat_id=chat_id, msg_id=msg_id)
+        except Exception:
+            pass
         try:
             if inline_id:
                 bot.edit_message_text(text, inline_message_id=inline_id, reply_markup=reply_markup, parse_mode=parse_mode)
@@ -386,6 +789,49 @@ def limited_edit_message_text(*, text: str, reply_markup=None, parse_mode: str =
         except Exception:
             pass
 
+def limited_edit_message_caption(*, caption: str, reply_markup=None, parse_mode: str = None,
+                                 inline_id: str = None, chat_id: int = None, msg_id: int = None,
+                                 priority: int = EDIT_PRIO_MENU, fallback_text: bool = False):
+    """Enqueue an edit_message_caption through the global limiter."""
+    try:
+        EDIT_LIMITER.edit_caption(caption=caption, reply_markup=reply_markup, parse_mode=parse_mode,
+                                  inline_id=inline_id, chat_id=chat_id, msg_id=msg_id,
+                                  priority=priority, fallback_text=fallback_text)
+    except Exception:
+        _direct_media_edit(None, caption, reply_markup, parse_mode, inline_id, chat_id, msg_id, fallback_text)
+
+def limited_edit_message_media(*, file_id: str, caption: str, reply_markup=None, parse_mode: str = None,
+                               inline_id: str = None, chat_id: int = None, msg_id: int = None,
+                               priority: int = EDIT_PRIO_MENU, fallback_text: bool = False):
+    """Enqueue an edit_message_media (photo + caption) through the global limiter."""
+    try:
+        EDIT_LIMITER.edit_media(file_id=file_id, caption=caption, reply_markup=reply_markup, parse_mode=parse_mode,
+                                inline_id=inline_id, chat_id=chat_id, msg_id=msg_id,
+                                priority=priority, fallback_text=fallback_text)
+    except Exception:
+        _direct_media_edit(file_id, caption, reply_markup, parse_mode, inline_id, chat_id, msg_id, fallback_text)
+
+def _direct_media_edit(file_id, caption, reply_markup, parse_mode, inline_id, chat_id, msg_id, fallback_text):
+    try:
+        EDIT_LIMITER.forget(inline_id=inline_id, chat_id=chat_id, msg_id=msg_id)
+    except Exception:
+        pass
+    where = {"inline_message_id": inline_id} if inline_id else {"chat_id": chat_id, "message_id": msg_id}
+    try:
+        if file_id:
+            media = InputMediaPhoto(media=file_id, caption=caption, parse_mode=parse_mode)
+            bot.edit_message_media(media=media, reply_markup=reply_markup, **where)
+        else:
+            bot.edit_message_caption(caption=caption, parse_mode=parse_mode, reply_markup=reply_markup, **where)
+        return
+    except Exception:
+        pass
+    if fallback_text:
+        try:
+            bot.edit_message_text(caption, reply_markup=reply_markup, parse_mode=parse_mode, **where)
+        except Exception:
+            pass
+
 # Защита бота от падения
 def init_bot_identity():
     try:
@@ -456,11 +902,6 @@ conn.execute("PRAGMA journal_mode=WAL;")
 conn.execute("PRAGMA synchronous=NORMAL;")
 conn.execute("PRAGMA busy_timeout=8000;")
 conn.execute("PRAGMA wal_autocheckpoint=2000;")  # ~8MB при page_size=4096
-try: #проверка 2
-    conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
-except Exception as e:
-    print("wal_checkpoint failed:", e)
-
 cur = conn.cursor()
 #проверка 3
 print("DB absolute:", cur.execute("PRAGMA database_list;").fetchall())
@@ -468,41 +909,586 @@ print("journal_mode:", cur.execute("PRAGMA journal_mode;").fetchone())
 print("wal_autocheckpoint:", cur.execute("PRAGMA wal_autocheckpoint;").fetchone())
 
 DB_LOCK = threading.RLock()
-with DB_LOCK:
+
+# Читатели: WAL позволяет читать параллельно с записью, поэтому SELECT-ы
+# идут через пул read-only соединений и не ждут DB_LOCK.
+# conn остаётся единственным соединением-писателем (db_exec, транзакции).
+DB_READ_POOL_SIZE = max(1, int(os.environ.get("DB_READ_POOL_SIZE", "6") or 6))
+_DB_TLS = threading.local()
+
+class ReadPool:
+    """
+    Пул read-only соединений к DB_PATH.
+    - соединение берётся на один запрос и сразу возвращается (потоки спинов живут недолго,
+      поэтому соединения не привязываются к потоку навсегда);
+    - не больше size соединений одновременно, остальные ждут;
+    - метрики: checkouts, ожидания, время ожидания, сколько чтений ушло на писателя.
+    """
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = max(1, int(size))
+        self._cv = threading.Condition(threading.Lock())
+        self._free: List[sqlite3.Connection] = []
+        self._opened = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.writer_reads = 0
+
+    def _open(self) -> sqlite3.Connection:
+        c = sqlite3.connect(self.path, check_same_thread=False)
+        c.execute("PRAGMA busy_timeout=8000;")
+        c.execute("PRAGMA query_only=ON;")
+        return c
+
+    def acquire(self) -> sqlite3.Connection:
+        t0 = time.perf_counter()
+        waited = False
+        with self._cv:
+            while True:
+                if self._free:
+                    c = self._free.pop()
+                    break
+                if self._opened < self.size:
+                    self._opened += 1
+                    c = None
+                    break
+                waited = True
+                self._cv.wait(timeout=1.0)
+            dt = time.perf_counter() - t0
+            self.checkouts += 1
+            if waited:
+                self.waits += 1
+            self.wait_total += dt
+            if dt > self.wait_max:
+                self.wait_max = dt
+        if c is None:
+            try:
+                c = self._open()
+            except Exception:
+                with self._cv:
+                    self._opened -= 1
+                    self._cv.notify()
+                raise
+        return c
+
+    def release(self, c: sqlite3.Connection, broken: bool = False) -> None:
+        with self._cv:
+            if broken:
+                self._opened -= 1
+                try:
+                    c.close()
+                except Exception:
+                    pass
+            else:
+                self._free.append(c)
+            self._cv.notify()
+
+    def stats(self) -> dict:
+        with self._cv:
+            n = max(1, self.checkouts)
+            return {
+                "size": self.size,
+                "opened": self._opened,
+                "idle": len(self._free),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "wait_total_ms": round(self.wait_total * 1000, 2),
+                "wait_avg_ms": round(self.wait_total * 1000 / n, 3),
+                "wait_max_ms": round(self.wait_max * 1000, 2),
+                "writer_reads": self.writer_reads,
+            }
+
+DB_READ_POOL = ReadPool(DB_PATH, DB_READ_POOL_SIZE)
+
+# Профайлер запросов (опционально): DB_PROFILE=1 или /dbprof on.
+# Запросы сводятся к отпечатку (литералы -> ?, списки IN (...) -> один ?), по отпечатку копятся
+# число вызовов, суммарное/p50/p95/макс время, строки и отдельно ожидание (DB_LOCK/пул/очередь записи).
+DB_PROFILE = os.environ.get("DB_PROFILE", "0") == "1"
+DB_PROFILE_DUMP_SEC = max(60, int(os.environ.get("DB_PROFILE_DUMP_SEC", "600") or 600))
+DB_PROFILE_PATH = os.path.join(DATA_DIR, "dbprof.txt")
+
+_SQL_FP_STR = re.compile(r"'(?:[^']|'')*'")
+_SQL_FP_NUM = re.compile(r"\b\d+(?:\.\d+)?\b")
+_SQL_FP_IN = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SQL_FP_WS = re.compile(r"\s+")
+
+def sql_fingerprint(sql: str) -> str:
+    s = _SQL_FP_STR.sub("?", sql or "")
+    s = _SQL_FP_NUM.sub("?", s)
+    s = _SQL_FP_WS.sub(" ", s).strip()
+    return _SQL_FP_IN.sub("(?+)", s)
+
+class _QueryStat:
+    __slots__ = ("count", "total", "wait", "rows", "max", "samples", "_pos")
+    SAMPLES = 256
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.wait = 0.0
+        self.rows = 0
+        self.max = 0.0
+        self.samples: List[float] = []
+        self._pos = 0
+
+    def add(self, exec_sec: float, wait_sec: float, rows: int):
+        self.count += 1
+        self.total += exec_sec
+        self.wait += wait_sec
+        self.rows += rows
+        if exec_sec > self.max:
+            self.max = exec_sec
+        # для перцентилей держим последние SAMPLES замеров (кольцо)
+        if len(self.samples) < self.SAMPLES:
+            self.samples.append(exec_sec)
+        else:
+            self.samples[self._pos] = exec_sec
+            self._pos = (self._pos + 1) % self.SAMPLES
+
+class QueryProfiler:
+    def __init__(self, enabled: bool):
+        self.enabled = bool(enabled)
+        self.since = time.time()
+        self._lock = threading.Lock()
+        self._stats: Dict[str, _QueryStat] = {}
+        self._fp_cache: Dict[str, str] = {}
+
+    def record(self, sql: str, exec_sec: float, wait_sec: float = 0.0, rows: int = 0):
+        if not self.enabled:
+            return
+        fp = self._fp_cache.get(sql)
+        if fp is None:
+            fp = sql_fingerprint(sql)
+            if len(self._fp_cache) < 4096:
+                self._fp_cache[sql] = fp
+        with self._lock:
+            st = self._stats.get(fp)
+            if st is None:
+                st = self._stats[fp] = _QueryStat()
+            st.add(exec_sec, wait_sec, max(0, int(rows or 0)))
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.since = time.time()
+
+    def report(self, top: int = 15, key: str = "total") -> List[dict]:
+        with self._lock:
+            items = [(fp, st.count, st.total, st.wait, st.rows, st.max, sorted(st.samples))
+                     for fp, st in self._stats.items()]
+        out = []
+        for fp, count, total, wait, rows, mx, smp in items:
+            n = len(smp)
+            out.append({
+                "sql": fp,
+                "count": count,
+                "total_ms": round(total * 1000, 1),
+                "wait_ms": round(wait * 1000, 1),
+                "p50_ms": round(smp[n // 2] * 1000, 3) if n else 0.0,
+                "p95_ms": round(smp[min(n - 1, int(n * 0.95))] * 1000, 3) if n else 0.0,
+                "max_ms": round(mx * 1000, 3),
+                "rows": rows,
+            })
+        out.sort(key=lambda r: r.get(key, 0), reverse=True)
+        return out[:max(1, int(top))]
+
+    def dump(self, path: str, top: int = 50) -> None:
+        rows = self.report(top)
+        lines = [
+            f"# {time.strftime('%Y-%m-%d %H:%M:%S')} с {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.since))}",
+            "total_ms\twait_ms\tcount\tp50_ms\tp95_ms\tmax_ms\trows\tsql",
+        ]
+        for r in rows:
+            lines.append(
+                f"{r['total_ms']}\t{r['wait_ms']}\t{r['count']}\t{r['p50_ms']}\t{r['p95_ms']}\t"
+                f"{r['max_ms']}\t{r['rows']}\t{r['sql']}"
+            )
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+DB_PROF = QueryProfiler(DB_PROFILE)
+
+def _db_lock_held() -> bool:
     try:
-        conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+        return bool(DB_LOCK._is_owned())
     except Exception:
-        pass
+        return False
 
-def db_one(sql: str, params=()):
-    with DB_LOCK:
-        c = conn.cursor()
-        try:
-            c.execute(sql, params)
-            return c.fetchone()
-        finally:
+def _db_read_on_writer() -> bool:
+    """
+    Чтение идёт через conn, если поток сам держит DB_LOCK (внутри своей транзакции)
+    или оставил на conn незакоммиченные записи (db_exec без commit) — иначе
+    read-only соединение их не увидит.
+    """
+    if _db_lock_held():
+        return True
+    if getattr(_DB_TLS, "dirty", False):
+        if conn.in_transaction:
+            return True
+        _DB_TLS.dirty = False
+    return False
+
+def _prof_rows(res, many: bool) -> int:
+    if many:
+        return len(res or ())
+    return 1 if res is not None else 0
+
+def _db_read(sql: str, params, many: bool):
+    t0 = time.perf_counter()
+    if _db_read_on_writer():
+        with DB_LOCK:
+            t1 = time.perf_counter()
+            DB_READ_POOL.writer_reads += 1
+            c = conn.cursor()
+            try:
+                c.execute(sql, params)
+                res = c.fetchall() if many else c.fetchone()
+                if DB_PROF.enabled:
+                    DB_PROF.record(sql, time.perf_counter() - t1, t1 - t0, _prof_rows(res, many))
+                return res
+            finally:
+                try: c.close()
+                except: pass
+
+    rc = DB_READ_POOL.acquire()
+    t1 = time.perf_counter()
+    broken = False
+    c = None
+    try:
+        c = rc.cursor()
+        c.execute(sql, params)
+        res = c.fetchall() if many else c.fetchone()
+        if DB_PROF.enabled:
+            DB_PROF.record(sql, time.perf_counter() - t1, t1 - t0, _prof_rows(res, many))
+        return res
+    except sqlite3.OperationalError as e:
+        # "readonly database"/"attempt to write" — запрос не чисто читающий, уходим на писателя
+        msg = str(e).lower()
+        if "readonly" in msg or "read-only" in msg or "query_only" in msg:
+            with DB_LOCK:
+                c2 = conn.cursor()
+                try:
+                    c2.execute(sql, params)
+                    if conn.in_transaction:
+                        _DB_TLS.dirty = True
+                    return c2.fetchall() if many else c2.fetchone()
+                finally:
+                    try: c2.close()
+                    except: pass
+        raise
+    except sqlite3.DatabaseError:
+        broken = True
+        raise
+    finally:
+        if c is not None:
             try: c.close()
             except: pass
+        DB_READ_POOL.release(rc, broken=broken)
+
+def db_pool_stats() -> dict:
+    return DB_READ_POOL.stats()
+
+def db_one(sql: str, params=()):
+    return _db_read(sql, params, many=False)
 
 def db_all(sql: str, params=()):
-    with DB_LOCK:
+    return _db_read(sql, params, many=True)
+
+# Потоковое чтение: большие выборки (обход users/daily_mail) не копируются в память целиком,
+# а читаются кусками по DB_STREAM_CHUNK со своего read-only соединения (отдельный маленький пул,
+# чтобы долгий обход в демоне не занимал слоты DB_READ_POOL). DB_LOCK между кусками не держится;
+# снимок — на момент первого fetch (WAL), записи во время обхода ему не мешают.
+DB_STREAM_CHUNK = max(1, int(os.environ.get("DB_STREAM_CHUNK", "500") or 500))
+DB_STREAM_POOL = ReadPool(DB_PATH, max(1, int(os.environ.get("DB_STREAM_POOL_SIZE", "2") or 2)))
+
+def db_iter(sql: str, params=(), chunk: int = DB_STREAM_CHUNK):
+    """Генератор строк. Если потоку нужен read-your-writes (см. _db_read_on_writer) — буферизованный db_all."""
+    if _db_read_on_writer():
+        for r in db_all(sql, params) or []:
+            yield r
+        return
+
+    rc = DB_STREAM_POOL.acquire()
+    broken = False
+    cu = None
+    spent = 0.0
+    n = 0
+    try:
+        t0 = time.perf_counter()
+        cu = rc.execute(sql, params)
+        spent += time.perf_counter() - t0
+        while True:
+            t0 = time.perf_counter()
+            rows = cu.fetchmany(chunk)
+            spent += time.perf_counter() - t0
+            if not rows:
+                break
+            n += len(rows)
+            for r in rows:
+                yield r
+    except sqlite3.DatabaseError:
+        broken = True
+        raise
+    finally:
+        if cu is not None:
+            try:
+                cu.close()  # закрывает read-транзакцию, если обход бросили на середине
+            except Exception:
+                pass
+        DB_STREAM_POOL.release(rc, broken=broken)
+        if DB_PROF.enabled:
+            DB_PROF.record(sql, spent, 0.0, n)
+
+# Писатель: один поток забирает записи из очереди и коммитит их пачкой (group commit),
+# вместо отдельного conn.commit() (WAL sync) на каждый db_exec(commit=True).
+DB_WRITE_LINGER_SEC = max(0.0, float(os.environ.get("DB_WRITE_LINGER_MS", "2") or 2) / 1000.0)
+DB_WRITE_BATCH_MAX = 256
+# писатель ждёт, пока чужой db_exec(commit=False) закоммитит свою транзакцию на conn; если ждёт
+# дольше этого, считаем транзакцию зависшей и сообщаем о ней (пачка остаётся в ожидании)
+DB_WRITE_FOREIGN_REPORT_SEC = max(0.1, float(os.environ.get("DB_WRITE_FOREIGN_REPORT_MS", "5000") or 5000) / 1000.0)
+
+class _WriteJob:
+    __slots__ = ("sql", "params", "rc", "lid", "exc", "exec_sec", "_done")
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+        self.rc = 0
+        self.lid = None
+        self.exc = None
+        self.exec_sec = 0.0
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def result(self, timeout: Optional[float] = None):
+        """Ждёт коммита пачки. Возвращает (rowcount, lastrowid) или бросает ошибку запроса."""
+        if not self._done.wait(timeout):
+            raise TimeoutError("db write not committed yet")
+        if self.exc is not None:
+            raise self.exc
+        return self.rc, self.lid
+
+class WriteQueue:
+    """
+    Очередь записей с групповым коммитом.
+    - каждая запись выполняется в своём SAVEPOINT: ошибка одной не откатывает соседей;
+    - пачка = то, что накопилось, пока шёл прошлый коммит (+ ожидание linger до batch_max,
+      если видно, что пишут сразу несколько потоков);
+    - если на conn открыта чужая транзакция (db_exec без commit в другом потоке), пачка
+      ждёт её коммита: иначе наш COMMIT зафиксировал бы чужую работу наполовину; записи из очереди
+      по таймеру не отбрасываются, долгое ожидание только попадает в foreign_timeouts и отчёт;
+    - submit() возвращает _WriteJob — вызывающий ждёт result(), когда ему нужен rowcount/lastrowid
+      или гарантия, что следующий SELECT увидит запись.
+    """
+    def __init__(self, linger_sec: float, batch_max: int, foreign_report_sec: float = 5.0):
+        self.linger = float(linger_sec)
+        self.batch_max = max(1, int(batch_max))
+        self.foreign_report = max(0.1, float(foreign_report_sec))
+        self._cv = threading.Condition(threading.Lock())
+        self._q: List[_WriteJob] = []
+        self._running = True
+        self.batches = 0
+        self.jobs = 0
+        self.errors = 0
+        self.max_batch = 0
+        self.commit_total = 0.0
+        self.foreign_waits = 0
+        self.foreign_timeouts = 0
+        self._thr = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thr.start()
+
+    def running(self) -> bool:
+        return self._running and self._thr.is_alive()
+
+    def is_writer_thread(self) -> bool:
+        return threading.current_thread() is self._thr
+
+    def submit(self, sql: str, params=()) -> _WriteJob:
+        job = _WriteJob(sql, params)
+        with self._cv:
+            self._q.append(job)
+            self._cv.notify()
+        return job
+
+    def stop(self):
+        with self._cv:
+            self._running = False
+            self._cv.notify_all()
+
+    def _take_batch(self) -> List[_WriteJob]:
+        with self._cv:
+            while not self._q:
+                if not self._running:
+                    return []
+                self._cv.wait(timeout=0.5)
+            if len(self._q) > 1 and self.linger > 0:
+                # каждый submit будит notify — ждём до дедлайна, а не до следующей записи
+                deadline = time.monotonic() + self.linger
+                while len(self._q) < self.batch_max and self._running:
+                    left = deadline - time.monotonic()
+                    if left <= 0:
+                        break
+                    self._cv.wait(timeout=left)
+            batch = self._q[:self.batch_max]
+            del self._q[:self.batch_max]
+            return batch
+
+    def _apply(self, batch: List[_WriteJob]) -> None:
+        t0 = time.monotonic()
+        deadline = t0 + self.foreign_report
+        waited = False
+        stalled = False
+        while True:
+            with DB_LOCK:
+                if not conn.in_transaction:
+                    self._apply_locked(batch)
+                    break
+            # чужие незакоммиченные записи: DB_LOCK отпущен, ждём их db_commit
+            if not waited:
+                waited = True
+                self.foreign_waits += 1
+            if time.monotonic() >= deadline:
+                self.foreign_timeouts += 1
+                stalled = True
+                deadline = time.monotonic() + self.foreign_report
+                print(f"db writer: foreign transaction open for {time.monotonic() - t0:.1f}s, {len(batch)} writes waiting")
+            time.sleep(0.002)
+        if stalled:
+            # отчёт сам пишет в bot_state — из писателя, пока conn занят, его слать нельзя
+            ctx = f"db_writer: foreign transaction held conn {time.monotonic() - t0:.1f}s"
+            threading.Thread(target=send_error_report, args=(ctx,), daemon=True).start()
+
+    def _apply_locked(self, batch: List[_WriteJob]) -> None:
+        """Вызывается под DB_LOCK, когда на conn нет открытой транзакции."""
+        ok: List[_WriteJob] = []
         c = conn.cursor()
         try:
-            c.execute(sql, params)
-            return c.fetchall()
+            c.execute("BEGIN")
+            for job in batch:
+                c.execute("SAVEPOINT wq")
+                try:
+                    t0 = time.perf_counter()
+                    c.execute(job.sql, job.params)
+                    job.exec_sec = time.perf_counter() - t0
+                    job.rc = c.rowcount
+                    job.lid = c.lastrowid
+                    c.execute("RELEASE wq")
+                    ok.append(job)
+                except Exception as e:
+                    job.exc = e
+                    self.errors += 1
+                    try:
+                        c.execute("ROLLBACK TO wq")
+                        c.execute("RELEASE wq")
+                    except Exception:
+                        pass
+            t0 = time.perf_counter()
+            conn.commit()
+            self.commit_total += time.perf_counter() - t0
+        except Exception as e:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            for job in ok:
+                job.exc = e
         finally:
-            try: c.close()
-            except: pass
+            try:
+                c.close()
+            except Exception:
+                pass
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                if not self._running:
+                    return
+                continue
+            try:
+                self._apply(batch)
+            except Exception as e:
+                for job in batch:
+                    if job.exc is None:
+                        job.exc = e
+            self.batches += 1
+            self.jobs += len(batch)
+            if len(batch) > self.max_batch:
+                self.max_batch = len(batch)
+            for job in batch:
+                job._done.set()
+
+    def stats(self) -> dict:
+        with self._cv:
+            pending = len(self._q)
+        b = max(1, self.batches)
+        return {
+            "pending": pending,
+            "batches": self.batches,
+            "jobs": self.jobs,
+            "errors": self.errors,
+            "avg_batch": round(self.jobs / b, 2),
+            "max_batch": self.max_batch,
+            "commit_avg_ms": round(self.commit_total * 1000 / b, 3),
+            "foreign_waits": self.foreign_waits,
+            "foreign_timeouts": self.foreign_timeouts,
+        }
+
+DB_WRITER = WriteQueue(DB_WRITE_LINGER_SEC, DB_WRITE_BATCH_MAX, DB_WRITE_FOREIGN_REPORT_SEC)
+
+def _db_in_tx() -> bool:
+    return getattr(_DB_TLS, "tx_depth", 0) > 0
+
+def _db_write_inline() -> bool:
+    """Пишем прямо в conn, если очередь не поможет или приведёт к дедлоку."""
+    if _db_in_tx() or _db_lock_held() or DB_WRITER.is_writer_thread() or not DB_WRITER.running():
+        return True
+    return bool(getattr(_DB_TLS, "dirty", False) and conn.in_transaction)
+
+def db_submit(sql: str, params=()) -> _WriteJob:
+    """Поставить запись в очередь писателя, не дожидаясь коммита."""
+    if _db_write_inline():
+        job = _WriteJob(sql, params)
+        try:
+            job.rc, job.lid = db_exec(sql, params, commit=True)
+        except Exception as e:
+            job.exc = e
+        job._done.set()
+        return job
+    return DB_WRITER.submit(sql, params)
+
+def db_writer_stats() -> dict:
+    return DB_WRITER.stats()
 
 def db_exec(sql: str, params=(), commit: bool = False):
+    t0 = time.perf_counter()
+    if commit and not _db_write_inline():
+        job = DB_WRITER.submit(sql, params)
+        try:
+            return job.result()
+        finally:
+            if DB_PROF.enabled:
+                # ожидание = очередь + групповой коммит
+                DB_PROF.record(sql, job.exec_sec, max(0.0, time.perf_counter() - t0 - job.exec_sec), job.rc)
+
     with DB_LOCK:
+        t1 = time.perf_counter()
         c = conn.cursor()
         try:
             c.execute(sql, params)
             rc = c.rowcount
             lid = c.lastrowid
-            if commit:
+            if commit and not _db_in_tx():
                 conn.commit()
+            elif conn.in_transaction:
+                _DB_TLS.dirty = True
+            if DB_PROF.enabled:
+                DB_PROF.record(sql, time.perf_counter() - t1, t1 - t0, rc)
             return rc, lid
         finally:
             try:
@@ -510,560 +1496,661 @@ def db_exec(sql: str, params=(), commit: bool = False):
             except:
                 pass
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS users (
-  user_id INTEGER PRIMARY KEY,
-  username TEXT,
-  short_name TEXT,
-  created_ts INTEGER,
-  contract_ts INTEGER,
-  balance_cents INTEGER DEFAULT 0,          -- текущий капитал в "центах"
-  demo_gift_cents INTEGER DEFAULT 0,        -- стартовые 1000$ (в центах), НЕ участвуют в топе
-  demon INTEGER DEFAULT 0                   -- 1 если демон
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS user_settings (
-  user_id INTEGER PRIMARY KEY,
-  pm_notify INTEGER NOT NULL DEFAULT 1,
-  auto_delete_pm INTEGER NOT NULL DEFAULT 1,
-  settings_msg_id INTEGER NOT NULL DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS pm_bot_messages (
-  chat_id INTEGER NOT NULL,
-  message_id INTEGER NOT NULL,
-  created_ts INTEGER NOT NULL,
-  delete_after_ts INTEGER NOT NULL,
-  deleted INTEGER NOT NULL DEFAULT 0,
-  PRIMARY KEY (chat_id, message_id)
-)
-""")
-
-cur.execute("""
-CREATE INDEX IF NOT EXISTS idx_pm_bot_messages_gc
-ON pm_bot_messages(deleted, delete_after_ts)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS reg_state (
-  user_id INTEGER PRIMARY KEY,
-  stage TEXT,           -- 'await_open' | 'await_name' | NULL
-  msg_id INTEGER,       -- id сообщения в ЛС, которое мы редактируем
-  last_ts INTEGER
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS daily_mail (
-  user_id INTEGER PRIMARY KEY,
-  next_ts INTEGER NOT NULL,
-  intro_sent INTEGER DEFAULT 0,
-  stopped INTEGER DEFAULT 0,
-  pending_amt_cents INTEGER DEFAULT 0,
-  pending_kind TEXT,
-  pending_msg_id INTEGER DEFAULT 0
-)
-""")
+def db_commit() -> None:
+    """conn.commit() под DB_LOCK; внутри db_tx коммит откладывается до конца единицы работы."""
+    if _db_in_tx():
+        return
+    with DB_LOCK:
+        conn.commit()
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS enslave_risk (
-  user_id INTEGER PRIMARY KEY,
-  chance_pct INTEGER NOT NULL DEFAULT 10
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS game_stats (
-  user_id INTEGER PRIMARY KEY,
-  games_total INTEGER DEFAULT 0,
-  wins INTEGER DEFAULT 0,
-  losses INTEGER DEFAULT 0,
-  max_win_cents INTEGER DEFAULT 0,
-  max_lose_cents INTEGER DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS game_type_stats (
-  user_id INTEGER,
-  game_type TEXT,
-  cnt INTEGER DEFAULT 0,
-  PRIMARY KEY (user_id, game_type)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS slavery (
-  slave_id INTEGER,
-  owner_id INTEGER,
-  share_bp INTEGER DEFAULT 6000,  -- доля в базисных пунктах (1000=10%)
-  PRIMARY KEY (slave_id, owner_id)
-)
-""")
+# сколько db_tx ждёт, пока чужой db_exec(commit=False) закоммитит свою транзакцию на conn
+DB_TX_FOREIGN_WAIT_SEC = max(0.0, float(os.environ.get("DB_TX_FOREIGN_WAIT_MS", "30000") or 30000) / 1000.0)
+DB_TX_FOREIGN_STATS = {"waits": 0, "timeouts": 0}
 
-#SLAVERY EXTENSIONS / BUY OFFERS
-try:
-    cur.execute("ALTER TABLE slavery ADD COLUMN earned_cents INTEGER DEFAULT 0")
-except Exception:
-    pass
-try:
-    cur.execute("ALTER TABLE slavery ADD COLUMN acquired_ts INTEGER DEFAULT 0")
-except Exception:
-    pass
-try:
-    cur.execute("""
-        UPDATE slavery
-        SET share_bp=6000
-        WHERE share_bp=2000
-          AND slave_id IN (
-              SELECT slave_id
-              FROM slavery
-              GROUP BY slave_id
-              HAVING COUNT(*)=1
-          )
+def _db_lock_for_tx() -> None:
+    """
+    Берёт DB_LOCK для db_tx так, чтобы на conn не было чужой открытой транзакции: иначе блок
+    закоммитил бы (или откатил) чужие записи. Свою незакоммиченную работу (dirty) или conn,
+    который поток уже держит под DB_LOCK, блок подхватывает — ждать тут некого.
+    """
+    if _db_lock_held() or getattr(_DB_TLS, "dirty", False):
+        DB_LOCK.acquire()
+        return
+    deadline = time.monotonic() + DB_TX_FOREIGN_WAIT_SEC
+    waited = False
+    while True:
+        DB_LOCK.acquire()
+        if not conn.in_transaction:
+            return
+        DB_LOCK.release()
+        if not waited:
+            waited = True
+            DB_TX_FOREIGN_STATS["waits"] += 1
+        if time.monotonic() >= deadline:
+            DB_TX_FOREIGN_STATS["timeouts"] += 1
+            raise sqlite3.OperationalError("db_tx: foreign transaction is still open on conn")
+        time.sleep(0.002)
+
+@contextmanager
+def db_tx():
+    """
+    Единица работы: все db_exec/cur.execute/db_commit внутри блока попадают в одну
+    транзакцию на conn и коммитятся один раз на выходе. Исключение => откат всего блока,
+    так что расчёт игры не остаётся применённым наполовину.
+    Вложенный db_tx присоединяется к внешнему. Чужую открытую транзакцию на conn
+    (db_exec без commit в другом потоке) блок не подхватывает, а ждёт её коммита.
+    Сетевые вызовы внутри блока лучше откладывать через db_after_commit.
+    """
+    if _db_in_tx():
+        _DB_TLS.tx_depth += 1
+        try:
+            yield
+        finally:
+            _DB_TLS.tx_depth -= 1
+        return
+
+    hooks: list = []
+    _db_lock_for_tx()
+    try:
+        if not conn.in_transaction:
+            conn.execute("BEGIN")
+        _DB_TLS.tx_depth = 1
+        _DB_TLS.after_commit = hooks
+        try:
+            yield
+            conn.commit()
+        except BaseException:
+            hooks.clear()
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+            raise
+        finally:
+            _DB_TLS.tx_depth = 0
+            _DB_TLS.after_commit = None
+    finally:
+        DB_LOCK.release()
+
+    for fn in hooks:
+        try:
+            fn()
+        except Exception:
+            pass
+
+def db_after_commit(fn) -> None:
+    """Выполнить fn после коммита текущего db_tx (или сразу, если транзакции нет)."""
+    hooks = getattr(_DB_TLS, "after_commit", None) if _db_in_tx() else None
+    if hooks is None:
+        fn()
+        return
+    hooks.append(fn)
+
+# SCHEMA MIGRATIONS
+# Версия схемы хранится в PRAGMA user_version. При старте применяются только шаги
+# с номером больше текущей версии, каждый шаг — в своей транзакции вместе с записью версии.
+# Тёплый рестарт (версия уже последняя) не выполняет ни одного DDL.
+# Любое изменение схемы — только новым шагом в конце MIGRATIONS, старые шаги не трогаем.
+
+def _try_ddl(c: sqlite3.Connection, sql: str) -> None:
+    try:
+        c.execute(sql)
+    except sqlite3.OperationalError:
+        pass  # колонка уже есть (базы, созданные до версионирования)
+
+def _migration_001_base(c: sqlite3.Connection) -> None:
+    """Базовая схема. Идемпотентна: подхватывает и старые базы с user_version=0."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+      user_id INTEGER PRIMARY KEY,
+      username TEXT,
+      short_name TEXT,
+      created_ts INTEGER,
+      contract_ts INTEGER,
+      balance_cents INTEGER DEFAULT 0,          -- текущий капитал в "центах"
+      demo_gift_cents INTEGER DEFAULT 0,        -- стартовые 1000$ (в центах), НЕ участвуют в топе
+      demon INTEGER DEFAULT 0                   -- 1 если демон
+    )
     """)
-    conn.commit()
-except Exception:
-    pass
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS slave_earn_log (
-  slave_id INTEGER,
-  owner_id INTEGER,
-  ts INTEGER,
-  amount_cents INTEGER DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS slave_meta (
-  slave_id INTEGER PRIMARY KEY,
-  buyout_cents INTEGER DEFAULT 0,
-  strikes INTEGER DEFAULT 0,
-  life_uses INTEGER DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS demon_loot (
-  winner_id INTEGER,
-  loser_id INTEGER,
-  slave_id INTEGER,
-  ts INTEGER,
-  taken INTEGER DEFAULT 0,
-  PRIMARY KEY (winner_id, loser_id, slave_id)
-)
-""")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS user_settings (
+      user_id INTEGER PRIMARY KEY,
+      pm_notify INTEGER NOT NULL DEFAULT 1,
+      auto_delete_pm INTEGER NOT NULL DEFAULT 1,
+      settings_msg_id INTEGER NOT NULL DEFAULT 0
+    )
+    """)
 
-try:  # ensure slave_meta has life_uses column
-    cur.execute("ALTER TABLE slave_meta ADD COLUMN life_uses INTEGER DEFAULT 0")
-except Exception:
-    pass
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS pm_bot_messages (
+      chat_id INTEGER NOT NULL,
+      message_id INTEGER NOT NULL,
+      created_ts INTEGER NOT NULL,
+      delete_after_ts INTEGER NOT NULL,
+      deleted INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (chat_id, message_id)
+    )
+    """)
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS buy_offers (
-  offer_id TEXT PRIMARY KEY,
-  slave_id INTEGER,
-  buyer_id INTEGER,
-  price_cents INTEGER,
-  created_ts INTEGER,
-  active INTEGER DEFAULT 1
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS buy_offer_resp (
-  offer_id TEXT,
-  owner_id INTEGER,
-  status INTEGER DEFAULT 0,
-  PRIMARY KEY (offer_id, owner_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS buyrab_offers (
-  offer_id TEXT PRIMARY KEY,
-  tx_no INTEGER,
-  slave_id INTEGER,
-  buyer_id INTEGER,
-  total_cents INTEGER,
-  hold_cents INTEGER DEFAULT 0,
-  created_ts INTEGER,
-  state INTEGER DEFAULT 0        -- 0 draft, 1 pending, 2 done, -1 cancelled
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS buyrab_offer_resp (
-  offer_id TEXT,
-  owner_id INTEGER,
-  pay_cents INTEGER DEFAULT 0,
-  status INTEGER DEFAULT 0,      -- 0 pending, 1 accepted, -1 declined
-  PRIMARY KEY (offer_id, owner_id)
-)
-""")
-
-# WORK
-cur.execute("""
-CREATE TABLE IF NOT EXISTS work_stats (
-  user_id INTEGER,
-  job_key TEXT,
-  shifts INTEGER DEFAULT 0,        -- сколько раз ходил на эту работу
-  days INTEGER DEFAULT 0,          -- стаж по этой работе (1 смена = 1 день стажа)
-  earned_cents INTEGER DEFAULT 0,  -- всего заработано на этой работе
-  PRIMARY KEY (user_id, job_key)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS work_shift (
-  user_id INTEGER PRIMARY KEY,
-  job_key TEXT,
-  started_ts INTEGER,
-  ends_ts INTEGER,
-  salary_full_cents INTEGER DEFAULT 0,   -- рассчитанная "полная" зарплата (со стажем)
-  success_pct INTEGER DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS work_history (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER,
-  job_key TEXT,
-  started_ts INTEGER,
-  ends_ts INTEGER,
-  success INTEGER,               -- 1/0
-  paid_cents INTEGER,
-  text TEXT
-)
-""")
-
-# SHOP
-cur.execute("""
-CREATE TABLE IF NOT EXISTS shop_inv (
-    user_id INTEGER NOT NULL,
-    item_key TEXT NOT NULL,
-    qty INTEGER NOT NULL DEFAULT 0,
-    PRIMARY KEY(user_id, item_key)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS shop_active (
-    user_id INTEGER NOT NULL,
-    item_key TEXT NOT NULL,
-    remaining_games INTEGER NOT NULL DEFAULT 0,
-    PRIMARY KEY(user_id, item_key)
-)
-""")
-cur.execute("""
-CREATE TABLE IF NOT EXISTS shop_bind (
-    user_id INTEGER PRIMARY KEY,
-    game_id TEXT NOT NULL,
-    bound_ts INTEGER NOT NULL
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS shop_used (
-    user_id INTEGER NOT NULL,
-    game_id TEXT NOT NULL,
-    item_key TEXT NOT NULL,
-    used_ts INTEGER NOT NULL,
-    PRIMARY KEY (user_id, game_id, item_key)
-)
-""")
+    c.execute("""
+    CREATE INDEX IF NOT EXISTS idx_pm_bot_messages_gc
+    ON pm_bot_messages(deleted, delete_after_ts)
+    """)
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS shop_cooldowns (
-    user_id INTEGER PRIMARY KEY,
-    next_protect_ts INTEGER NOT NULL DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS shop_item_cooldowns (
-    user_id INTEGER NOT NULL,
-    item_key TEXT NOT NULL,
-    next_ts INTEGER NOT NULL DEFAULT 0,
-    PRIMARY KEY (user_id, item_key)
-)
-""")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS reg_state (
+      user_id INTEGER PRIMARY KEY,
+      stage TEXT,           -- 'await_open' | 'await_name' | NULL
+      msg_id INTEGER,       -- id сообщения в ЛС, которое мы редактируем
+      last_ts INTEGER
+    )
+    """)
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS shop_catalog (
-    user_id INTEGER PRIMARY KEY,
-    cycle_start_ts INTEGER NOT NULL,
-    keys_csv TEXT NOT NULL
-)
-""")
-
-# GAMES
-cur.execute("""
-CREATE TABLE IF NOT EXISTS games (
-  game_id TEXT PRIMARY KEY,
-  group_key TEXT,
-  creator_id INTEGER,
-  state TEXT,                    -- 'lobby'|'choose_format'|'playing'|'finished'|'cancelled'
-  stake_cents INTEGER,
-  created_ts INTEGER,
-  reg_ends_ts INTEGER,
-  reg_extended INTEGER DEFAULT 0,
-  roulette_format TEXT,          -- '1x3'|'3x3'|'3x5'
-  turn_index INTEGER DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS game_players (
-  game_id TEXT,
-  user_id INTEGER,
-  status TEXT,          -- 'pending'|'ready'|'anon_pending'
-  PRIMARY KEY (game_id, user_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS turn_orders (
-  game_id TEXT PRIMARY KEY,
-  order_csv TEXT NOT NULL,
-  round INTEGER NOT NULL DEFAULT 0,
-  updated_ts INTEGER NOT NULL DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS game_results (
-  game_id TEXT,
-  user_id INTEGER,
-  delta_cents INTEGER DEFAULT 0,
-  finished INTEGER DEFAULT 0,
-  PRIMARY KEY (game_id, user_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS continue_tokens (
-  group_key TEXT,
-  user_id INTEGER,
-  token TEXT,
-  ts INTEGER,
-  PRIMARY KEY (group_key, user_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS spins (
-  game_id TEXT,
-  user_id INTEGER,
-  stage TEXT,              -- 'ready'|'spinning'|'done'
-  msg_chat_id INTEGER,
-  msg_id INTEGER,
-  inline_id TEXT,
-  grid_text TEXT,          -- текущий вид слотов
-  started_ts INTEGER,
-  PRIMARY KEY (game_id, user_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS zero_bets (
-  game_id TEXT,
-  user_id INTEGER,
-  slot INTEGER,        -- 0..4 по порядку выбора
-  code TEXT,           -- N1..N36 | Z | E|O|R|B
-  PRIMARY KEY (game_id, user_id, slot)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS zero_lock (
-  game_id TEXT,
-  user_id INTEGER,
-  locked INTEGER DEFAULT 0,
-  PRIMARY KEY (game_id, user_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS zero_state (
-  game_id TEXT PRIMARY KEY,
-  stage TEXT DEFAULT 'betting',     -- betting|reveal|done
-  revealed INTEGER DEFAULT 0,       -- 0..5
-  gen_csv TEXT DEFAULT '',
-  gen_ts INTEGER DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS zero_outcomes (
-  game_id TEXT,
-  user_id INTEGER,
-  combo TEXT DEFAULT '',
-  mult REAL DEFAULT 1.0,
-  PRIMARY KEY (game_id, user_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS rematch_votes (
-  game_id TEXT,
-  user_id INTEGER,
-  vote TEXT,          -- 'yes'|'no'
-  PRIMARY KEY (game_id, user_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS life_wait (
-  game_id TEXT,
-  user_id INTEGER,
-  stake_cents INTEGER,
-  PRIMARY KEY (game_id, user_id)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS demon_streak (
-  user_id INTEGER PRIMARY KEY,
-  streak INTEGER DEFAULT 0,
-  best INTEGER DEFAULT 0,
-  updated_ts INTEGER DEFAULT 0
-)
-""")
-
-# ПРОЧЕЕ 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS credit_loans (
-  user_id INTEGER PRIMARY KEY,
-  contract_code INTEGER NOT NULL,
-  principal_cents INTEGER NOT NULL,
-  term_days INTEGER NOT NULL,
-  rate_pct INTEGER NOT NULL,
-  created_ts INTEGER NOT NULL,
-  status TEXT DEFAULT 'active'
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS transfers (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  from_id INTEGER NOT NULL,
-  to_id INTEGER NOT NULL,
-  amount_cents INTEGER NOT NULL,
-  fee_cents INTEGER DEFAULT 0,
-  ts INTEGER NOT NULL,
-  comment TEXT,
-  chat_id INTEGER DEFAULT 0,
-  msg_id INTEGER DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS known_group_chats (
-  chat_id INTEGER PRIMARY KEY,
-  title TEXT DEFAULT '',
-  added_ts INTEGER NOT NULL DEFAULT 0,
-  last_seen_ts INTEGER NOT NULL DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS transfer_blocks (
-  user_id INTEGER PRIMARY KEY,
-  until_ts INTEGER NOT NULL,
-  reason TEXT,
-  created_ts INTEGER NOT NULL,
-  first_notice_ts INTEGER NOT NULL DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS transfer_block_log (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  action TEXT NOT NULL,             -- 'block'|'manual_unblock'
-  user_id INTEGER NOT NULL,
-  until_ts INTEGER NOT NULL,
-  reason TEXT,
-  created_ts INTEGER NOT NULL,
-  from_id INTEGER DEFAULT 0,
-  to_id INTEGER DEFAULT 0,
-  amount_cents INTEGER DEFAULT 0,
-  c0 INTEGER DEFAULT 0,
-  c100k INTEGER DEFAULT 0,
-  c1m INTEGER DEFAULT 0,
-  chat_id INTEGER DEFAULT 0,
-  msg_id INTEGER DEFAULT 0
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS user_custom_status (
-  user_id INTEGER NOT NULL,
-  status TEXT NOT NULL,
-  added_ts INTEGER NOT NULL DEFAULT 0,
-  PRIMARY KEY (user_id, status)
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS bans (
-  user_id INTEGER PRIMARY KEY,
-  banned INTEGER NOT NULL DEFAULT 1,
-  ts INTEGER NOT NULL,
-  until_ts INTEGER NOT NULL DEFAULT 0,
-  by_id INTEGER DEFAULT 0,
-  reason TEXT
-)
-""")
-try:
-    cur.execute("ALTER TABLE bans ADD COLUMN until_ts INTEGER NOT NULL DEFAULT 0")
-except Exception:
-    pass
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_mail (
+      user_id INTEGER PRIMARY KEY,
+      next_ts INTEGER NOT NULL,
+      intro_sent INTEGER DEFAULT 0,
+      stopped INTEGER DEFAULT 0,
+      pending_amt_cents INTEGER DEFAULT 0,
+      pending_kind TEXT,
+      pending_msg_id INTEGER DEFAULT 0
+    )
+    """)
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS report_state (
-  user_id INTEGER PRIMARY KEY,
-  category TEXT NOT NULL,
-  stage TEXT NOT NULL,
-  created_ts INTEGER NOT NULL
-)
-""")
-
-cur.execute("""
-CREATE TABLE IF NOT EXISTS pm_trade_state (
-  user_id INTEGER PRIMARY KEY,
-  action TEXT NOT NULL,
-  payload TEXT NOT NULL DEFAULT '',
-  stage TEXT NOT NULL DEFAULT 'ready',
-  created_ts INTEGER NOT NULL DEFAULT 0
-)
-""")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS enslave_risk (
+      user_id INTEGER PRIMARY KEY,
+      chance_pct INTEGER NOT NULL DEFAULT 10
+    )
+    """)
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS bot_admins (
-  user_id INTEGER PRIMARY KEY,
-  added_ts INTEGER NOT NULL DEFAULT 0,
-  added_by INTEGER NOT NULL DEFAULT 0
-)
-""")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS game_stats (
+      user_id INTEGER PRIMARY KEY,
+      games_total INTEGER DEFAULT 0,
+      wins INTEGER DEFAULT 0,
+      losses INTEGER DEFAULT 0,
+      max_win_cents INTEGER DEFAULT 0,
+      max_lose_cents INTEGER DEFAULT 0
+    )
+    """)
 
-cur.execute("""
-CREATE TABLE IF NOT EXISTS bot_state (
-  key TEXT PRIMARY KEY,
-  value TEXT NOT NULL DEFAULT '',
-  updated_ts INTEGER NOT NULL DEFAULT 0
-)
-""")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS game_type_stats (
+      user_id INTEGER,
+      game_type TEXT,
+      cnt INTEGER DEFAULT 0,
+      PRIMARY KEY (user_id, game_type)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS slavery (
+      slave_id INTEGER,
+      owner_id INTEGER,
+      share_bp INTEGER DEFAULT 6000,  -- доля в базисных пунктах (1000=10%)
+      PRIMARY KEY (slave_id, owner_id)
+    )
+    """)
+
+    #SLAVERY EXTENSIONS / BUY OFFERS
+    try:
+        c.execute("ALTER TABLE slavery ADD COLUMN earned_cents INTEGER DEFAULT 0")
+    except Exception:
+        pass
+    try:
+        c.execute("ALTER TABLE slavery ADD COLUMN acquired_ts INTEGER DEFAULT 0")
+    except Exception:
+        pass
+    try:
+        c.execute("""
+            UPDATE slavery
+            SET share_bp=6000
+            WHERE share_bp=2000
+              AND slave_id IN (
+                  SELECT slave_id
+                  FROM slavery
+                  GROUP BY slave_id
+                  HAVING COUNT(*)=1
+              )
+        """)
+    except Exception:
+        pass
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS slave_earn_log (
+      slave_id INTEGER,
+      owner_id INTEGER,
+      ts INTEGER,
+      amount_cents INTEGER DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS slave_meta (
+      slave_id INTEGER PRIMARY KEY,
+      buyout_cents INTEGER DEFAULT 0,
+      strikes INTEGER DEFAULT 0,
+      life_uses INTEGER DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS demon_loot (
+      winner_id INTEGER,
+      loser_id INTEGER,
+      slave_id INTEGER,
+      ts INTEGER,
+      taken INTEGER DEFAULT 0,
+      PRIMARY KEY (winner_id, loser_id, slave_id)
+    )
+    """)
+
+    try:  # ensure slave_meta has life_uses column
+        c.execute("ALTER TABLE slave_meta ADD COLUMN life_uses INTEGER DEFAULT 0")
+    except Exception:
+        pass
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS buy_offers (
+      offer_id TEXT PRIMARY KEY,
+      slave_id INTEGER,
+      buyer_id INTEGER,
+      price_cents INTEGER,
+      created_ts INTEGER,
+      active INTEGER DEFAULT 1
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS buy_offer_resp (
+      offer_id TEXT,
+      owner_id INTEGER,
+      status INTEGER DEFAULT 0,
+      PRIMARY KEY (offer_id, owner_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS buyrab_offers (
+      offer_id TEXT PRIMARY KEY,
+      tx_no INTEGER,
+      slave_id INTEGER,
+      buyer_id INTEGER,
+      total_cents INTEGER,
+      hold_cents INTEGER DEFAULT 0,
+      created_ts INTEGER,
+      state INTEGER DEFAULT 0        -- 0 draft, 1 pending, 2 done, -1 cancelled
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS buyrab_offer_resp (
+      offer_id TEXT,
+      owner_id INTEGER,
+      pay_cents INTEGER DEFAULT 0,
+      status INTEGER DEFAULT 0,      -- 0 pending, 1 accepted, -1 declined
+      PRIMARY KEY (offer_id, owner_id)
+    )
+    """)
+
+    # WORK
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS work_stats (
+      user_id INTEGER,
+      job_key TEXT,
+      shifts INTEGER DEFAULT 0,        -- сколько раз ходил на эту работу
+      days INTEGER DEFAULT 0,          -- стаж по этой работе (1 смена = 1 день стажа)
+      earned_cents INTEGER DEFAULT 0,  -- всего заработано на этой работе
+      PRIMARY KEY (user_id, job_key)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS work_shift (
+      user_id INTEGER PRIMARY KEY,
+      job_key TEXT,
+      started_ts INTEGER,
+      ends_ts INTEGER,
+      salary_full_cents INTEGER DEFAULT 0,   -- рассчитанная "полная" зарплата (со стажем)
+      success_pct INTEGER DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS work_history (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER,
+      job_key TEXT,
+      started_ts INTEGER,
+      ends_ts INTEGER,
+      success INTEGER,               -- 1/0
+      paid_cents INTEGER,
+      text TEXT
+    )
+    """)
+
+    # SHOP
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shop_inv (
+        user_id INTEGER NOT NULL,
+        item_key TEXT NOT NULL,
+        qty INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(user_id, item_key)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shop_active (
+        user_id INTEGER NOT NULL,
+        item_key TEXT NOT NULL,
+        remaining_games INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(user_id, item_key)
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shop_bind (
+        user_id INTEGER PRIMARY KEY,
+        game_id TEXT NOT NULL,
+        bound_ts INTEGER NOT NULL
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shop_used (
+        user_id INTEGER NOT NULL,
+        game_id TEXT NOT NULL,
+        item_key TEXT NOT NULL,
+        used_ts INTEGER NOT NULL,
+        PRIMARY KEY (user_id, game_id, item_key)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shop_cooldowns (
+        user_id INTEGER PRIMARY KEY,
+        next_protect_ts INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shop_item_cooldowns (
+        user_id INTEGER NOT NULL,
+        item_key TEXT NOT NULL,
+        next_ts INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, item_key)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS shop_catalog (
+        user_id INTEGER PRIMARY KEY,
+        cycle_start_ts INTEGER NOT NULL,
+        keys_csv TEXT NOT NULL
+    )
+    """)
+
+    # GAMES
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS games (
+      game_id TEXT PRIMARY KEY,
+      group_key TEXT,
+      creator_id INTEGER,
+      state TEXT,                    -- 'lobby'|'choose_format'|'playing'|'finished'|'cancelled'
+      stake_cents INTEGER,
+      created_ts INTEGER,
+      reg_ends_ts INTEGER,
+      reg_extended INTEGER DEFAULT 0,
+      roulette_format TEXT,          -- '1x3'|'3x3'|'3x5'
+      turn_index INTEGER DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS game_players (
+      game_id TEXT,
+      user_id INTEGER,
+      status TEXT,          -- 'pending'|'ready'|'anon_pending'
+      PRIMARY KEY (game_id, user_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS turn_orders (
+      game_id TEXT PRIMARY KEY,
+      order_csv TEXT NOT NULL,
+      round INTEGER NOT NULL DEFAULT 0,
+      updated_ts INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS game_results (
+      game_id TEXT,
+      user_id INTEGER,
+      delta_cents INTEGER DEFAULT 0,
+      finished INTEGER DEFAULT 0,
+      PRIMARY KEY (game_id, user_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS continue_tokens (
+      group_key TEXT,
+      user_id INTEGER,
+      token TEXT,
+      ts INTEGER,
+      PRIMARY KEY (group_key, user_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS spins (
+      game_id TEXT,
+      user_id INTEGER,
+      stage TEXT,              -- 'ready'|'spinning'|'done'
+      msg_chat_id INTEGER,
+      msg_id INTEGER,
+      inline_id TEXT,
+      grid_text TEXT,          -- текущий вид слотов
+      started_ts INTEGER,
+      PRIMARY KEY (game_id, user_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS zero_bets (
+      game_id TEXT,
+      user_id INTEGER,
+      slot INTEGER,        -- 0..4 по порядку выбора
+      code TEXT,           -- N1..N36 | Z | E|O|R|B
+      PRIMARY KEY (game_id, user_id, slot)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS zero_lock (
+      game_id TEXT,
+      user_id INTEGER,
+      locked INTEGER DEFAULT 0,
+      PRIMARY KEY (game_id, user_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS zero_state (
+      game_id TEXT PRIMARY KEY,
+      stage TEXT DEFAULT 'betting',     -- betting|reveal|done
+      revealed INTEGER DEFAULT 0,       -- 0..5
+      gen_csv TEXT DEFAULT '',
+      gen_ts INTEGER DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS zero_outcomes (
+      game_id TEXT,
+      user_id INTEGER,
+      combo TEXT DEFAULT '',
+      mult REAL DEFAULT 1.0,
+      PRIMARY KEY (game_id, user_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS rematch_votes (
+      game_id TEXT,
+      user_id INTEGER,
+      vote TEXT,          -- 'yes'|'no'
+      PRIMARY KEY (game_id, user_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS life_wait (
+      game_id TEXT,
+      user_id INTEGER,
+      stake_cents INTEGER,
+      PRIMARY KEY (game_id, user_id)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS demon_streak (
+      user_id INTEGER PRIMARY KEY,
+      streak INTEGER DEFAULT 0,
+      best INTEGER DEFAULT 0,
+      updated_ts INTEGER DEFAULT 0
+    )
+    """)
+
+    # ПРОЧЕЕ 
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS credit_loans (
+      user_id INTEGER PRIMARY KEY,
+      contract_code INTEGER NOT NULL,
+      principal_cents INTEGER NOT NULL,
+      term_days INTEGER NOT NULL,
+      rate_pct INTEGER NOT NULL,
+      created_ts INTEGER NOT NULL,
+      status TEXT DEFAULT 'active'
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS transfers (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      from_id INTEGER NOT NULL,
+      to_id INTEGER NOT NULL,
+      amount_cents INTEGER NOT NULL,
+      fee_cents INTEGER DEFAULT 0,
+      ts INTEGER NOT NULL,
+      comment TEXT,
+      chat_id INTEGER DEFAULT 0,
+      msg_id INTEGER DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS known_group_chats (
+      chat_id INTEGER PRIMARY KEY,
+      title TEXT DEFAULT '',
+      added_ts INTEGER NOT NULL DEFAULT 0,
+      last_seen_ts INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS transfer_blocks (
+      user_id INTEGER PRIMARY KEY,
+      until_ts INTEGER NOT NULL,
+      reason TEXT,
+      created_ts INTEGER NOT NULL,
+      first_notice_ts INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS transfer_block_log (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      action TEXT NOT NULL,             -- 'block'|'manual_unblock'
+      user_id INTEGER NOT NULL,
+      until_ts INTEGER NOT NULL,
+      reason TEXT,
+      created_ts INTEGER NOT NULL,
+      from_id INTEGER DEFAULT 0,
+      to_id INTEGER DEFAULT 0,
+      amount_cents INTEGER DEFAULT 0,
+      c0 INTEGER DEFAULT 0,
+      c100k INTEGER DEFAULT 0,
+      c1m INTEGER DEFAULT 0,
+      chat_id INTEGER DEFAULT 0,
+      msg_id INTEGER DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS user_custom_status (
+      user_id INTEGER NOT NULL,
+      status TEXT NOT NULL,
+      added_ts INTEGER NOT NULL DEFAULT 0,
+      PRIMARY KEY (user_id, status)
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS bans (
+      user_id INTEGER PRIMARY KEY,
+      banned INTEGER NOT NULL DEFAULT 1,
+      ts INTEGER NOT NULL,
+      until_ts INTEGER NOT NULL DEFAULT 0,
+      by_id INTEGER DEFAULT 0,
+      reason TEXT
+    )
+    """)
+    try:
+        c.execute("ALTER TABLE bans ADD COLUMN until_ts INTEGER NOT NULL DEFAULT 0")
+    except Exception:
+        pass
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS report_state (
+      user_id INTEGER PRIMARY KEY,
+      category TEXT NOT NULL,
+      stage TEXT NOT NULL,
+      created_ts INTEGER NOT NULL
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS pm_trade_state (
+      user_id INTEGER PRIMARY KEY,
+      action TEXT NOT NULL,
+      payload TEXT NOT NULL DEFAULT '',
+      stage TEXT NOT NULL DEFAULT 'ready',
+      created_ts INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS bot_admins (
+      user_id INTEGER PRIMARY KEY,
+      added_ts INTEGER NOT NULL DEFAULT 0,
+      added_by INTEGER NOT NULL DEFAULT 0
+    )
+    """)
 
-conn.commit()
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS bot_state (
+      key TEXT PRIMARY KEY,
+      value TEXT NOT NULL DEFAULT '',
+      updated_ts INTEGER NOT NULL DEFAULT 0
+    )
+    """)
 
-def ensure_game_origin_columns():
+    # колонки, которые раньше добавлялись ensure_*_columns() на каждом старте
     for sql in [
         "ALTER TABLE games ADD COLUMN origin_chat_id INTEGER",
         "ALTER TABLE games ADD COLUMN origin_message_id INTEGER",
@@ -1073,84 +2160,277 @@ def ensure_game_origin_columns():
         "ALTER TABLE games ADD COLUMN stake_kind TEXT DEFAULT 'money'",
         "ALTER TABLE games ADD COLUMN life_demon_id INTEGER DEFAULT 0",
         "ALTER TABLE games ADD COLUMN demon_settled INTEGER DEFAULT 0",
-    ]:
-        try:
-            conn.execute(sql)
-        except sqlite3.OperationalError:
-            pass  
-    conn.commit()
-
-ensure_game_origin_columns()
-
-def ensure_credit_columns():
-    cols = [
-        ("next_due_ts", "INTEGER DEFAULT 0"),
-        ("end_ts", "INTEGER DEFAULT 0"),
-        ("payment_cents", "INTEGER DEFAULT 0"),
-        ("remaining_cents", "INTEGER DEFAULT 0"),
-        ("postponed_cents", "INTEGER DEFAULT 0"),
-        ("last_notice_ts", "INTEGER DEFAULT 0"),
-        ("notice_msg_id", "INTEGER DEFAULT 0"),
-    ]
-    for name, typ in cols:
-        try:
-            conn.execute(f"ALTER TABLE credit_loans ADD COLUMN {name} {typ}")
-        except sqlite3.OperationalError:
-            pass
-    conn.commit()
-
-def ensure_transfer_columns():
-    for sql in [
+        "ALTER TABLE credit_loans ADD COLUMN next_due_ts INTEGER DEFAULT 0",
+        "ALTER TABLE credit_loans ADD COLUMN end_ts INTEGER DEFAULT 0",
+        "ALTER TABLE credit_loans ADD COLUMN payment_cents INTEGER DEFAULT 0",
+        "ALTER TABLE credit_loans ADD COLUMN remaining_cents INTEGER DEFAULT 0",
+        "ALTER TABLE credit_loans ADD COLUMN postponed_cents INTEGER DEFAULT 0",
+        "ALTER TABLE credit_loans ADD COLUMN last_notice_ts INTEGER DEFAULT 0",
+        "ALTER TABLE credit_loans ADD COLUMN notice_msg_id INTEGER DEFAULT 0",
         "ALTER TABLE transfers ADD COLUMN fee_cents INTEGER DEFAULT 0",
         "ALTER TABLE transfer_blocks ADD COLUMN first_notice_ts INTEGER NOT NULL DEFAULT 0",
     ]:
-        try:
-            conn.execute(sql)
-        except sqlite3.OperationalError:
-            pass
+        _try_ddl(c, sql)
 
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS transfer_blocks (
+def _migration_002_hot_indexes(c: sqlite3.Connection) -> None:
+    """Индексы под горячие выборки (см. HOT_QUERY_PLANS)."""
+    for sql in [
+        "CREATE INDEX IF NOT EXISTS idx_game_players_user ON game_players(user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_slavery_owner ON slavery(owner_id)",
+        "CREATE INDEX IF NOT EXISTS idx_slave_earn_log_pair_ts ON slave_earn_log(slave_id, owner_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_work_shift_ends ON work_shift(ends_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_transfers_pair_ts ON transfers(from_id, to_id, ts)",
+        "CREATE INDEX IF NOT EXISTS idx_games_state_created ON games(state, created_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)",
+        "CREATE INDEX IF NOT EXISTS idx_users_demon ON users(demon)",
+    ]:
+        c.execute(sql)
+
+def _migration_003_archive_rollups(c: sqlite3.Connection) -> None:
+    """Свёртки для истории, которая уходит в архив (см. ARCHIVE)."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS slave_earn_rollup (
+      slave_id INTEGER,
+      owner_id INTEGER,
+      cnt INTEGER DEFAULT 0,
+      total_cents INTEGER DEFAULT 0,
+      last_ts INTEGER DEFAULT 0,
+      last_amount_cents INTEGER DEFAULT 0,
+      PRIMARY KEY (slave_id, owner_id)
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS work_history_rollup (
       user_id INTEGER PRIMARY KEY,
-      until_ts INTEGER NOT NULL,
-      reason TEXT,
-      created_ts INTEGER NOT NULL,
-      first_notice_ts INTEGER NOT NULL DEFAULT 0
+      shifts INTEGER DEFAULT 0,
+      paid_cents INTEGER DEFAULT 0,
+      last_ts INTEGER DEFAULT 0
     )
     """)
-
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS transfer_block_log (
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      action TEXT NOT NULL,             -- 'block'|'manual_block'|'manual_unblock'
-      user_id INTEGER NOT NULL,
-      until_ts INTEGER NOT NULL,
-      reason TEXT,
-      created_ts INTEGER NOT NULL,
-      from_id INTEGER DEFAULT 0,
-      to_id INTEGER DEFAULT 0,
-      amount_cents INTEGER DEFAULT 0,
-      c0 INTEGER DEFAULT 0,
-      c100k INTEGER DEFAULT 0,
-      c1m INTEGER DEFAULT 0,
-      chat_id INTEGER DEFAULT 0,
-      msg_id INTEGER DEFAULT 0
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS archived_status (
+      user_id INTEGER,
+      status TEXT,
+      game_id TEXT,
+      ts INTEGER DEFAULT 0,
+      PRIMARY KEY (user_id, status)
     )
     """)
-    conn.commit()
 
-ensure_transfer_columns()
+def _migration_004_user_achievements(c: sqlite3.Connection) -> None:
+    """
+    Липкие статусы-достижения: archived_status становится user_achievements и пополняется
+    уже при завершении игры, а не только из архива. Бэкфилл "Ломаного рта" из живых игр.
+    """
+    c.execute("ALTER TABLE archived_status RENAME TO user_achievements")
+    c.execute("""
+    INSERT OR IGNORE INTO user_achievements (user_id, status, game_id, ts)
+    SELECT gr.user_id, 'Ломаный рот этой рулетки', g.game_id, COALESCE(g.created_ts,0)
+    FROM games g
+    JOIN game_results gr ON gr.game_id=g.game_id
+    WHERE g.game_type='cross'
+      AND g.state='finished'
+      AND COALESCE(g.cross_round,0) >= 9
+      AND COALESCE(gr.delta_cents,0) <= -100000000
+    """)
 
-def ensure_shop_cooldowns():
-    conn.execute("""
-    CREATE TABLE IF NOT EXISTS shop_cooldowns (
-      user_id INTEGER PRIMARY KEY,
-      next_protect_ts INTEGER NOT NULL DEFAULT 0
+# Пересчёт строки owner_stats по одному владельцу: дёшево (idx_slavery_owner), и не зависит
+# от того, каким ON CONFLICT вставляли в slavery (REPLACE не вызывает DELETE-триггер).
+_OWNER_STATS_RESYNC = """
+    DELETE FROM owner_stats WHERE owner_id={o};
+    INSERT INTO owner_stats (owner_id, slaves_cnt, earned_cents)
+    SELECT {o}, COUNT(*), COALESCE(SUM(COALESCE(earned_cents,0)),0)
+    FROM slavery WHERE owner_id={o}
+    HAVING COUNT(*) > 0;
+"""
+
+def _migration_005_owner_stats(c: sqlite3.Connection) -> None:
+    """
+    Материализованный рейтинг рабовладельцев. Поддерживается триггерами на slavery, так что его
+    держат в актуальном виде все пути: slavery_add_owner, remove_owner_from_slave, free_slave_fully,
+    выкупы/buyrab, apply_slave_cut, /del и wipe — в той же транзакции, что и сама запись.
+    """
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS owner_stats (
+      owner_id INTEGER PRIMARY KEY,
+      slaves_cnt INTEGER NOT NULL DEFAULT 0,
+      earned_cents INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_owner_stats_rank ON owner_stats(slaves_cnt DESC, earned_cents DESC, owner_id)")
+    c.execute("DELETE FROM owner_stats")
+    c.execute("""
+    INSERT INTO owner_stats (owner_id, slaves_cnt, earned_cents)
+    SELECT owner_id, COUNT(*), COALESCE(SUM(COALESCE(earned_cents,0)),0)
+    FROM slavery
+    GROUP BY owner_id
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_slavery_ins_owner_stats AFTER INSERT ON slavery
+    BEGIN {_OWNER_STATS_RESYNC.format(o="NEW.owner_id")} END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_slavery_del_owner_stats AFTER DELETE ON slavery
+    BEGIN {_OWNER_STATS_RESYNC.format(o="OLD.owner_id")} END
+    """)
+    # горячий путь (apply_slave_cut) — только дельта дохода
+    c.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_slavery_earn_owner_stats AFTER UPDATE OF earned_cents ON slavery
+    WHEN NEW.owner_id = OLD.owner_id
+    BEGIN
+        UPDATE owner_stats
+        SET earned_cents = earned_cents + COALESCE(NEW.earned_cents,0) - COALESCE(OLD.earned_cents,0)
+        WHERE owner_id = NEW.owner_id;
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_slavery_move_owner_stats AFTER UPDATE OF owner_id ON slavery
+    WHEN NEW.owner_id <> OLD.owner_id
+    BEGIN {_OWNER_STATS_RESYNC.format(o="OLD.owner_id")} {_OWNER_STATS_RESYNC.format(o="NEW.owner_id")} END
+    """)
+
+def _migration_006_rank_snapshots(c: sqlite3.Connection) -> None:
+    """Снимки денежного топа (см. RANK SNAPSHOTS): одна строка на снимок, данные — сжатый массив."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS rank_snapshots (
+      snap_id INTEGER PRIMARY KEY AUTOINCREMENT,
+      ts INTEGER NOT NULL,
+      users INTEGER NOT NULL DEFAULT 0,
+      packed BLOB NOT NULL
     )
     """)
-    conn.commit()
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rank_snapshots_ts ON rank_snapshots(ts)")
+
+MIGRATIONS = [
+    (1, "base schema", _migration_001_base),
+    (2, "hot lookup indexes", _migration_002_hot_indexes),
+    (3, "archive rollups", _migration_003_archive_rollups),
+    (4, "user achievements", _migration_004_user_achievements),
+    (5, "owner stats", _migration_005_owner_stats),
+    (6, "rank snapshots", _migration_006_rank_snapshots),
+]
+
+def db_schema_version(c: sqlite3.Connection) -> int:
+    r = c.execute("PRAGMA user_version;").fetchone()
+    return int((r[0] if r else 0) or 0)
+
+def run_migrations(c: sqlite3.Connection) -> Tuple[int, int]:
+    """Применяет недостающие шаги. Возвращает (версия_до, версия_после)."""
+    v0 = db_schema_version(c)
+    v = v0
+    for ver, name, fn in MIGRATIONS:
+        if ver <= v:
+            continue
+        try:
+            if c.in_transaction:
+                c.commit()
+            c.execute("BEGIN")
+            fn(c)
+            c.execute(f"PRAGMA user_version={int(ver)};")
+            c.commit()
+        except Exception:
+            try:
+                c.rollback()
+            except Exception:
+                pass
+            print(f"migration {ver} ({name}) failed")
+            raise
+        print(f"migration {ver} applied: {name}")
+        v = ver
+    return v0, v
+
+_t_schema = time.perf_counter()
+with DB_LOCK:
+    _schema_v0, _schema_v1 = run_migrations(conn)
+print(f"schema: v{_schema_v0} -> v{_schema_v1}, {(time.perf_counter() - _t_schema) * 1000:.1f} ms")
+
+# Горячие запросы. Текст SQL живёт здесь, места вызова берут его из HOT_SQL — так проверка планов
+# смотрит ровно на то, что выполняется. По каждому EXPLAIN QUERY PLAN не должен показывать SCAN
+# (полный обход таблицы или индекса); исключения — только в HOT_QUERY_PLAN_SCAN_OK с причиной.
+# Проверяется при старте, командой /dbplan и тестом tests/test_query_plans.py.
+HOT_SQL: Dict[str, str] = {
+    "shop_get_earliest_active_game":
+        "SELECT g.game_id, g.state, g.created_ts FROM games g JOIN game_players gp ON gp.game_id=g.game_id "
+        "WHERE gp.user_id=? AND g.state NOT IN ('finished','cancelled') ORDER BY g.created_ts ASC",
+    "refresh_lobbies_for_user":
+        "SELECT gp.game_id FROM game_players gp JOIN games g ON g.game_id = gp.game_id "
+        "WHERE gp.user_id=? AND g.state='lobby'",
+    "owns_slaves": "SELECT 1 FROM slavery WHERE owner_id=? LIMIT 1",
+    "is_slave": "SELECT 1 FROM slavery WHERE slave_id=? LIMIT 1",
+    "slave_profit_lasth":
+        "SELECT COALESCE(SUM(amount_cents),0) FROM slave_earn_log WHERE slave_id=? AND owner_id=? AND ts>=?",
+    "slave_last_credit":
+        "SELECT amount_cents FROM slave_earn_log WHERE slave_id=? AND owner_id=? ORDER BY ts DESC LIMIT 1",
+    "_work_daemon": "SELECT user_id FROM work_shift WHERE ends_ts <= ?",
+    "transfer_balance:antifraud":
+        "SELECT COALESCE(SUM(CASE WHEN amount_cents > 0 THEN 1 ELSE 0 END),0), "
+        "COALESCE(SUM(CASE WHEN amount_cents > ? THEN 1 ELSE 0 END),0), "
+        "COALESCE(SUM(CASE WHEN amount_cents > ? THEN 1 ELSE 0 END),0) "
+        "FROM transfers WHERE from_id=? AND to_id=? AND ts>=?",
+    "archive:games":
+        "SELECT rowid,{cols} FROM games "
+        "WHERE state IN ('finished','cancelled') AND created_ts < ? ORDER BY created_ts LIMIT ?",
+    "user_id_by_username": "SELECT user_id FROM users WHERE username=? COLLATE NOCASE",
+    "user_by_username": "SELECT user_id, short_name, username FROM users WHERE username=? COLLATE NOCASE",
+    "random_demon": "SELECT user_id FROM users WHERE demon=1 ORDER BY RANDOM() LIMIT 1",
+    "stats:owners":
+        "SELECT owner_id, slaves_cnt, earned_cents FROM owner_stats WHERE slaves_cnt > 0 "
+        "ORDER BY slaves_cnt DESC, earned_cents DESC, owner_id",
+}
+
+# Пробные параметры для EXPLAIN; {cols} подставляется минимальным списком столбцов.
+HOT_QUERY_PLANS: List[Tuple[str, str, tuple]] = [
+    ("shop_get_earliest_active_game", HOT_SQL["shop_get_earliest_active_game"], (0,)),
+    ("refresh_lobbies_for_user", HOT_SQL["refresh_lobbies_for_user"], (0,)),
+    ("owns_slaves", HOT_SQL["owns_slaves"], (0,)),
+    ("is_slave", HOT_SQL["is_slave"], (0,)),
+    ("slave_profit_lasth", HOT_SQL["slave_profit_lasth"], (0, 0, 0)),
+    ("slave_last_credit", HOT_SQL["slave_last_credit"], (0, 0)),
+    ("_work_daemon", HOT_SQL["_work_daemon"], (0,)),
+    ("transfer_balance:antifraud", HOT_SQL["transfer_balance:antifraud"], (0, 0, 0, 0, 0)),
+    ("archive:games", HOT_SQL["archive:games"].format(cols="game_id"), (0, 1)),
+    ("user_id_by_username", HOT_SQL["user_id_by_username"], ("",)),
+    ("user_by_username", HOT_SQL["user_by_username"], ("",)),
+    ("random_demon", HOT_SQL["random_demon"], ()),
+    ("stats:owners", HOT_SQL["stats:owners"] + " LIMIT ?", (20,)),
+]
+
+# SCAN, который допустим осознанно: имя запроса -> почему.
+HOT_QUERY_PLAN_SCAN_OK: Dict[str, str] = {
+    "stats:owners": "обход idx_owner_stats_rank в порядке сортировки, останавливается на LIMIT",
+}
+
+def query_plan_regressions(c: sqlite3.Connection) -> List[Tuple[str, str]]:
+    """[(имя_запроса, строка_плана)] для горячих запросов с SCAN не из списка исключений."""
+    bad: List[Tuple[str, str]] = []
+    for name, sql, params in HOT_QUERY_PLANS:
+        try:
+            rows = c.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        except Exception as e:
+            bad.append((name, f"error: {e}"))
+            continue
+        if name in HOT_QUERY_PLAN_SCAN_OK:
+            continue
+        for r in rows:
+            detail = str(r[-1] or "")
+            if detail.startswith("SCAN "):
+                bad.append((name, detail))
+    return bad
+
+def hot_query_plan_regressions() -> List[Tuple[str, str]]:
+    """То же на рабочей базе."""
+    # Отдельное соединение: закэшированный EXPLAIN не перепланируется после DROP/CREATE INDEX.
+    c = DB_READ_POOL._open()
+    try:
+        return query_plan_regressions(c)
+    finally:
+        try:
+            c.close()
+        except Exception:
+            pass
 
-ensure_shop_cooldowns()
+for _name, _detail in hot_query_plan_regressions():
+    print(f"query plan regression: {_name}: {_detail}")
 
 # Runtime DB: безопасный "cur" 
 # До этого места "cur" был реальным sqlite3.Cursor и использовался для миграций/DDL.
@@ -1171,15 +2451,40 @@ class CurProxy:
     При этом:
     - SELECT/PRAGMA/WITH/EXPLAIN -> буферизуем результаты через db_all
     - INSERT/UPDATE/DELETE/...   -> выполняем через db_exec(commit=True) и выставляем rowcount
+    - cur.stream(sql, params)    -> SELECT без буфера: строки идут кусками через db_iter,
+                                    читать fetchone/fetchmany/fetchall или `for row in cur.stream(...)`
     """
     def __init__(self):
         self._local = threading.local()
         self.rowcount = 0
 
+    def _drop_stream(self):
+        it = getattr(self._local, "it", None)
+        if it is not None:
+            self._local.it = None
+            try:
+                it.close()
+            except Exception:
+                pass
+
     def _set_rows(self, rows):
+        self._drop_stream()
         self._local.rows = rows or []
         self._local.idx = 0
 
+    def stream(self, sql, params=(), chunk: int = DB_STREAM_CHUNK):
+        self._set_rows([])
+        self._local.it = db_iter(sql, params, chunk)
+        self.rowcount = -1
+        return self
+
+    def __iter__(self):
+        it = getattr(self._local, "it", None)
+        if it is not None:
+            self._local.it = None
+            return it
+        return iter(self.fetchall())
+
     def execute(self, sql, params=()):
         s = (sql or "").lstrip().upper()
 
@@ -1202,6 +2507,12 @@ class CurProxy:
         return self
 
     def fetchone(self):
+        it = getattr(self._local, "it", None)
+        if it is not None:
+            r = next(it, None)
+            if r is None:
+                self._local.it = None
+            return r
         rows = getattr(self._local, "rows", [])
         idx = getattr(self._local, "idx", 0)
         if idx >= len(rows):
@@ -1209,7 +2520,27 @@ class CurProxy:
         self._local.idx = idx + 1
         return rows[idx]
 
+    def fetchmany(self, size: int = DB_STREAM_CHUNK):
+        it = getattr(self._local, "it", None)
+        if it is not None:
+            out = []
+            for r in it:
+                out.append(r)
+                if len(out) >= size:
+                    break
+            else:
+                self._local.it = None
+            return out
+        rows = getattr(self._local, "rows", [])
+        idx = getattr(self._local, "idx", 0)
+        self._local.idx = min(len(rows), idx + max(0, int(size)))
+        return rows[idx:self._local.idx]
+
     def fetchall(self):
+        it = getattr(self._local, "it", None)
+        if it is not None:
+            self._local.it = None
+            return list(it)
         rows = getattr(self._local, "rows", [])
         idx = getattr(self._local, "idx", 0)
         if idx <= 0:
@@ -1225,6 +2556,73 @@ def now_ts() -> int:
 
 PM_AUTO_DELETE_SEC = 48 * 3600 # таймер авто-удаления
 
+# Кэш "политик" для пути каждого апдейта: баны, набор админов, user_settings, report/trade state.
+# Ключи — кортежи: ("ban", uid), ("admins",), ("settings", uid), ("report", uid), ("trade", uid).
+# Все записи этих таблиц идут через функции ниже, и каждая сбрасывает свой ключ явно (в транзакции —
+# ещё раз после коммита). Заполнение отбрасывается, если за время чтения был сброс (seq).
+# Бан хранится до min(TTL, until_ts), чтобы истёкший бан снимался тем же путём, что и раньше.
+POLICY_CACHE_TTL_SEC = float(os.environ.get("POLICY_CACHE_TTL_SEC", "300") or 0)
+POLICY_CACHE_MAX = 50000
+
+class PolicyCache:
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = float(ttl)
+        self.max_size = int(max_size)
+        self._d: Dict[tuple, Tuple[object, float]] = {}
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: tuple, load, expires_at=None):
+        """load() — чтение из базы; expires_at(value) -> ts или None — собственный срок значения."""
+        now = time.time()
+        if self.ttl > 0:
+            with self._lock:
+                e = self._d.get(key)
+                if e is not None and e[1] > now:
+                    self.hits += 1
+                    return e[0]
+                seq = self._seq
+        else:
+            seq = None
+        self.misses += 1
+        value = load()
+        if seq is None or _db_read_on_writer():
+            return value
+        exp = now + self.ttl
+        if expires_at is not None:
+            own = expires_at(value)
+            if own:
+                exp = min(exp, float(own))
+        with self._lock:
+            if seq == self._seq:
+                if len(self._d) >= self.max_size:
+                    self._d.clear()
+                self._d[key] = (value, exp)
+        return value
+
+    def invalidate(self, key: tuple) -> None:
+        with self._lock:
+            self._seq += 1
+            self.invalidations += 1
+            self._d.pop(key, None)
+        if _db_in_tx():
+            db_after_commit(lambda: self.invalidate(key))
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._d),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_pct": round(100.0 * self.hits / total, 1) if total else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+POLICY_CACHE = PolicyCache(POLICY_CACHE_TTL_SEC, POLICY_CACHE_MAX)
+
 def ensure_user_settings(uid: int):
     db_exec(
         "INSERT OR IGNORE INTO user_settings (user_id, pm_notify, auto_delete_pm, settings_msg_id) VALUES (?,?,?,?)",
@@ -1233,25 +2631,21 @@ def ensure_user_settings(uid: int):
     )
 
 def _user_settings_row(uid: int) -> Tuple[int, int, int]:
-    row = db_one(
-        "SELECT pm_notify, auto_delete_pm, settings_msg_id FROM user_settings WHERE user_id=?",
-        (int(uid),)
-    )
-    if not row:
-        return (1, 1, 0)
-    return (int(row[0] or 0), int(row[1] or 0), int(row[2] or 0))
+    def load():
+        row = db_one(
+            "SELECT pm_notify, auto_delete_pm, settings_msg_id FROM user_settings WHERE user_id=?",
+            (int(uid),)
+        )
+        if not row:
+            return (1, 1, 0)
+        return (int(row[0] or 0), int(row[1] or 0), int(row[2] or 0))
+    return POLICY_CACHE.get(("settings", int(uid)), load)
 
 def user_pm_notifications_enabled(uid: int) -> bool:
-    row = db_one("SELECT pm_notify FROM user_settings WHERE user_id=?", (int(uid),))
-    if not row:
-        return True
-    return bool(int(row[0] or 0))
+    return bool(_user_settings_row(uid)[0])
 
 def user_auto_delete_pm_enabled(uid: int) -> bool:
-    row = db_one("SELECT auto_delete_pm FROM user_settings WHERE user_id=?", (int(uid),))
-    if not row:
-        return True
-    return bool(int(row[0] or 0))
+    return bool(_user_settings_row(uid)[1])
 
 def set_user_pm_notify(uid: int, enabled: bool):
     ensure_user_settings(uid)
@@ -1260,6 +2654,7 @@ def set_user_pm_notify(uid: int, enabled: bool):
         (1 if enabled else 0, int(uid)),
         commit=True
     )
+    POLICY_CACHE.invalidate(("settings", int(uid)))
 
 def set_user_auto_delete_pm(uid: int, enabled: bool):
     ensure_user_settings(uid)
@@ -1268,10 +2663,10 @@ def set_user_auto_delete_pm(uid: int, enabled: bool):
         (1 if enabled else 0, int(uid)),
         commit=True
     )
+    POLICY_CACHE.invalidate(("settings", int(uid)))
 
 def get_settings_msg_id(uid: int) -> int:
-    row = db_one("SELECT settings_msg_id FROM user_settings WHERE user_id=?", (int(uid),))
-    return int((row[0] if row else 0) or 0)
+    return int(_user_settings_row(uid)[2])
 
 def set_settings_msg_id(uid: int, msg_id: int):
     ensure_user_settings(uid)
@@ -1280,6 +2675,7 @@ def set_settings_msg_id(uid: int, msg_id: int):
         (int(msg_id or 0), int(uid)),
         commit=True
     )
+    POLICY_CACHE.invalidate(("settings", int(uid)))
 
 def _settings_onoff(v: bool) -> str:
     return "✅" if v else "❌"
@@ -1353,10 +2749,10 @@ def _track_private_bot_message(sent_msg):
         if chat_id <= 0 or msg_id <= 0:
             return
 
-        db_exec(
+        # ответ не нужен: не ждём коммита, запись уйдёт в ближайшей пачке писателя
+        db_submit(
             "INSERT OR REPLACE INTO pm_bot_messages (chat_id, message_id, created_ts, delete_after_ts, deleted) VALUES (?,?,?,?,0)",
-            (chat_id, msg_id, now_ts(), now_ts() + PM_AUTO_DELETE_SEC),
-            commit=True
+            (chat_id, msg_id, now_ts(), now_ts() + PM_AUTO_DELETE_SEC)
         )
     except Exception:
         pass
@@ -1448,21 +2844,89 @@ def safe_format(template: str, **kwargs) -> str:
             return "{" + key + "}"
     return template.format_map(DD(**kwargs))
 
-def remember_group_chat(chat_id: int, title: str = "") -> None:
-    chat_id = int(chat_id or 0)
-    if chat_id >= 0:
-        return
-
+# Групповые чаты видны на каждом сообщении/колбэке, поэтому last_seen_ts копится в памяти и
+# пишется пачкой раз в GROUP_SEEN_FLUSH_SEC. Сразу пишется только первый раз за процесс
+# (новый чат должен попасть в рассылки) и смена названия. Flush делает UPDATE, а не upsert:
+# чат, удалённый forget_group_chat, не воскреснет.
+GROUP_SEEN_FLUSH_SEC = max(1, int(os.environ.get("GROUP_SEEN_FLUSH_SEC", "30") or 30))
+_GROUP_SEEN_LOCK = threading.Lock()
+_GROUP_TITLES: Dict[int, str] = {}          # чаты, уже записанные этим процессом -> название
+_GROUP_SEEN_PENDING: Dict[int, int] = {}    # chat_id -> last_seen_ts, ещё не в базе
+GROUP_SEEN_STATS = {"calls": 0, "writes": 0, "flushes": 0, "flushed_rows": 0}
+
+def _write_group_chat(chat_id: int, title: str, ts: int) -> None:
     db_exec(
         "INSERT INTO known_group_chats (chat_id, title, added_ts, last_seen_ts) VALUES (?,?,?,?) "
         "ON CONFLICT(chat_id) DO UPDATE SET "
         "title=CASE WHEN excluded.title<>'' THEN excluded.title ELSE known_group_chats.title END, "
         "last_seen_ts=excluded.last_seen_ts",
-        (chat_id, str(title or "")[:200], now_ts(), now_ts()),
+        (chat_id, title, ts, ts),
         commit=True
     )
+    GROUP_SEEN_STATS["writes"] += 1
+
+def remember_group_chat(chat_id: int, title: str = "") -> None:
+    chat_id = int(chat_id or 0)
+    if chat_id >= 0:
+        return
+
+    title = str(title or "")[:200]
+    ts = now_ts()
+    GROUP_SEEN_STATS["calls"] += 1
+    with _GROUP_SEEN_LOCK:
+        known = _GROUP_TITLES.get(chat_id)
+        immediate = known is None or (title and title != known)
+        if immediate:
+            _GROUP_TITLES[chat_id] = title or (known or "")
+            _GROUP_SEEN_PENDING.pop(chat_id, None)
+        else:
+            _GROUP_SEEN_PENDING[chat_id] = ts
+    if immediate:
+        try:
+            _write_group_chat(chat_id, title, ts)
+        except Exception:
+            with _GROUP_SEEN_LOCK:
+                _GROUP_TITLES.pop(chat_id, None)  # следующий вызов попробует записать снова
+            raise
+
+def flush_group_chats_seen() -> int:
+    with _GROUP_SEEN_LOCK:
+        if not _GROUP_SEEN_PENDING:
+            return 0
+        batch = sorted(_GROUP_SEEN_PENDING.items())
+        _GROUP_SEEN_PENDING.clear()
+    try:
+        with db_tx():
+            for chat_id, ts in batch:
+                db_exec(
+                    "UPDATE known_group_chats SET last_seen_ts=MAX(COALESCE(last_seen_ts,0), ?) WHERE chat_id=?",
+                    (int(ts), int(chat_id))
+                )
+    except Exception:
+        # вернём в очередь, более свежие отметки не затираем
+        with _GROUP_SEEN_LOCK:
+            for chat_id, ts in batch:
+                if _GROUP_SEEN_PENDING.get(chat_id, 0) < ts:
+                    _GROUP_SEEN_PENDING[chat_id] = ts
+        raise
+    GROUP_SEEN_STATS["flushes"] += 1
+    GROUP_SEEN_STATS["flushed_rows"] += len(batch)
+    return len(batch)
+
+def _group_seen_flush_daemon():
+    while True:
+        time.sleep(GROUP_SEEN_FLUSH_SEC)
+        try:
+            flush_group_chats_seen()
+        except Exception:
+            pass
+
+threading.Thread(target=_group_seen_flush_daemon, daemon=True).start()
 
 def forget_group_chat(chat_id: int) -> None:
+    with _GROUP_SEEN_LOCK:
+        _GROUP_TITLES.pop(int(chat_id), None)
+        _GROUP_SEEN_PENDING.pop(int(chat_id), None)
     db_exec("DELETE FROM known_group_chats WHERE chat_id=?", (int(chat_id),), commit=True)
 
 # BOT ADMINS + MAINTENANCE MODE
@@ -1470,13 +2934,18 @@ def forget_group_chat(chat_id: int) -> None:
 def is_owner(uid: int) -> bool:
     return int(uid) == int(OWNER_ID)
 
+def _bot_admin_ids() -> frozenset:
+    return POLICY_CACHE.get(
+        ("admins",),
+        lambda: frozenset(int(r[0]) for r in (db_all("SELECT user_id FROM bot_admins", ()) or []))
+    )
+
 def is_bot_admin(uid: int) -> bool:
     uid = int(uid or 0)
     if uid == int(OWNER_ID):
         return True
     try:
-        r = db_one("SELECT 1 FROM bot_admins WHERE user_id=? LIMIT 1", (uid,))
-        return bool(r)
+        return uid in _bot_admin_ids()
     except Exception:
         return False
 
@@ -1492,6 +2961,7 @@ def set_bot_admin(uid: int, enabled: bool, by_id: int = 0) -> None:
             (uid, now_ts(), by_id),
             commit=True
         )
+        POLICY_CACHE.invalidate(("admins",))
         # видимый статус
         try:
             add_custom_status(uid, "Бот-админ")
@@ -1499,12 +2969,14 @@ def set_bot_admin(uid: int, enabled: bool, by_id: int = 0) -> None:
             pass
     else:
         db_exec("DELETE FROM bot_admins WHERE user_id=?", (uid,), commit=True)
+        POLICY_CACHE.invalidate(("admins",))
         try:
             db_exec(
                 "DELETE FROM user_custom_status WHERE user_id=? AND status=?",
                 (uid, "Бот-админ"),
                 commit=True
             )
+            status_invalidate(uid)
         except Exception:
             pass
 
@@ -1935,9 +3407,13 @@ def get_ban_info(uid: int) -> Tuple[bool, int, str]:
     until_ts=0 => перманентный бан.
     Если бан истёк — автоматически снимает.
     """
-    r = db_one(
-        "SELECT COALESCE(banned,0), COALESCE(until_ts,0), COALESCE(reason,'') FROM bans WHERE user_id=? LIMIT 1",
-        (int(uid),)
+    r = POLICY_CACHE.get(
+        ("ban", int(uid)),
+        lambda: db_one(
+            "SELECT COALESCE(banned,0), COALESCE(until_ts,0), COALESCE(reason,'') FROM bans WHERE user_id=? LIMIT 1",
+            (int(uid),)
+        ),
+        expires_at=lambda r: (int(r[1] or 0) if r and int(r[0] or 0) == 1 else None)
     )
     if not r:
         return False, 0, ""
@@ -1954,6 +3430,7 @@ def get_ban_info(uid: int) -> Tuple[bool, int, str]:
             db_exec("UPDATE bans SET banned=0, until_ts=0 WHERE user_id=?", (int(uid),), commit=True)
         except Exception:
             pass
+        POLICY_CACHE.invalidate(("ban", int(uid)))
         return False, 0, reason
 
     return True, until_ts, reason
@@ -1978,6 +3455,7 @@ def ban_user(uid: int, by_id: int = 0, reason: str = "", *, duration_sec: int =
         (int(uid), 1, now_ts(), int(until_ts), int(by_id or 0), (reason or "")[:500]),
         commit=True
     )
+    POLICY_CACHE.invalidate(("ban", int(uid)))
     return int(until_ts)
 
 def unban_user(uid: int, by_id: int = 0, reason: str = "") -> None:
@@ -1987,6 +3465,7 @@ def unban_user(uid: int, by_id: int = 0, reason: str = "") -> None:
         (int(uid), 0, now_ts(), 0, int(by_id or 0), (reason or "")[:500]),
         commit=True
     )
+    POLICY_CACHE.invalidate(("ban", int(uid)))
 
 def report_set_state(uid: int, category: str, stage: str) -> None:
     db_exec(
@@ -1995,15 +3474,20 @@ def report_set_state(uid: int, category: str, stage: str) -> None:
         (int(uid), str(category), str(stage), now_ts()),
         commit=True
     )
+    POLICY_CACHE.invalidate(("report", int(uid)))
 
 def report_get_state(uid: int) -> Tuple[Optional[str], Optional[str]]:
-    r = db_one("SELECT stage, category FROM report_state WHERE user_id=?", (int(uid),))
+    r = POLICY_CACHE.get(
+        ("report", int(uid)),
+        lambda: db_one("SELECT stage, category FROM report_state WHERE user_id=?", (int(uid),))
+    )
     if not r:
         return None, None
     return (r[0], r[1])
 
 def report_clear_state(uid: int) -> None:
     db_exec("DELETE FROM report_state WHERE user_id=?", (int(uid),), commit=True)
+    POLICY_CACHE.invalidate(("report", int(uid)))
 
 def trade_state_set(uid: int, action: str, payload: str = "", stage: str = "ready") -> None:
     db_exec(
@@ -2013,11 +3497,15 @@ def trade_state_set(uid: int, action: str, payload: str = "", stage: str = "read
         (int(uid), str(action or ""), str(payload or ""), str(stage or "ready"), now_ts()),
         commit=True
     )
+    POLICY_CACHE.invalidate(("trade", int(uid)))
 
 def trade_state_get(uid: int) -> Tuple[Optional[str], Optional[str], str]:
-    r = db_one(
-        "SELECT action, stage, payload FROM pm_trade_state WHERE user_id=?",
-        (int(uid),)
+    r = POLICY_CACHE.get(
+        ("trade", int(uid)),
+        lambda: db_one(
+            "SELECT action, stage, payload FROM pm_trade_state WHERE user_id=?",
+            (int(uid),)
+        )
     )
     if not r:
         return None, None, ""
@@ -2025,6 +3513,7 @@ def trade_state_get(uid: int) -> Tuple[Optional[str], Optional[str], str]:
 
 def trade_state_clear(uid: int) -> None:
     db_exec("DELETE FROM pm_trade_state WHERE user_id=?", (int(uid),), commit=True)
+    POLICY_CACHE.invalidate(("trade", int(uid)))
 
 def _trade_pack_payload(target_un: str = "", amount_raw: str = "") -> str:
     return f"{(target_un or '').strip()}|{(amount_raw or '').strip()}"
@@ -2278,28 +3767,570 @@ def render_contract_for_user(uid: int) -> Optional[str]:
     head = lines[0]
     tail = "\n".join(lines[1:]).strip()
 
-    if not tail:
-        return head
+    if not tail:
+        return head
+
+    return f"{head}\n\n<blockquote expandable>{tail}</blockquote>"
+
+# Денежный топ: отсортированный список ключей (-(баланс - подарок), user_id) по всем не-демонам.
+# Порядок совпадает со старым sort(key=top_value_cents, reverse=True) по выборке в порядке user_id.
+# top(n) — срез, rank(uid) — bisect, O(log N). Обновляется через touch(uid) из мест, где меняются
+# balance_cents/demo_gift_cents/demon; check() сверяет с полным пересчётом и чинит расхождения
+# (фоном раз в LEADERBOARD_CHECK_SEC), так что пропущенный путь записи не живёт долго.
+# Порядок обновлений держат версии из _LB_VER: пишущий берёт значение и версию внутри своей записи
+# (leaderboard_capture, под DB_LOCK до коммита) и передаёт их в touch; без значения touch берёт
+# версию, дождавшись DB_LOCK, и читает уже с read-пула. Значение со старой версией не перетирает
+# более новое. Полные сканы идут с read-пула без DB_LOCK: что закоммичено после начала скана,
+# видно по версиям и в сверке не участвует.
+LEADERBOARD_CHECK_SEC = max(0, int(os.environ.get("LEADERBOARD_CHECK_SEC", "600") or 0))
+_LB_SQL = "SELECT user_id, COALESCE(balance_cents,0) - COALESCE(demo_gift_cents,0) FROM users WHERE demon=0"
+_LB_VALUE_SQL = "SELECT COALESCE(balance_cents,0) - COALESCE(demo_gift_cents,0), demon FROM users WHERE user_id=?"
+_LB_VER = _itertools.count(1)
+_LB_READ = object()
+
+def _lb_next_ver() -> int:
+    """Версия, старше всех записей, закоммиченных или идущих сейчас под DB_LOCK."""
+    with DB_LOCK:
+        return next(_LB_VER)
+
+def leaderboard_capture(uid: int, c=None) -> Tuple[Optional[int], int]:
+    """(значение для топа или None, версия) — вызывать внутри своей записи, до коммита."""
+    if c is None:
+        r = db_one(_LB_VALUE_SQL, (int(uid),))
+    else:
+        c.execute(_LB_VALUE_SQL, (int(uid),))
+        r = c.fetchone()
+    return (int(r[0] or 0) if (r and int(r[1] or 0) == 0) else None), next(_LB_VER)
+
+class Leaderboard:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys: List[Tuple[int, int]] = []
+        self._val: Dict[int, int] = {}
+        self._ver: Dict[int, int] = {}
+        self._loaded = False
+        self.touches = 0
+        self.rebuilds = 0
+        self.checks = 0
+        self.mismatches = 0
+        self.last_check: dict = {}
+
+    def _load(self) -> Tuple[int, Dict[int, int]]:
+        """(версия начала скана, {uid: значение}) — скан с read-пула без DB_LOCK."""
+        gen0 = _lb_next_ver()
+        val = {int(r[0]): int(r[1] or 0) for r in db_iter(_LB_SQL)}
+        return gen0, val
+
+    def _merge_locked(self, gen0: int, val: Dict[int, int]) -> set:
+        """Переносит в val свежие (после gen0) значения из памяти; возвращает их uid."""
+        fresh = {u for u, v in self._ver.items() if v > gen0}
+        for u in fresh:
+            if u in self._val:
+                val[u] = self._val[u]
+            else:
+                val.pop(u, None)
+        return fresh
+
+    def rebuild(self) -> None:
+        gen0, val = self._load()
+        with self._lock:
+            self._merge_locked(gen0, val)
+            self._keys = sorted((-v, uid) for uid, v in val.items())
+            self._val, self._loaded = val, True
+            self.rebuilds += 1
+
+    def _ensure(self) -> None:
+        if not self._loaded:
+            self.rebuild()
+
+    def _set(self, uid: int, value: Optional[int], ver: int) -> None:
+        """value=None — убрать из топа (демон или пользователя нет). Старая версия игнорируется."""
+        with self._lock:
+            if ver < self._ver.get(uid, 0):
+                return
+            self._ver[uid] = ver
+            old = self._val.pop(uid, None)
+            if old is not None:
+                i = bisect.bisect_left(self._keys, (-old, uid))
+                if i < len(self._keys) and self._keys[i] == (-old, uid):
+                    del self._keys[i]
+            if value is not None:
+                self._val[uid] = value
+                bisect.insort(self._keys, (-value, uid))
+
+    def touch(self, uid: int, value=_LB_READ, ver: Optional[int] = None) -> None:
+        """Обновить uid в топе: значением из leaderboard_capture или перечитав из базы.
+        Внутри db_tx — после коммита."""
+        uid = int(uid)
+        status_invalidate(uid)
+        if not self._loaded:
+            return  # первая загрузка всё равно прочитает свежие данные
+        if _db_in_tx():
+            db_after_commit(lambda: self.touch(uid, value, ver))
+            return
+        if value is _LB_READ or ver is None:
+            ver = _lb_next_ver()
+            r = db_one(_LB_VALUE_SQL, (uid,))
+            value = int(r[0] or 0) if (r and int(r[1] or 0) == 0) else None
+        self._set(uid, value, ver)
+        self.touches += 1
+
+    def add_if_missing(self, uid: int) -> None:
+        if self._loaded and int(uid) not in self._val:
+            self.touch(uid)
+
+    def remove(self, uid: int) -> None:
+        status_invalidate(uid)
+        if self._loaded:
+            self._set(int(uid), None, _lb_next_ver())
+
+    def top(self, n: int) -> List[int]:
+        self._ensure()
+        with self._lock:
+            return [uid for (_v, uid) in self._keys[:max(0, int(n))]]
+
+    def last(self) -> Optional[int]:
+        self._ensure()
+        with self._lock:
+            return self._keys[-1][1] if self._keys else None
+
+    def rank(self, uid: int) -> Optional[int]:
+        """Место в топе (с 1) или None, если uid не участвует (демон/нет в базе)."""
+        self._ensure()
+        uid = int(uid)
+        with self._lock:
+            v = self._val.get(uid)
+            if v is None:
+                return None
+            return bisect.bisect_left(self._keys, (-v, uid)) + 1
+
+    def size(self) -> int:
+        self._ensure()
+        return len(self._keys)
+
+    def items(self) -> List[Tuple[int, int]]:
+        """[(uid, top_value)] в порядке мест."""
+        self._ensure()
+        with self._lock:
+            return [(uid, -negv) for (negv, uid) in self._keys]
+
+    def check(self, repair: bool = True) -> dict:
+        """Сверка с полным пересчётом из users."""
+        self._ensure()
+        gen0, val = self._load()
+        with self._lock:
+            cur_val = self._val
+            fresh = self._merge_locked(gen0, val)
+            bad = [u for u in set(val) | set(cur_val) if u not in fresh and val.get(u) != cur_val.get(u)]
+            if bad and repair:
+                self._keys = sorted((-v, uid) for uid, v in val.items())
+                self._val = val
+        self.checks += 1
+        self.mismatches += len(bad)
+        self.last_check = {"ts": now_ts(), "users": len(val), "mismatched": len(bad), "sample": sorted(bad)[:5]}
+        return self.last_check
+
+LEADERBOARD = Leaderboard()
+
+def _leaderboard_check_daemon():
+    while True:
+        time.sleep(LEADERBOARD_CHECK_SEC)
+        try:
+            LEADERBOARD.check(repair=True)
+        except Exception:
+            pass
+
+if LEADERBOARD_CHECK_SEC > 0:
+    threading.Thread(target=_leaderboard_check_daemon, daemon=True).start()
+
+# Кэш строк users для get_user: LRU на USER_CACHE_SIZE записей с TTL. Согласованность держит
+# TEMP-триггер на писателе (conn): любая запись в users — upsert_user, set_short_name, балансы,
+# переводы, контракт, демоны, buyrab, /del — тем же оператором выкидывает строку из кэша,
+# так что и чтения внутри своей транзакции не увидят старое значение. Заполняется кэш только
+# чтением с read-пула при закрытой транзакции писателя и если за время чтения не было сбросов —
+# иначе можно положить строку, которая уже устарела (или ещё не закоммичена).
+USER_CACHE_SIZE = max(0, int(os.environ.get("USER_CACHE_SIZE", "5000") or 0))
+USER_CACHE_TTL_SEC = float(os.environ.get("USER_CACHE_TTL_SEC", "60") or 0)
+_USER_COLS = "user_id, username, short_name, created_ts, contract_ts, balance_cents, demo_gift_cents, demon"
+
+class UserCache:
+    def __init__(self, size: int, ttl: float):
+        self.size = int(size)
+        self.ttl = float(ttl)
+        self._rows: "OrderedDict[int, Tuple[tuple, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._seq = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.skipped_fills = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and self.ttl > 0
+
+    def get(self, uid: int):
+        if not self.enabled:
+            return None
+        with self._lock:
+            e = self._rows.get(uid)
+            if e is not None:
+                if e[1] > time.monotonic():
+                    self._rows.move_to_end(uid)
+                    self.hits += 1
+                    return e[0]
+                del self._rows[uid]
+            self.misses += 1
+        return None
+
+    def fill_token(self) -> Optional[int]:
+        if not self.enabled or conn.in_transaction or _db_read_on_writer():
+            return None
+        return self._seq
+
+    def put(self, uid: int, row, token: Optional[int]) -> None:
+        with self._lock:
+            if token is None or token != self._seq or conn.in_transaction:
+                self.skipped_fills += 1
+                return
+            self._rows[uid] = (tuple(row), time.monotonic() + self.ttl)
+            self._rows.move_to_end(uid)
+            while len(self._rows) > self.size:
+                self._rows.popitem(last=False)
+
+    def invalidate(self, uid) -> None:
+        with self._lock:
+            self._seq += 1
+            self.invalidations += 1
+            self._rows.pop(int(uid), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._seq += 1
+            self._rows.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "max": self.size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_pct": round(100.0 * self.hits / total, 1) if total else 0.0,
+            "invalidations": self.invalidations,
+            "skipped_fills": self.skipped_fills,
+        }
+
+USER_CACHE = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL_SEC)
+
+def _user_cache_drop(uid):
+    try:
+        USER_CACHE.invalidate(int(uid))
+    except Exception:
+        pass
+    return 0
+
+def _user_row_deleted(uid):
+    _user_cache_drop(uid)
+    KNOWN_USERS.forget(uid)
+    return 0
+
+def _install_user_cache_triggers(c: sqlite3.Connection) -> None:
+    """TEMP-триггеры живут только на этом соединении — остальным функция не нужна."""
+    c.create_function("user_cache_drop", 1, _user_cache_drop)
+    c.create_function("user_row_deleted", 1, _user_row_deleted)
+    changed = " OR ".join(f"OLD.{col} IS NOT NEW.{col}" for col in _USER_COLS.split(", "))
+    c.execute("CREATE TEMP TRIGGER IF NOT EXISTS trg_users_cache_ins AFTER INSERT ON users "
+              "BEGIN SELECT user_cache_drop(NEW.user_id); END")
+    c.execute(f"CREATE TEMP TRIGGER IF NOT EXISTS trg_users_cache_upd AFTER UPDATE ON users WHEN {changed} "
+              "BEGIN SELECT user_cache_drop(OLD.user_id); SELECT user_cache_drop(NEW.user_id); END")
+    c.execute("CREATE TEMP TRIGGER IF NOT EXISTS trg_users_cache_del AFTER DELETE ON users "
+              "BEGIN SELECT user_row_deleted(OLD.user_id); END")
+
+# Известные пользователи: uid -> последний записанный username (_NAME_UNKNOWN — строка есть,
+# username не знаем). upsert_user пишет только для новых uid и при смене username — иначе
+# каждый inline-запрос/команда стоили бы коммита в WAL. Удаление строки users (wipe, /del)
+# убирает uid через триггер; раз в KNOWN_USERS_RECONCILE_SEC карта сверяется с базой.
+KNOWN_USERS_RECONCILE_SEC = max(0, int(os.environ.get("KNOWN_USERS_RECONCILE_SEC", "900") or 0))
+KNOWN_USERS_MAX = max(0, int(os.environ.get("KNOWN_USERS_MAX", "200000") or 0))
+_NAME_UNKNOWN = object()
+
+class KnownUsers:
+    def __init__(self, max_size: int):
+        self.max_size = int(max_size)
+        self._names: Dict[int, object] = {}
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.skipped = 0
+        self.reconciles = 0
+        self.drift = 0
+
+    def needs_write(self, uid: int, username: Optional[str]) -> bool:
+        with self._lock:
+            if uid not in self._names:
+                return True
+            if username is None:
+                return False
+            return self._names[uid] != username
+
+    def remember(self, uid: int, username: Optional[str]) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if username is None:
+                self._names.setdefault(uid, _NAME_UNKNOWN)
+            else:
+                self._names[uid] = username
+            if len(self._names) > self.max_size:
+                self._names.clear()
+
+    def forget(self, uid) -> None:
+        with self._lock:
+            self._names.pop(int(uid), None)
+
+    def reconcile(self) -> int:
+        """
+        Сверка с users: uid, которых нет в базе, убираются, username правится на сохранённый.
+        Новых записей не добавляет — только сужает, поэтому гонка с записью даст максимум лишний upsert.
+        """
+        with self._lock:
+            uids = list(self._names)
+        stored: Dict[int, Optional[str]] = {}
+        for i in range(0, len(uids), 500):
+            part = uids[i:i + 500]
+            q = ",".join("?" * len(part))
+            for r in db_all(f"SELECT user_id, username FROM users WHERE user_id IN ({q})", tuple(part)):
+                stored[int(r[0])] = r[1]
+        drift = 0
+        with self._lock:
+            for uid in uids:
+                if uid not in self._names:
+                    continue
+                if uid not in stored:
+                    self._names.pop(uid, None)
+                    drift += 1
+                    continue
+                have = self._names[uid]
+                if have is not _NAME_UNKNOWN and have != stored[uid]:
+                    self._names[uid] = stored[uid] if stored[uid] is not None else _NAME_UNKNOWN
+                    drift += 1
+        self.reconciles += 1
+        self.drift += drift
+        return drift
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._names),
+            "writes": self.writes,
+            "skipped": self.skipped,
+            "reconciles": self.reconciles,
+            "drift": self.drift,
+        }
+
+KNOWN_USERS = KnownUsers(KNOWN_USERS_MAX)
+
+def _known_users_daemon():
+    while True:
+        time.sleep(KNOWN_USERS_RECONCILE_SEC)
+        try:
+            KNOWN_USERS.reconcile()
+        except Exception:
+            pass
+
+if KNOWN_USERS_RECONCILE_SEC > 0:
+    threading.Thread(target=_known_users_daemon, daemon=True).start()
+
+with DB_LOCK:
+    _install_user_cache_triggers(conn)
+    if conn.in_transaction:
+        conn.commit()
+
+# RANK SNAPSHOTS
+# Раз в RANK_SNAPSHOT_SEC снимаем денежный топ: по каждому участнику (uid, top_value, рабов, игр)
+# в порядке мест, место — это индекс. Пакуем в array('q') по столбцам и жмём zlib. Значения
+# хранятся дельтами: в порядке мест они убывают, и дельты маленькие. uid тоже идут дельтами, но
+# в порядке мест это разности случайных id (~5 байт после zlib); сортировка по uid не помогает —
+# столбец мест съедает выигрыш. Итого ~10-11 байт на игрока.
+# Источник — LEADERBOARD, owner_stats и game_stats, users не сканируется. Экран "Движение" в
+# статистике сравнивает текущие места со снимком; имена он берёт через get_users (кэш + IN по
+# ключу): в текущем топе бывают игроки, которых нет в снимке.
+RANK_SNAPSHOT_SEC = max(0, int(os.environ.get("RANK_SNAPSHOT_SEC", str(6 * 3600)) or 0))
+RANK_SNAPSHOT_KEEP_DAYS = max(1, int(os.environ.get("RANK_SNAPSHOT_KEEP_DAYS", "60") or 60))
+_RANK_SNAP_VERSION = 1
+
+def _delta_encode(vals: List[int]) -> List[int]:
+    prev = 0
+    out = []
+    for v in vals:
+        out.append(v - prev)
+        prev = v
+    return out
+
+def _delta_decode(vals) -> List[int]:
+    acc = 0
+    out = []
+    for d in vals:
+        acc += d
+        out.append(acc)
+    return out
+
+def pack_rank_snapshot(rows: List[Tuple[int, int, int, int]]) -> bytes:
+    """rows: [(uid, top_value, slaves_cnt, games_total)] в порядке мест."""
+    n = len(rows)
+    cols = [
+        _delta_encode([r[0] for r in rows]),
+        _delta_encode([r[1] for r in rows]),
+        [r[2] for r in rows],
+        [r[3] for r in rows],
+    ]
+    a = array("q", [_RANK_SNAP_VERSION, n])
+    for col in cols:
+        a.extend(col)
+    return zlib.compress(a.tobytes(), 6)
+
+def unpack_rank_snapshot(blob: bytes) -> List[Tuple[int, int, int, int]]:
+    a = array("q")
+    a.frombytes(zlib.decompress(blob))
+    if len(a) < 2 or a[0] != _RANK_SNAP_VERSION:
+        return []
+    n = int(a[1])
+    uids = _delta_decode(a[2:2 + n])
+    vals = _delta_decode(a[2 + n:2 + 2 * n])
+    slaves = a[2 + 2 * n:2 + 3 * n]
+    games = a[2 + 3 * n:2 + 4 * n]
+    return list(zip(uids, vals, slaves, games))
+
+class RankSnapshots:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latest: Optional[Tuple[int, int, Dict[int, Tuple[int, int, int, int]]]] = None  # (snap_id, ts, uid -> (место, value, рабы, игры))
+        self.taken = 0
+        self.last_bytes = 0
+        self.last_ms = 0.0
+
+    def take(self) -> Tuple[int, int]:
+        """Снимает топ. Возвращает (snap_id, игроков)."""
+        t0 = time.perf_counter()
+        items = LEADERBOARD.items()
+        slaves = {int(r[0]): int(r[1] or 0) for r in db_iter("SELECT owner_id, slaves_cnt FROM owner_stats")}
+        games = {int(r[0]): int(r[1] or 0) for r in db_iter("SELECT user_id, COALESCE(games_total,0) FROM game_stats")}
+        rows = [(uid, val, slaves.get(uid, 0), games.get(uid, 0)) for uid, val in items]
+        blob = pack_rank_snapshot(rows)
+        ts = now_ts()
+        with db_tx():
+            _rc, snap_id = db_exec(
+                "INSERT INTO rank_snapshots (ts, users, packed) VALUES (?,?,?)",
+                (ts, len(rows), sqlite3.Binary(blob))
+            )
+            db_exec("DELETE FROM rank_snapshots WHERE ts < ?", (ts - RANK_SNAPSHOT_KEEP_DAYS * 86400,))
+        with self._lock:
+            self._latest = (int(snap_id), ts, {r[0]: (i, r[1], r[2], r[3]) for i, r in enumerate(rows, start=1)})
+        self.taken += 1
+        self.last_bytes = len(blob)
+        self.last_ms = round((time.perf_counter() - t0) * 1000, 1)
+        return int(snap_id), len(rows)
+
+    def latest(self) -> Optional[Tuple[int, int, Dict[int, Tuple[int, int, int, int]]]]:
+        """(snap_id, ts, uid -> (место, value, рабы, игры)) последнего снимка; раскодируется один раз."""
+        r = db_one("SELECT snap_id FROM rank_snapshots ORDER BY snap_id DESC LIMIT 1", ())
+        if not r:
+            return None
+        snap_id = int(r[0])
+        with self._lock:
+            if self._latest and self._latest[0] == snap_id:
+                return self._latest
+        row = db_one("SELECT ts, packed FROM rank_snapshots WHERE snap_id=?", (snap_id,))
+        if not row:
+            return None
+        rows = unpack_rank_snapshot(bytes(row[1]))
+        latest = (snap_id, int(row[0]), {r[0]: (i, r[1], r[2], r[3]) for i, r in enumerate(rows, start=1)})
+        with self._lock:
+            self._latest = latest
+        return latest
+
+    def due(self) -> bool:
+        r = db_one("SELECT COALESCE(MAX(ts),0) FROM rank_snapshots", ())
+        return now_ts() - int((r[0] if r else 0) or 0) >= RANK_SNAPSHOT_SEC
+
+RANK_SNAPSHOTS = RankSnapshots()
+
+def _rank_snapshot_daemon():
+    while True:
+        try:
+            if RANK_SNAPSHOTS.due():
+                RANK_SNAPSHOTS.take()
+        except Exception as e:
+            try:
+                send_error_report("rank_snapshot", e)
+            except Exception:
+                pass
+        time.sleep(min(600, RANK_SNAPSHOT_SEC))
+
+if RANK_SNAPSHOT_SEC > 0:
+    threading.Thread(target=_rank_snapshot_daemon, daemon=True).start()
 
-    return f"{head}\n\n<blockquote expandable>{tail}</blockquote>"
+def rank_move_mark(old_place: Optional[int], new_place: int) -> str:
+    if old_place is None:
+        return "🆕"
+    d = int(old_place) - int(new_place)
+    if d > 0:
+        return f"▲{d}"
+    if d < 0:
+        return f"▼{-d}"
+    return "="
 
 def upsert_user(uid: int, username: Optional[str]):
+    uid = int(uid)
+    if not KNOWN_USERS.needs_write(uid, username):
+        KNOWN_USERS.skipped += 1
+        return
     db_exec("""
     INSERT INTO users (user_id, username, created_ts)
     VALUES (?,?,?)
     ON CONFLICT(user_id) DO UPDATE SET username=COALESCE(excluded.username, users.username)
-    """, (int(uid), username, now_ts()), commit=True)
+    """, (uid, username, now_ts()), commit=True)
+    KNOWN_USERS.writes += 1
+    if _db_in_tx():
+        # запоминаем только закоммиченное: после отката строки может не быть
+        db_after_commit(lambda: KNOWN_USERS.remember(uid, username))
+    else:
+        KNOWN_USERS.remember(uid, username)
+    LEADERBOARD.add_if_missing(uid)
 
 def set_short_name(uid: int, name: str):
     upsert_user(uid, None)
     db_exec("UPDATE users SET short_name=? WHERE user_id=?", (name, int(uid)), commit=True)
 
 def get_user(uid: int):
-    return db_one(
-        "SELECT user_id, username, short_name, created_ts, contract_ts, balance_cents, demo_gift_cents, demon "
-        "FROM users WHERE user_id=?",
-        (int(uid),)
-    )
+    uid = int(uid)
+    row = USER_CACHE.get(uid)
+    if row is not None:
+        return row
+    token = USER_CACHE.fill_token()
+    row = db_one(f"SELECT {_USER_COLS} FROM users WHERE user_id=?", (uid,))
+    if row is not None and token is not None:
+        USER_CACHE.put(uid, row, token)
+    return row
+
+def get_users(uids) -> Dict[int, tuple]:
+    """{uid: строка как у get_user} — из кэша, остальное одним IN-запросом."""
+    out: Dict[int, tuple] = {}
+    missing: List[int] = []
+    for uid in dict.fromkeys(int(u) for u in (uids or [])):
+        row = USER_CACHE.get(uid)
+        if row is not None:
+            out[uid] = row
+        else:
+            missing.append(uid)
+    if missing:
+        token = USER_CACHE.fill_token()
+        q = ",".join("?" * len(missing))
+        for row in db_all(f"SELECT {_USER_COLS} FROM users WHERE user_id IN ({q})", tuple(missing)) or []:
+            out[int(row[0])] = row
+            if token is not None:
+                USER_CACHE.put(int(row[0]), row, token)
+    return out
 
 def set_reg_state(uid: int, stage: Optional[str], msg_id: Optional[int]):
     db_exec("""
@@ -2315,18 +4346,23 @@ def get_reg_state(uid: int):
 def wipe_user(uid: int):
     uid = int(uid)
     db_exec("DELETE FROM users WHERE user_id=?", (uid,), commit=True)
+    LEADERBOARD.remove(uid)
     db_exec("DELETE FROM reg_state WHERE user_id=?", (uid,), commit=True)
     db_exec("DELETE FROM daily_mail WHERE user_id=?", (uid,), commit=True)
     db_exec("DELETE FROM game_stats WHERE user_id=?", (uid,), commit=True)
     db_exec("DELETE FROM slavery WHERE slave_id=? OR owner_id=?", (uid, uid), commit=True)
 
 def add_balance(uid: int, delta_cents: int):
-    upsert_user(int(uid), None)
-    db_exec(
-        "UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE user_id=?",
-        (int(delta_cents), int(uid)),
-        commit=True
-    )
+    uid = int(uid)
+    with db_tx():
+        upsert_user(uid, None)
+        db_exec(
+            "UPDATE users SET balance_cents = COALESCE(balance_cents,0) + ? WHERE user_id=?",
+            (int(delta_cents), uid),
+            commit=True
+        )
+        lb = leaderboard_capture(uid)
+    LEADERBOARD.touch(uid, *lb)
 
 def resolve_user_id_ref(ref: str) -> Optional[int]:
     """
@@ -2343,7 +4379,7 @@ def resolve_user_id_ref(ref: str) -> Optional[int]:
         uname = ref[1:].strip()
         if not uname:
             return None
-        r = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+        r = db_one(HOT_SQL["user_id_by_username"], (uname,))
         return int(r[0]) if r else None
 
     if ref.isdigit():
@@ -2377,6 +4413,7 @@ def add_custom_status(uid: int, status: str) -> bool:
         (int(uid), status, now_ts()),
         commit=True
     )
+    status_invalidate(uid)
     return True
 
 # PAY
@@ -2535,17 +4572,7 @@ def transfer_balance(
             TH_100K = 100_000 * 100
             TH_1M = 1_000_000 * 100
 
-            c.execute(
-                """
-                SELECT
-                  COALESCE(SUM(CASE WHEN amount_cents > 0 THEN 1 ELSE 0 END),0) AS c0,
-                  COALESCE(SUM(CASE WHEN amount_cents > ? THEN 1 ELSE 0 END),0) AS c100k,
-                  COALESCE(SUM(CASE WHEN amount_cents > ? THEN 1 ELSE 0 END),0) AS c1m
-                FROM transfers
-                WHERE from_id=? AND to_id=? AND ts>=?
-                """,
-                (TH_100K, TH_1M, from_uid, to_uid, ts0)
-            )
+            c.execute(HOT_SQL["transfer_balance:antifraud"], (TH_100K, TH_1M, from_uid, to_uid, ts0))
             row = c.fetchone() or (0, 0, 0)
             c0 = int((row[0] if len(row) > 0 else 0) or 0)
             c100k = int((row[1] if len(row) > 1 else 0) or 0)
@@ -2618,8 +4645,12 @@ def transfer_balance(
             sbal2 = int((c.fetchone() or [0])[0] or 0)
             c.execute("SELECT COALESCE(balance_cents,0) FROM users WHERE user_id=?", (to_uid,))
             rbal2 = int((c.fetchone() or [0])[0] or 0)
+            lb_from = leaderboard_capture(from_uid, c)
+            lb_to = leaderboard_capture(to_uid, c)
 
             conn.commit()
+            LEADERBOARD.touch(from_uid, *lb_from)
+            LEADERBOARD.touch(to_uid, *lb_to)
             return True, "ok", sbal2, rbal2, transfer_id
 
         except Exception as e:
@@ -2635,11 +4666,14 @@ def transfer_balance(
                 pass
 
 def set_contract_signed(uid: int, gift_cents: int):
-    db_exec("""
-    UPDATE users
-    SET contract_ts=?, demo_gift_cents=?, balance_cents=COALESCE(balance_cents,0)+?
-    WHERE user_id=?
-    """, (now_ts(), int(gift_cents), int(gift_cents), int(uid)), commit=True)
+    with db_tx():
+        db_exec("""
+        UPDATE users
+        SET contract_ts=?, demo_gift_cents=?, balance_cents=COALESCE(balance_cents,0)+?
+        WHERE user_id=?
+        """, (now_ts(), int(gift_cents), int(gift_cents), int(uid)), commit=True)
+        lb = leaderboard_capture(uid)
+    LEADERBOARD.touch(uid, *lb)
     ensure_daily_mail_row(int(uid))
 
 # Daily mail
@@ -2755,6 +4789,10 @@ def _mail_letter_text(kind: str, amount_cents: int) -> str:
     )
 
 def _send_mail_prompt(uid: int, kind: str, amount_cents: int) -> None:
+    if _db_in_tx():
+        # внутри расчёта игры письмо отправляем только после коммита
+        db_after_commit(lambda: _send_mail_prompt(uid, kind, amount_cents))
+        return
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton("Открыть письмо", callback_data=cb_pack("mail:open", uid)))
     msg = bot.send_message(uid, "Вам пришло письмо. Открыть?", reply_markup=kb)
@@ -2764,42 +4802,54 @@ def _send_mail_prompt(uid: int, kind: str, amount_cents: int) -> None:
         commit=True,
     )
 
+MAIL_SCAN_CHUNK = 500
+
 def _mail_daemon():
     while True:
         try:
             now = now_ts()
-            cur.execute("SELECT user_id, next_ts, intro_sent, stopped, pending_amt_cents, pending_msg_id FROM daily_mail")
-            rows = cur.fetchall()
-            for (uid, next_ts, intro_sent, stopped, pending_amt, pending_msg_id) in rows:
-                uid = int(uid)
-                if int(stopped or 0) == 1:
-                    continue
+            last_uid = 0
+            while True:
+                # закрытыми пачками: снимок чтения не держится, пока шлём в Telegram и пишем,
+                # а в памяти одновременно только одна пачка
+                rows = db_all(
+                    "SELECT user_id, next_ts, intro_sent, stopped, pending_amt_cents, pending_msg_id FROM daily_mail "
+                    "WHERE user_id > ? AND COALESCE(stopped,0)=0 ORDER BY user_id LIMIT ?",
+                    (last_uid, MAIL_SCAN_CHUNK),
+                ) or []
+                for (uid, next_ts, intro_sent, stopped, pending_amt, pending_msg_id) in rows:
+                    uid = int(uid)
+                    if int(stopped or 0) == 1:
+                        continue
 
-                if not is_registered(uid):
-                    continue
+                    if not is_registered(uid):
+                        continue
 
-                if has_work_history(uid):
-                    stop_daily_mail(uid)
-                    continue
+                    if has_work_history(uid):
+                        stop_daily_mail(uid)
+                        continue
 
-                if int(pending_msg_id or 0) != 0:
-                    continue
+                    if int(pending_msg_id or 0) != 0:
+                        continue
 
-                if now < int(next_ts or 0):
-                    continue
+                    if now < int(next_ts or 0):
+                        continue
 
-                if int(intro_sent or 0) == 0:
-                    kind = "intro"
-                    amt = 40000
-                    cur.execute("UPDATE daily_mail SET next_ts=?, intro_sent=1 WHERE user_id=?", (now + MAIL_PERIOD_SEC, uid))
-                    conn.commit()
-                    try:
-                        if user_pm_notifications_enabled(uid):
-                            _send_mail_prompt(uid, kind, amt)
-                        else:
-                            add_balance(uid, amt)
-                    except Exception:
-                        pass
+                    if int(intro_sent or 0) == 0:
+                        kind = "intro"
+                        amt = 40000
+                        cur.execute("UPDATE daily_mail SET next_ts=?, intro_sent=1 WHERE user_id=?", (now + MAIL_PERIOD_SEC, uid))
+                        db_commit()
+                        try:
+                            if user_pm_notifications_enabled(uid):
+                                _send_mail_prompt(uid, kind, amt)
+                            else:
+                                add_balance(uid, amt)
+                        except Exception:
+                            pass
+                if len(rows) < MAIL_SCAN_CHUNK:
+                    break
+                last_uid = rows[-1][0]
         except Exception:
             send_error_report("_mail_daemon")
         time.sleep(30)
@@ -2818,7 +4868,83 @@ def get_balance_cents(uid: int) -> int:
     r = db_one("SELECT COALESCE(balance_cents,0) FROM users WHERE user_id=?", (int(uid),))
     return int((r[0] if r else 0) or 0)
 
+# Статус профиля кэшируется на пользователя. Сброс — status_invalidate(uid) там, где меняется то,
+# от чего статус зависит: баланс/демон/подарок (LEADERBOARD.touch), рабство, кастомные статусы,
+# серия против демона, достижения. "Богатейший"/"Сама нищета" сверяются с текущими краями
+# LEADERBOARD при каждом попадании. TTL страхует пропущенные пути и "Вечного узника",
+# который наступает просто по времени.
+STATUS_MEMO_TTL_SEC = 300
+BROKEN_MOUTH_STATUS = "Ломаный рот этой рулетки"
+_STATUS_MEMO: Dict[int, Tuple[str, float, Optional[int], Optional[int]]] = {}
+_STATUS_MEMO_LOCK = threading.Lock()
+_STATUS_MEMO_SEQ = [0]
+STATUS_MEMO_STATS = {"hits": 0, "misses": 0, "invalidations": 0, "skipped_fills": 0}
+
+def status_invalidate(uid: int) -> None:
+    uid = int(uid)
+    with _STATUS_MEMO_LOCK:
+        _STATUS_MEMO_SEQ[0] += 1
+        if _STATUS_MEMO.pop(uid, None) is not None:
+            STATUS_MEMO_STATS["invalidations"] += 1
+    if _db_in_tx():
+        # параллельный читатель мог закэшировать статус по данным до коммита
+        db_after_commit(lambda: status_invalidate(uid))
+
+def _status_extremes() -> Tuple[Optional[int], Optional[int]]:
+    top1 = LEADERBOARD.top(1)
+    return (top1[0] if top1 else None), LEADERBOARD.last()
+
+def award_broken_mouth(game_id: str) -> None:
+    """Выдаёт липкий статус игрокам завершённой крестовой игры, ушедшим в минус от 1 млн $ к 9+ раунду."""
+    rows = db_all("""
+        SELECT gr.user_id
+        FROM games g
+        JOIN game_results gr ON gr.game_id=g.game_id
+        WHERE g.game_id=?
+          AND g.game_type='cross'
+          AND g.state='finished'
+          AND COALESCE(g.cross_round,0) >= 9
+          AND COALESCE(gr.delta_cents,0) <= ?
+    """, (str(game_id), -1_000_000 * 100))
+    for r in rows or []:
+        uid = int(r[0])
+        rc, _ = db_exec(
+            "INSERT OR IGNORE INTO user_achievements (user_id, status, game_id, ts) VALUES (?,?,?,?)",
+            (uid, BROKEN_MOUTH_STATUS, str(game_id), now_ts()),
+            commit=True
+        )
+        if rc:
+            status_invalidate(uid)
+
 def compute_status(uid: int) -> str:
+    uid = int(uid)
+    now = time.time()
+    top_uid, last_uid = _status_extremes()
+    with _STATUS_MEMO_LOCK:
+        m = _STATUS_MEMO.get(uid)
+        seq = _STATUS_MEMO_SEQ[0]
+    if m is not None:
+        text, exp, m_top, m_last = m
+        edges_moved = (m_top, m_last) != (top_uid, last_uid) and uid in (m_top, m_last, top_uid, last_uid)
+        if now < exp and not edges_moved:
+            STATUS_MEMO_STATS["hits"] += 1
+            return text
+    STATUS_MEMO_STATS["misses"] += 1
+    text = _compute_status_uncached(uid)
+    if _db_read_on_writer():
+        return text  # могли прочитать незакоммиченное
+    with _STATUS_MEMO_LOCK:
+        if seq != _STATUS_MEMO_SEQ[0]:
+            # пока считали, что-то сбросилось — результат мог устареть, не запоминаем
+            STATUS_MEMO_STATS["skipped_fills"] += 1
+            return text
+        if len(_STATUS_MEMO) > 20000:
+            for k in [k for k, v in _STATUS_MEMO.items() if v[1] <= now]:
+                _STATUS_MEMO.pop(k, None)
+        _STATUS_MEMO[uid] = (text, now + STATUS_MEMO_TTL_SEC, top_uid, last_uid)
+    return text
+
+def _compute_status_uncached(uid: int) -> str:
     u = get_user(uid)
     if not u:
         return "-"
@@ -2868,7 +4994,8 @@ def compute_status(uid: int) -> str:
         statuses.append("Великий должник")
 
     # раб
-    if is_slave(uid):
+    slave = is_slave(uid)
+    if slave:
         statuses.append("Раб")
 
     # удача/неудача по играм
@@ -2886,19 +5013,17 @@ def compute_status(uid: int) -> str:
 
     # богатейший/нищета
     try:
-        rows = db_all("SELECT user_id FROM users WHERE demon=0", ())
-        uids = [int(x[0]) for x in rows]
-        if uids:
-            uids.sort(key=lambda x: top_value_cents(x), reverse=True)
-            if uid == uids[0]:
+        top1 = LEADERBOARD.top(1)
+        if top1:
+            if uid == top1[0]:
                 statuses.append("Богатейший человек")
-            if uid == uids[-1]:
+            if uid == LEADERBOARD.last():
                 statuses.append("Сама нищета")
     except Exception:
         pass
 
     # Вечный узник: раб > полугода
-    if is_slave(uid):
+    if slave:
         try:
             r = db_one("SELECT COALESCE(MIN(acquired_ts),0) FROM slavery WHERE slave_id=?", (uid,))
             acq = int((r[0] if r else 0) or 0)
@@ -2914,21 +5039,11 @@ def compute_status(uid: int) -> str:
     except Exception:
         pass
 
-    # Ломаный рот этой рулетки
+    # Ломаный рот этой рулетки (липкий, выдаётся в award_broken_mouth)
     try:
-        r = db_one("""
-            SELECT 1
-            FROM games g
-            JOIN game_results gr ON gr.game_id=g.game_id
-            WHERE g.game_type='cross'
-              AND g.state='finished'
-              AND COALESCE(g.cross_round,0) >= 9
-              AND gr.user_id=?
-              AND COALESCE(gr.delta_cents,0) <= ?
-            LIMIT 1
-        """, (uid, -1_000_000 * 100))
+        r = db_one("SELECT 1 FROM user_achievements WHERE user_id=? AND status=?", (uid, BROKEN_MOUTH_STATUS))
         if r:
-            statuses.append("Ломаный рот этой рулетки")
+            statuses.append(BROKEN_MOUTH_STATUS)
     except Exception:
         pass
 
@@ -2951,6 +5066,7 @@ def set_demon_streak(uid: int, new_streak: int):
         (uid, new_streak, best, ts),
         commit=True
     )
+    status_invalidate(uid)
 
 def update_demon_streak_after_game(game_id: str):
     """
@@ -3149,7 +5265,7 @@ def _shop_catalog_regen(uid: int) -> List[str]:
         """,
         (uid, now_ts(), ",".join(picks)),
     )
-    conn.commit()
+    db_commit()
     return picks
 
 def get_shop_catalog(uid: int) -> List[str]:
@@ -3193,7 +5309,7 @@ def shop_set_qty(uid: int, key: str, qty: int):
     VALUES (?,?,?)
     ON CONFLICT(user_id, item_key) DO UPDATE SET qty=excluded.qty
     """, (uid, key, qty))
-    conn.commit()
+    db_commit()
 
 def shop_get_active(uid: int) -> dict:
     cur.execute("SELECT item_key, remaining_games FROM shop_active WHERE user_id=?", (uid,))
@@ -3303,7 +5419,8 @@ def shop_set_active(uid: int, key: str, remaining: int):
         VALUES (?,?,?)
         ON CONFLICT(user_id, item_key) DO UPDATE SET remaining_games=excluded.remaining_games
         """, (uid, key, remaining))
-    conn.commit()
+    db_commit()
+    shop_effects_invalidate(uid)
 
 def shop_get_bound_game(uid: int) -> str | None:
     row = db_one("SELECT game_id FROM shop_bind WHERE user_id=?", (uid,))
@@ -3311,6 +5428,7 @@ def shop_get_bound_game(uid: int) -> str | None:
 
 def shop_clear_bind(uid: int):
     db_exec("DELETE FROM shop_bind WHERE user_id=?", (uid,), commit=True)
+    shop_effects_invalidate(uid)
 
 def shop_bind_to_game(uid: int, game_id: str):
     db_exec(
@@ -3319,6 +5437,58 @@ def shop_bind_to_game(uid: int, game_id: str):
         (uid, game_id, now_ts()),
         commit=True
     )
+    # привязка ушла из прежней игры — её снимок у этого игрока больше не верен
+    shop_effects_invalidate(uid)
+
+# Снимок эффектов на игру: при переходе игры в playing (shop_bind_players_for_game) для каждого
+# игрока считается shop_get_active_for_game и дальше читается из памяти — кадры анимации и расчёт
+# хода не ходят в shop_active/shop_bind/games. Запись игрока сбрасывается во всех играх при
+# shop_set_active, shop_clear_bind и shop_bind_to_game (покупка посреди игры должна подействовать
+# сразу, а перенос привязки — снять эффект со старой игры), в своей игре — при shop_mark_used и
+# shop_tick_after_game. Сброшенная запись пересчитывается из базы при следующем чтении. Снимок игры удаляется,
+# когда она переходит в finished/cancelled.
+SHOP_SNAP_MAX_GAMES = 500
+_SHOP_SNAP: "OrderedDict[str, Dict[int, dict]]" = OrderedDict()
+_SHOP_SNAP_LOCK = threading.Lock()
+_SHOP_SNAP_SEQ = [0]
+SHOP_SNAP_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def shop_effects_invalidate(uid: int, game_id: Optional[str] = None) -> None:
+    uid = int(uid)
+    with _SHOP_SNAP_LOCK:
+        _SHOP_SNAP_SEQ[0] += 1
+        SHOP_SNAP_STATS["invalidations"] += 1
+        games = [str(game_id)] if game_id is not None else list(_SHOP_SNAP)
+        for gid in games:
+            snap = _SHOP_SNAP.get(gid)
+            if snap is not None:
+                snap.pop(uid, None)
+    if _db_in_tx():
+        db_after_commit(lambda: shop_effects_invalidate(uid, game_id))
+
+def _shop_snap_store(game_id: str, uid: int, active: dict, seq: int) -> None:
+    if _db_read_on_writer():
+        return  # могли прочитать незакоммиченное
+    with _SHOP_SNAP_LOCK:
+        snap = _SHOP_SNAP.get(game_id)
+        if snap is None or seq != _SHOP_SNAP_SEQ[0]:
+            return
+        snap[int(uid)] = dict(active)
+
+def shop_snapshot_game(game_id: str, uids) -> None:
+    game_id = str(game_id)
+    with _SHOP_SNAP_LOCK:
+        _SHOP_SNAP[game_id] = {}
+        _SHOP_SNAP.move_to_end(game_id)
+        while len(_SHOP_SNAP) > SHOP_SNAP_MAX_GAMES:
+            _SHOP_SNAP.popitem(last=False)
+    for uid in uids:
+        seq = _SHOP_SNAP_SEQ[0]
+        _shop_snap_store(game_id, uid, _shop_get_active_for_game_db(int(uid), game_id), seq)
+
+def shop_snapshot_drop(game_id: str) -> None:
+    with _SHOP_SNAP_LOCK:
+        _SHOP_SNAP.pop(str(game_id), None)
 
 def shop_bind_players_for_game(game_id: str):
     """
@@ -3331,6 +5501,7 @@ def shop_bind_players_for_game(game_id: str):
             uid = int(uid)
             if shop_get_active(uid):  # есть активные эффекты
                 shop_bind_to_game(uid, game_id)
+        shop_snapshot_game(game_id, [int(r[0]) for r in rows])
     except Exception:
         pass
 
@@ -3341,15 +5512,7 @@ def shop_get_earliest_active_game(uid: int) -> str | None:
     Возвращает самую раннюю активную игру пользователя для привязки усилений,
     но игнорирует "зависшие" лобби (старые lobby), которые часто остаются в БД и блокируют привязку.
     """
-    rows = db_all(
-        """SELECT g.game_id, g.state, g.created_ts
-             FROM games g
-             JOIN game_players gp ON gp.game_id=g.game_id
-            WHERE gp.user_id=?
-              AND g.state NOT IN ('finished','cancelled')
-            ORDER BY g.created_ts ASC""",
-        (uid,)
-    )
+    rows = db_all(HOT_SQL["shop_get_earliest_active_game"], (uid,))
     if not rows:
         return None
 
@@ -3368,6 +5531,22 @@ def shop_get_earliest_active_game(uid: int) -> str | None:
     return None
 
 def shop_get_active_for_game(uid: int, game_id: str) -> dict:
+    """Эффекты для игры: из снимка, если игра уже в playing, иначе из базы."""
+    game_id = str(game_id)
+    with _SHOP_SNAP_LOCK:
+        snap = _SHOP_SNAP.get(game_id)
+        hit = snap.get(int(uid)) if snap is not None else None
+        seq = _SHOP_SNAP_SEQ[0]
+    if hit is not None:
+        SHOP_SNAP_STATS["hits"] += 1
+        return dict(hit)
+    active = _shop_get_active_for_game_db(uid, game_id)
+    if snap is not None:
+        SHOP_SNAP_STATS["misses"] += 1
+        _shop_snap_store(game_id, uid, active, seq)
+    return active
+
+def _shop_get_active_for_game_db(uid: int, game_id: str) -> dict:
     """
     Активные эффекты магазина, применяемые ТОЛЬКО к привязанной игре.
 
@@ -3520,6 +5699,7 @@ def shop_mark_used(uid: int, game_id: str, item_key: str):
         (int(uid), str(game_id), str(item_key), int(time.time())),
         commit=True
     )
+    shop_effects_invalidate(uid, game_id)
 
 def shop_is_used(uid: int, game_id: str, item_key: str) -> bool:
     r = db_one(
@@ -3542,6 +5722,7 @@ def shop_tick_after_game(uid: int, game_id: str):
     Дополнительно: списываем только те предметы, которые реально работают в данном типе игры.
     Для insurance/paket списываем только если эффект реально сработал в этой игре.
     """
+    shop_effects_invalidate(uid, game_id)
     bound = shop_get_bound_game(uid)
     if not bound or bound != game_id:
         return
@@ -3723,7 +5904,7 @@ def maybe_make_slave_by_shop_trigger(uid: int, protected_amount_cents: int, game
     roll = random.randint(1, 100)
 
     if roll <= chance:
-        rr = db_one("SELECT user_id FROM users WHERE demon=1 ORDER BY RANDOM() LIMIT 1")
+        rr = db_one(HOT_SQL["random_demon"])
         if rr:
             demon_id = int(rr[0] or 0)
             if demon_id > 0 and demon_id != uid:
@@ -3880,7 +6061,7 @@ def load_jobs() -> Dict[str, JobDef]:
 
 def get_work_stats(uid: int, job_key: str) -> Tuple[int, int, int]:
     cur.execute("INSERT OR IGNORE INTO work_stats (user_id, job_key) VALUES (?,?)", (uid, job_key))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT shifts, days, earned_cents FROM work_stats WHERE user_id=? AND job_key=?", (uid, job_key))
     r = cur.fetchone()
     return (int(r[0] or 0), int(r[1] or 0), int(r[2] or 0))
@@ -3927,7 +6108,7 @@ def start_shift(uid: int, job_key: str) -> Tuple[int, int]:
       salary_full_cents=excluded.salary_full_cents,
       success_pct=excluded.success_pct
     """, (uid, job_key, now_ts(), ends_ts, int(salary_full), int(job.success_pct)))
-    conn.commit()
+    db_commit()
     return ends_ts, salary_full
 
 def finish_shift(uid: int):
@@ -3965,16 +6146,16 @@ def finish_shift(uid: int):
       days = work_stats.days + 1,
       earned_cents = work_stats.earned_cents + excluded.earned_cents
     """, (uid, job_key, 1, 1, int(paid_after_slave)))
-    conn.commit()
+    db_commit()
 
     cur.execute("""
     INSERT INTO work_history (user_id, job_key, started_ts, ends_ts, success, paid_cents, text)
     VALUES (?,?,?,?,?,?,?)
     """, (uid, job_key, int(started_ts), int(ends_ts), int(success), int(paid_after_slave), text))
-    conn.commit()
+    db_commit()
 
     cur.execute("DELETE FROM work_shift WHERE user_id=?", (uid,))
-    conn.commit()
+    db_commit()
 
     try:
         money_s = cents_to_money_str(paid_after_slave)
@@ -3984,7 +6165,10 @@ def finish_shift(uid: int):
 
 def has_work_history(uid: int) -> bool:
     cur.execute("SELECT 1 FROM work_history WHERE user_id=? LIMIT 1", (uid,))
-    return cur.fetchone() is not None
+    if cur.fetchone() is not None:
+        return True
+    # старые смены могли уйти в архив
+    return db_one("SELECT 1 FROM work_history_rollup WHERE user_id=? AND shifts>0", (int(uid),)) is not None
 
 def _format_duration(seconds: int) -> str:
     seconds = max(0, int(seconds))
@@ -4930,10 +7114,11 @@ def compute_group_key_from_callback(call: CallbackQuery, prefix_len=PREFIX_LEN)
         return f"inline_pref:{inline_id[:prefix_len]}"
     return None
 
-def edit_inline_or_message(call: CallbackQuery, text: str, reply_markup=None, parse_mode: Optional[str] = None):
+def edit_inline_or_message(call: CallbackQuery, text: str, reply_markup=None, parse_mode: Optional[str] = None,
+                           priority: int = EDIT_PRIO_MENU):
     inline_id = getattr(call, "inline_message_id", None)
     if inline_id:
-        limited_edit_message_text(text=text, inline_id=inline_id, reply_markup=reply_markup, parse_mode=parse_mode)
+        limited_edit_message_text(text=text, inline_id=inline_id, reply_markup=reply_markup, parse_mode=parse_mode, priority=priority)
         return
     if getattr(call, "message", None):
         limited_edit_message_text(
@@ -4941,7 +7126,8 @@ def edit_inline_or_message(call: CallbackQuery, text: str, reply_markup=None, pa
             chat_id=call.message.chat.id,
             msg_id=call.message.message_id,
             reply_markup=reply_markup,
-            parse_mode=parse_mode
+            parse_mode=parse_mode,
+            priority=priority
         )
         return
 
@@ -4967,49 +7153,20 @@ def edit_zero_message(
         return
 
     inline_id = getattr(call, "inline_message_id", None)
+    if inline_id:
+        where = {"inline_id": inline_id}
+    elif getattr(call, "message", None):
+        where = {"chat_id": call.message.chat.id, "msg_id": call.message.message_id}
+    else:
+        return
 
     if force_media:
-        try:
-            media = InputMediaPhoto(media=PHOTO_FILE_ID, caption=text, parse_mode=parse_mode)
-            if inline_id:
-                bot.edit_message_media(inline_message_id=inline_id, media=media, reply_markup=reply_markup)
-                return
-            if getattr(call, "message", None):
-                bot.edit_message_media(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    media=media,
-                    reply_markup=reply_markup
-                )
-                return
-        except Exception:
-            pass
-
-        edit_inline_or_message(call, text, reply_markup=reply_markup, parse_mode=parse_mode)
+        limited_edit_message_media(file_id=PHOTO_FILE_ID, caption=text, reply_markup=reply_markup,
+                                   parse_mode=parse_mode, fallback_text=True, **where)
         return
 
-    try:
-        if inline_id:
-            bot.edit_message_caption(
-                inline_message_id=inline_id,
-                caption=text,
-                parse_mode=parse_mode,
-                reply_markup=reply_markup
-            )
-            return
-        if getattr(call, "message", None):
-            bot.edit_message_caption(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                caption=text,
-                parse_mode=parse_mode,
-                reply_markup=reply_markup
-            )
-            return
-    except Exception:
-        pass
-
-    edit_inline_or_message(call, text, reply_markup=reply_markup, parse_mode=parse_mode)
+    limited_edit_message_caption(caption=text, reply_markup=reply_markup, parse_mode=parse_mode,
+                                 fallback_text=True, **where)
 
 # INLINE MENU
 def inline_article(title: str, desc: str, text: str, kb, thumb_key: str = "") -> InlineQueryResultArticle:
@@ -5131,10 +7288,7 @@ def on_inline(q: InlineQuery):
             status = compute_status(uid)
 
             try:
-                cur.execute("SELECT user_id FROM users WHERE demon=0")
-                uids = [r[0] for r in cur.fetchall()]
-                uids.sort(key=lambda x: top_value_cents(x), reverse=True)
-                place = (uids.index(uid2) + 1) if (int(demon or 0) == 0 and uid2 in uids) else "-"
+                place = (LEADERBOARD.rank(uid2) or "-") if int(demon or 0) == 0 else "-"
             except Exception:
                 place = "-"
 
@@ -5381,10 +7535,7 @@ def on_inline(q: InlineQuery):
         ))
     else:
         uid2, uname, short_name, created_ts, contract_ts, bal, gift, demon = u
-        cur.execute("SELECT user_id FROM users WHERE demon=0")
-        uids = [r[0] for r in cur.fetchall()]
-        uids.sort(key=lambda x: top_value_cents(x), reverse=True)
-        place = (uids.index(uid2) + 1) if (demon == 0 and uid2 in uids) else "-"
+        place = (LEADERBOARD.rank(uid2) or "-") if demon == 0 else "-"
 
         status = compute_status(uid)
 
@@ -5475,18 +7626,14 @@ def on_inline(q: InlineQuery):
         pass
 
     # Статистика
-    cur.execute("SELECT user_id FROM users WHERE demon=0")
-    all_uids = [r[0] for r in cur.fetchall()]
-    all_uids.sort(key=lambda u: top_value_cents(u), reverse=True)
-    
     header = "📄<b><u>Статистика</u>\nПо количеству денежного трафика</b>\n\n"
     lines = []
-    topn = all_uids[:STATS_TOP_LIMIT]
+    topn = LEADERBOARD.top(STATS_TOP_LIMIT)
     for i2, uid_top in enumerate(topn, start=1):
         lines.append(format_user_line(uid_top, i2, uid))
     
-    if uid in all_uids:
-        my_place = all_uids.index(uid) + 1
+    my_place = LEADERBOARD.rank(uid)
+    if my_place:
         if my_place > STATS_TOP_LIMIT:
             lines.append("…")
             lines.append(format_user_line(uid, my_place, uid))
@@ -5620,10 +7767,7 @@ def on_reg_callbacks(call: CallbackQuery):
     m.chat.type == "private"
     and m.text
     and not m.text.startswith("/")
-    and db_one(
-        "SELECT 1 FROM report_state WHERE user_id=? AND stage='await_content' LIMIT 1",
-        (int(m.from_user.id),),
-    ) is None
+    and report_get_state(m.from_user.id)[0] != "await_content"
 ))
 def on_private_text(message):
     uid = message.from_user.id
@@ -5719,10 +7863,65 @@ def stats_kb(uid: int, active: str) -> InlineKeyboardMarkup:
         InlineKeyboardButton(a1, callback_data=cb_pack("stats:top", uid)),
         InlineKeyboardButton(a2, callback_data=cb_pack("stats:owners", uid)),
     )
+    kb.row(InlineKeyboardButton("Движение в топе", callback_data=cb_pack("stats:moves", uid)))
     return kb
 
-def format_owner_line(owner_id: int, place: int, highlight_uid: int, slaves_cnt: int, earned_cents: int) -> str:
-    r = db_one("SELECT short_name, username FROM users WHERE user_id=?", (int(owner_id),))
+def build_rank_moves_text(viewer: int) -> str:
+    """
+    Места сейчас против последнего снимка. Значения и места — из LEADERBOARD, не из users;
+    имена — get_users по uid строк экрана (обычно из USER_CACHE).
+    """
+    header = "📄<b><u>Статистика</u>\nДвижение в денежном топе</b>\n"
+    snap = RANK_SNAPSHOTS.latest()
+    if not snap:
+        return header + "\nСнимков ещё нет."
+    _snap_id, snap_ts, prev = snap
+    items = LEADERBOARD.items()
+    top = items[:STATS_TOP_LIMIT]
+    mine = None
+    # место зрителя — из того же списка items: отдельный LEADERBOARD.rank мог бы разойтись с ним
+    place = next((i for i, (uid, _v) in enumerate(items, start=1) if uid == int(viewer)), None)
+    if place and place > STATS_TOP_LIMIT:
+        mine = (place, items[place - 1])
+    names = get_users([uid for uid, _v in top] + ([int(viewer)] if mine else []))
+
+    def line(place: int, uid: int, val: int) -> str:
+        u = names.get(uid)
+        name = (u[2] if u and u[2] else None) or "Без имени"
+        name_html = f"<b><u>{html_escape(name)}</u></b>" if uid == int(viewer) else f"<b>{html_escape(name)}</b>"
+        old = prev.get(uid)
+        mark = rank_move_mark(old[0] if old else None, place)
+        dv = ""
+        if old and val != old[1]:
+            dv = f" ({'+' if val > old[1] else '−'}{cents_to_money_str(abs(val - old[1]))}$)"
+        return f"{place}. {mark} {name_html} - <b>{cents_to_money_str(val)}</b>${dv}"
+
+    lines = [f"С {time.strftime('%d.%m %H:%M', time.localtime(snap_ts))}:", ""]
+    for i, (uid, val) in enumerate(top, start=1):
+        lines.append(line(i, uid, val))
+    if mine:
+        place, (uid, val) = mine
+        lines.append("…")
+        lines.append(line(place, uid, val))
+    if not top:
+        lines.append("Пусто")
+    return header + "\n".join(lines)
+
+def get_user_names(uids) -> Dict[int, Tuple[str, str]]:
+    """{user_id: (short_name, username)} одним запросом."""
+    ids = sorted({int(u) for u in (uids or [])})
+    if not ids:
+        return {}
+    q = ",".join("?" * len(ids))
+    rows = db_all(f"SELECT user_id, short_name, username FROM users WHERE user_id IN ({q})", tuple(ids))
+    return {int(r[0]): (r[1], r[2]) for r in (rows or [])}
+
+def format_owner_line(owner_id: int, place: int, highlight_uid: int, slaves_cnt: int, earned_cents: int,
+                      names: Optional[Dict[int, Tuple[str, str]]] = None) -> str:
+    if names is not None:
+        r = names.get(int(owner_id))
+    else:
+        r = db_one("SELECT short_name, username FROM users WHERE user_id=?", (int(owner_id),))
     name = (r[0] if r else None) or "Без имени"
     uname = (r[1] if r else "") or ""
 
@@ -5736,22 +7935,32 @@ def format_owner_line(owner_id: int, place: int, highlight_uid: int, slaves_cnt:
         f"доход: <b>{cents_to_money_str(int(earned_cents))}</b>$"
     )
 
-def get_slave_owner_ranking() -> list[tuple[int, int, int]]:
+def get_slave_owner_ranking(limit: Optional[int] = None) -> list[tuple[int, int, int]]:
     """
-    Возвращает список (owner_id, slaves_cnt, earned_cents),
+    Возвращает список (owner_id, slaves_cnt, earned_cents) из owner_stats,
     сортировка: slaves_cnt desc, earned_cents desc.
     """
-    rows = db_all("""
-        SELECT owner_id,
-               COUNT(DISTINCT slave_id) AS slaves_cnt,
-               COALESCE(SUM(COALESCE(earned_cents,0)),0) AS earned_cents
-        FROM slavery
-        GROUP BY owner_id
-        HAVING slaves_cnt > 0
-    """, ())
-    out = [(int(r[0]), int(r[1] or 0), int(r[2] or 0)) for r in (rows or [])]
-    out.sort(key=lambda x: (x[1], x[2]), reverse=True)
-    return out
+    sql = HOT_SQL["stats:owners"]
+    params: tuple = ()
+    if limit is not None:
+        sql += " LIMIT ?"
+        params = (int(limit),)
+    rows = db_all(sql, params)
+    return [(int(r[0]), int(r[1] or 0), int(r[2] or 0)) for r in (rows or [])]
+
+def get_slave_owner_place(uid: int) -> Optional[tuple[int, int, int]]:
+    """(place, slaves_cnt, earned_cents) владельца или None, если рабов нет."""
+    r = db_one("SELECT slaves_cnt, earned_cents FROM owner_stats WHERE owner_id=? AND slaves_cnt > 0", (int(uid),))
+    if not r:
+        return None
+    scnt, earned = int(r[0] or 0), int(r[1] or 0)
+    above = db_one("""
+        SELECT COUNT(*) FROM owner_stats
+        WHERE slaves_cnt > ?
+           OR (slaves_cnt = ? AND earned_cents > ?)
+           OR (slaves_cnt = ? AND earned_cents = ? AND owner_id < ?)
+    """, (scnt, scnt, earned, scnt, earned, int(uid)))
+    return (int(above[0] or 0) + 1, scnt, earned)
 
 @bot.callback_query_handler(func=lambda c: c.data and (c.data.startswith("stats:") or c.data.startswith("profile:") or c.data.startswith("work:") or c.data.startswith("game:")))
 def on_main_callbacks(call: CallbackQuery):
@@ -5773,18 +7982,14 @@ def on_main_callbacks(call: CallbackQuery):
 
     #STATS TOP
     if kind == "stats" and parts[1] == "top":
-        cur.execute("SELECT user_id FROM users WHERE demon=0")
-        all_uids = [r[0] for r in cur.fetchall()]
-        all_uids.sort(key=lambda u: top_value_cents(u), reverse=True)
-    
         header = "📄<b><u>Статистика</u>\nПо количеству денежного трафика</b>\n\n"
         lines = []
-        topn = all_uids[:STATS_TOP_LIMIT]
+        topn = LEADERBOARD.top(STATS_TOP_LIMIT)
         for i, uid in enumerate(topn, start=1):
             lines.append(format_user_line(uid, i, clicker))
     
-        if clicker in all_uids:
-            my_place = all_uids.index(clicker) + 1
+        my_place = LEADERBOARD.rank(clicker)
+        if my_place:
             if my_place > STATS_TOP_LIMIT:
                 lines.append("…")
                 lines.append(format_user_line(clicker, my_place, clicker))
@@ -5795,27 +8000,32 @@ def on_main_callbacks(call: CallbackQuery):
         bot.answer_callback_query(call.id)
         return
     
+    if kind == "stats" and parts[1] == "moves":
+        text = build_rank_moves_text(clicker)
+        kb = stats_kb(clicker, "moves")
+        edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
+        bot.answer_callback_query(call.id)
+        return
+
     if kind == "stats" and parts[1] == "owners":
-        ranking = get_slave_owner_ranking()
+        topn = get_slave_owner_ranking(STATS_TOP_LIMIT)
     
         header = "📄<b><u>Статистика</u>\nРабовладельцы</b>\n\n"
         helpline = "\n\nДля более детальной информации по пользователю /rabs"
         lines = []
     
-        topn = ranking[:STATS_TOP_LIMIT]
+        mine = None
+        if not any(int(oid) == int(clicker) for oid, _sc, _er in topn):
+            mine = get_slave_owner_place(clicker)
+        names = get_user_names([oid for oid, _sc, _er in topn] + ([clicker] if mine else []))
+
         for i, (oid, scnt, earned) in enumerate(topn, start=1):
-            lines.append(format_owner_line(oid, i, clicker, scnt, earned))
-    
-        my_place = None
-        for i, (oid, _sc, _er) in enumerate(ranking, start=1):
-            if int(oid) == int(clicker):
-                my_place = i
-                break
+            lines.append(format_owner_line(oid, i, clicker, scnt, earned, names))
     
-        if my_place is not None and my_place > STATS_TOP_LIMIT:
-            oid, scnt, earned = next((x for x in ranking if int(x[0]) == int(clicker)), (clicker, 0, 0))
+        if mine is not None and mine[0] > STATS_TOP_LIMIT:
+            my_place, scnt, earned = mine
             lines.append("…")
-            lines.append(format_owner_line(oid, int(my_place), clicker, scnt, earned))
+            lines.append(format_owner_line(clicker, int(my_place), clicker, scnt, earned, names))
     
         text = header + "\n".join(lines if lines else ["Пусто"]) + helpline
         kb = stats_kb(clicker, "owners")
@@ -6625,7 +8835,7 @@ def on_main_callbacks(call: CallbackQuery):
               origin_chat_id, origin_message_id, origin_inline_id, game_key, 1,
               stake_kind, int(life_demon_id), 0))
         cur.execute("INSERT INTO game_players (game_id, user_id, status) VALUES (?,?,?)", (game_id, clicker, "ready"))
-        conn.commit()
+        db_commit()
 
         schedule_lobby_end(game_id)
 
@@ -6706,7 +8916,7 @@ def on_buy_callbacks(call: CallbackQuery):
 
     if action == "dec":
         cur.execute("UPDATE buy_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?", (offer_id, clicker))
-        conn.commit()
+        db_commit()
         try:
             bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
         except Exception:
@@ -6722,7 +8932,7 @@ def on_buy_callbacks(call: CallbackQuery):
         sr = cur.fetchone()
         if not sr:
             cur.execute("UPDATE buy_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?", (offer_id, clicker))
-            conn.commit()
+            db_commit()
             bot.answer_callback_query(call.id, "У тебя уже нет доли за владение рабом.", show_alert=True)
             return
         seller_bp = int(sr[0] or 0)
@@ -6732,7 +8942,7 @@ def on_buy_callbacks(call: CallbackQuery):
         buyer_bal = int(br[0] or 0) if br else 0
         if buyer_bal < price_cents or buyer_bal < 0:
             cur.execute("UPDATE buy_offer_resp SET status=-1 WHERE offer_id=? AND owner_id=?", (offer_id, clicker))
-            conn.commit()
+            db_commit()
             bot.answer_callback_query(call.id, "У покупателя не хватает средств.", show_alert=True)
             return
 
@@ -6747,10 +8957,11 @@ def on_buy_callbacks(call: CallbackQuery):
             cur.execute("UPDATE slavery SET share_bp=? WHERE slave_id=? AND owner_id=?", (new_bp, slave_id, buyer_id))
         else:
             cur.execute("INSERT OR IGNORE INTO slavery (slave_id, owner_id, share_bp, earned_cents) VALUES (?,?,?,0)", (slave_id, buyer_id, seller_bp))
-        conn.commit()
+        db_commit()
+        status_invalidate(slave_id)
 
         cur.execute("UPDATE buy_offer_resp SET status=1 WHERE offer_id=? AND owner_id=?", (offer_id, clicker))
-        conn.commit()
+        db_commit()
 
         try:
             bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=None)
@@ -6767,7 +8978,7 @@ def on_buy_callbacks(call: CallbackQuery):
     pending = int(cur.fetchone()[0] or 0)
     if pending == 0:
         cur.execute("UPDATE buy_offers SET active=0 WHERE offer_id=?", (offer_id,))
-        conn.commit()
+        db_commit()
         cur.execute("SELECT COUNT(1) FROM buy_offer_resp WHERE offer_id=? AND status=1", (offer_id,))
         acc = int(cur.fetchone()[0] or 0)
         cur.execute("SELECT COUNT(1) FROM buy_offer_resp WHERE offer_id=? AND status=-1", (offer_id,))
@@ -6862,7 +9073,10 @@ def _buyrab_finalize_if_ready(offer_id: str):
                 "UPDATE buyrab_offers SET hold_cents=0, state=2 WHERE offer_id=?",
                 (offer_id,),
             )
+            lb = leaderboard_capture(buyer_id, c) if (refund > 0 and buyer_id > 0) else None
             conn.commit()
+            if lb is not None:
+                LEADERBOARD.touch(buyer_id, *lb)
 
             spent = max(0, total_cents - refund)
 
@@ -6993,8 +9207,10 @@ def on_buyrab_callbacks(call: CallbackQuery):
                 ur = c.fetchone() or (None, None)
                 buyer_name = ur[0] or "Покупатель"
                 buyer_un = ur[1] or ""
+                lb = leaderboard_capture(buyer_id, c)
 
                 conn.commit()
+                LEADERBOARD.touch(buyer_id, *lb)
 
             except Exception as e:
                 try:
@@ -7182,7 +9398,10 @@ def on_buyrab_callbacks(call: CallbackQuery):
                         "UPDATE buyrab_offer_resp SET status=1 WHERE offer_id=? AND owner_id=?",
                         (offer_id, clicker),
                     )
+                    lb = leaderboard_capture(clicker, c)
                     conn.commit()
+                    LEADERBOARD.touch(clicker, *lb)
+                    status_invalidate(slave_id)
 
             except Exception as e:
                 try:
@@ -7274,28 +9493,106 @@ def _send_buyrab_final(fin: dict):
         except Exception:
             pass
 
-# Game lobby rendering & handlers
-def render_lobby(game_id: str) -> Tuple[str, InlineKeyboardMarkup]:
+# Game view: всё, что нужно экранам игры, набором запросов фиксированной длины
+# (игра, игроки, пользователи, результаты, ставки/исходы зеро, голоса за реванш) — без запроса на игрока.
+@dataclass
+class GameView:
+    game_id: str
+    creator_id: int
+    stake_cents: int
+    reg_ends_ts: int
+    reg_extended: int
+    game_type: str
+    stake_kind: str
+    life_demon_id: int
+    turn_index: int
+    state: str
+    players: List[Tuple[int, str]]
+    users: Dict[int, tuple]
+    deltas: Dict[int, int]
+    picks: Dict[int, List[str]]
+    outcomes: Dict[int, Tuple[str, float]]
+    votes: Dict[str, int]
+
+    def user(self, uid: int):
+        return self.users.get(int(uid))
+
+def load_game_view(game_id: str, *, results: bool = False, zero: bool = False, votes: bool = False) -> Optional[GameView]:
     row = db_one(
         """
         SELECT creator_id, stake_cents, reg_ends_ts, reg_extended,
                COALESCE(game_type,'roulette'),
                COALESCE(stake_kind,'money'),
-               COALESCE(life_demon_id,0)
+               COALESCE(life_demon_id,0),
+               COALESCE(turn_index,0),
+               COALESCE(state,'')
         FROM games WHERE game_id=?
         """,
         (game_id,),
     )
     if not row:
+        return None
+
+    players = [(int(r[0]), r[1]) for r in (db_all(
+        "SELECT user_id, status FROM game_players WHERE game_id=? ORDER BY rowid", (game_id,)
+    ) or [])]
+
+    deltas: Dict[int, int] = {}
+    if results:
+        for uid, delta in db_all("SELECT user_id, COALESCE(delta_cents,0) FROM game_results WHERE game_id=?", (game_id,)) or []:
+            deltas[int(uid)] = int(delta or 0)
+
+    picks: Dict[int, List[str]] = {}
+    outcomes: Dict[int, Tuple[str, float]] = {}
+    if zero:
+        for uid, code in db_all(
+            "SELECT user_id, code FROM zero_bets WHERE game_id=? ORDER BY user_id, slot", (game_id,)
+        ) or []:
+            picks.setdefault(int(uid), []).append((code or "").strip())
+        if results:
+            for uid, combo, mult in db_all(
+                "SELECT user_id, COALESCE(combo,''), COALESCE(mult,1.0) FROM zero_outcomes WHERE game_id=?", (game_id,)
+            ) or []:
+                outcomes[int(uid)] = (combo or "", float(mult or 1.0))
+
+    vote_counts = {"yes": 0, "no": 0}
+    if votes:
+        for vote, n in db_all("SELECT vote, COUNT(*) FROM rematch_votes WHERE game_id=? GROUP BY vote", (game_id,)) or []:
+            vote_counts[str(vote)] = int(n or 0)
+
+    return GameView(
+        game_id=str(game_id),
+        creator_id=int(row[0] or 0),
+        stake_cents=int(row[1] or 0),
+        reg_ends_ts=int(row[2] or 0),
+        reg_extended=int(row[3] or 0),
+        game_type=row[4] or "roulette",
+        stake_kind=row[5] or "money",
+        life_demon_id=int(row[6] or 0),
+        turn_index=int(row[7] or 0),
+        state=row[8] or "",
+        players=players,
+        users=get_users([uid for uid, _st in players]),
+        deltas=deltas,
+        picks=picks,
+        outcomes=outcomes,
+        votes=vote_counts,
+    )
+
+# Game lobby rendering & handlers
+def render_lobby(game_id: str) -> Tuple[str, InlineKeyboardMarkup]:
+    view = load_game_view(game_id)
+    if not view:
         return "Игра не найдена.", InlineKeyboardMarkup()
 
-    creator_id, stake_cents, reg_ends_ts, reg_extended, game_type, stake_kind, life_demon_id = row
-    players = db_all("SELECT user_id, status FROM game_players WHERE game_id=? ORDER BY rowid", (game_id,))
+    creator_id, stake_cents, reg_ends_ts, reg_extended = view.creator_id, view.stake_cents, view.reg_ends_ts, view.reg_extended
+    game_type, stake_kind = view.game_type, view.stake_kind
+    players = view.players
 
     lines = []
     pending_uids = []
     for uid, status in players:
-        u = get_user(int(uid))
+        u = view.user(uid)
         if not u or not u[2]:
             pending_uids.append(int(uid))
             name = "<b>Аноним</b>"
@@ -7386,7 +9683,8 @@ def end_lobby_if_needed(game_id: str):
 
     if others_n == 0:
         db_exec("UPDATE games SET state='cancelled' WHERE game_id=?", (game_id,), commit=True)
-        edit_game_message(game_id, "Регистрация завершена. Никто не присоединился.\nИгра отменена", reply_markup=None)
+        shop_snapshot_drop(game_id)
+        edit_game_message(game_id, "Регистрация завершена. Никто не присоединился.\nИгра отменена", reply_markup=None, priority=EDIT_PRIO_FINAL)
         return
 
     if game_type == "cross":
@@ -7710,14 +10008,10 @@ def zero_format_gen_row(gen_nums: list, revealed: int) -> str:
     return "".join(parts)
 
 def zero_render_screen(game_id: str) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
-    g = db_one(
-        "SELECT stake_cents, COALESCE(stake_kind,'money'), COALESCE(turn_index,0), COALESCE(state,'') "
-        "FROM games WHERE game_id=?",
-        (game_id,)
-    )
-    if not g:
+    view = load_game_view(game_id, zero=True)
+    if not view:
         return "Игра не найдена.", None
-    stake_cents, stake_kind, turn_index, gstate = int(g[0] or 0), (g[1] or "money"), int(g[2] or 0), (g[3] or "")
+    stake_cents, stake_kind, turn_index, gstate = view.stake_cents, view.stake_kind, view.turn_index, view.state
 
     z = db_one("SELECT COALESCE(stage,'betting'), COALESCE(revealed,0) FROM zero_state WHERE game_id=?", (game_id,))
     stage = (z[0] if z else "betting") or "betting"
@@ -7737,15 +10031,19 @@ def zero_render_screen(game_id: str) -> Tuple[str, Optional[InlineKeyboardMarkup
     lines.append(f"⛂⛁ Цена фишки: <b>{cents_to_money_str(stake_cents)}</b>$")
     lines.append("Игроки:")
 
+    missing = [u for u in order if int(u) not in view.users]
+    if missing:
+        view.users.update(get_users(missing))
+
     for uid in order:
-        u = get_user(uid)
+        u = view.user(uid)
         name = u[2] if u and u[2] else "Игрок"
         uname = u[1] if u and u[1] else ""
         name_html = f"<b>{html_escape(name)}</b>"
         if stage == "betting" and uid == active_uid:
             name_html = f"<b>Ход <u>{html_escape(name)}</u></b>"
         tail = f" (@{html_escape(uname)})" if uname else ""
-        picks = zero_get_picks(game_id, uid)
+        picks = view.picks.get(int(uid), [])
     
         lines.append(f"{name_html}{tail}")
     
@@ -8119,79 +10417,82 @@ def zero_finish_game(game_id: str):
     if not order:
         return
 
-    for uid in order:
-        picks = zero_get_picks(game_id, uid)
-        delta, combo_name, mult = zero_compute_delta(picks, gen_nums, stake_cents)
-
-        active = shop_get_active_for_game(uid, game_id)
-
-        insured = (active.get("insurance", 0) > 0) or (active.get("paket", 0) > 0)
-        if insured and int(delta) < 0:
-            protected_amt = abs(int(delta))
-            if active.get("paket", 0) > 0:
-                shop_mark_used(uid, game_id, "paket")
-                delta = protected_amt
-            else:
-                shop_mark_used(uid, game_id, "insurance")
-                delta = 0
-            maybe_make_slave_by_shop_trigger(uid, protected_amt, game_id)
+    # расчёт всех игроков и завершение игры — одним коммитом
+    with db_tx():
+        for uid in order:
+            picks = zero_get_picks(game_id, uid)
+            delta, combo_name, mult = zero_compute_delta(picks, gen_nums, stake_cents)
 
-        u = get_user(uid)
-        is_demon = (u and int(u[7] or 0) == 1)
-        if not is_demon:
-            if delta > 0:
-                kept = apply_slave_cut(uid, int(delta), reason="zero")
-                add_balance(uid, kept)
-            else:
-                add_balance(uid, int(delta))
+            active = shop_get_active_for_game(uid, game_id)
 
-        db_exec(
-            "INSERT INTO game_results (game_id, user_id, delta_cents, finished) "
-            "VALUES (?,?,?,1) "
-            "ON CONFLICT(game_id,user_id) DO UPDATE SET delta_cents=excluded.delta_cents, finished=1",
-            (game_id, int(uid), int(delta)),
-            commit=True
-        )
+            insured = (active.get("insurance", 0) > 0) or (active.get("paket", 0) > 0)
+            if insured and int(delta) < 0:
+                protected_amt = abs(int(delta))
+                if active.get("paket", 0) > 0:
+                    shop_mark_used(uid, game_id, "paket")
+                    delta = protected_amt
+                else:
+                    shop_mark_used(uid, game_id, "insurance")
+                    delta = 0
+                maybe_make_slave_by_shop_trigger(uid, protected_amt, game_id)
 
-        db_exec(
-            "INSERT INTO zero_outcomes (game_id, user_id, combo, mult) VALUES (?,?,?,?) "
-            "ON CONFLICT(game_id,user_id) DO UPDATE SET combo=excluded.combo, mult=excluded.mult",
-            (game_id, int(uid), combo_name or "", float(mult)),
-            commit=True
-        )
+            u = get_user(uid)
+            is_demon = (u and int(u[7] or 0) == 1)
+            if not is_demon:
+                if delta > 0:
+                    kept = apply_slave_cut(uid, int(delta), reason="zero")
+                    add_balance(uid, kept)
+                else:
+                    add_balance(uid, int(delta))
 
-        db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (int(uid),), commit=True)
-        if int(delta) >= 0:
             db_exec(
-                "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
-                (int(delta), int(uid)),
+                "INSERT INTO game_results (game_id, user_id, delta_cents, finished) "
+                "VALUES (?,?,?,1) "
+                "ON CONFLICT(game_id,user_id) DO UPDATE SET delta_cents=excluded.delta_cents, finished=1",
+                (game_id, int(uid), int(delta)),
                 commit=True
             )
-        else:
+
             db_exec(
-                "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
-                (int(abs(int(delta))), int(uid)),
+                "INSERT INTO zero_outcomes (game_id, user_id, combo, mult) VALUES (?,?,?,?) "
+                "ON CONFLICT(game_id,user_id) DO UPDATE SET combo=excluded.combo, mult=excluded.mult",
+                (game_id, int(uid), combo_name or "", float(mult)),
                 commit=True
             )
-        bump_game_type_stat(int(uid), "zero")
 
-    db_exec("UPDATE games SET state='finished' WHERE game_id=?", (game_id,), commit=True)
+            db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (int(uid),), commit=True)
+            if int(delta) >= 0:
+                db_exec(
+                    "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
+                    (int(delta), int(uid)),
+                    commit=True
+                )
+            else:
+                db_exec(
+                    "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
+                    (int(abs(int(delta))), int(uid)),
+                    commit=True
+                )
+            bump_game_type_stat(int(uid), "zero")
+
+        db_exec("UPDATE games SET state='finished' WHERE game_id=?", (game_id,), commit=True)
+        shop_snapshot_drop(game_id)
 
-    try:
-        for pid in set(order):
-            shop_tick_after_game(int(pid), game_id)
-    except Exception:
-        pass
+        try:
+            for pid in set(order):
+                shop_tick_after_game(int(pid), game_id)
+        except Exception:
+            pass
 
-    apply_demon_life_settlement(game_id)
-    update_demon_streak_after_game(game_id)
-    emancipate_slaves_after_game(game_id)
+        apply_demon_life_settlement(game_id)
+        update_demon_streak_after_game(game_id)
+        emancipate_slaves_after_game(game_id)
 
     creator_row = db_one("SELECT creator_id FROM games WHERE game_id=?", (game_id,))
     creator_id = int((creator_row[0] if creator_row else 0) or 0)
 
     totals_text, totals_kb = render_game_totals(game_id, creator_id)
-    edit_game_message(game_id, totals_text, reply_markup=totals_kb, parse_mode="HTML")
+    edit_game_message(game_id, totals_text, reply_markup=totals_kb, parse_mode="HTML", priority=EDIT_PRIO_FINAL)
 
 @bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("zero:"))
 def on_zero_callbacks(call: CallbackQuery):
@@ -8288,24 +10589,20 @@ def on_zero_callbacks(call: CallbackQuery):
     bot.answer_callback_query(call.id)
 
 # Итоги игры
-def build_totals_block(game_id: str, creator_id: int) -> str:
-    gt = db_one("SELECT COALESCE(game_type,'roulette') FROM games WHERE game_id=?", (game_id,))
-    game_type = (gt[0] if gt else "roulette") or "roulette"
+def build_totals_block(game_id: str, creator_id: int, view: Optional[GameView] = None) -> str:
+    if view is None:
+        view = load_game_view(game_id, results=True, zero=True)
+    game_type = (view.game_type if view else "roulette") or "roulette"
 
     if game_type == "zero":
         gen_nums = zero_parse_gen(game_id)
         gen_row = zero_format_gen_row(gen_nums, 5) if gen_nums else ""
 
         order = zero_get_order(game_id)
-
-        rows = db_all("""
-            SELECT gp.user_id, COALESCE(gr.delta_cents, 0) AS delta
-            FROM game_players gp
-            LEFT JOIN game_results gr
-              ON gr.game_id = gp.game_id AND gr.user_id = gp.user_id
-            WHERE gp.game_id=?
-        """, (game_id,))
-        delta_map = {int(uid): int(delta or 0) for (uid, delta) in rows}
+        missing = [u for u in order if int(u) not in view.users]
+        if missing:
+            view.users.update(get_users(missing))
+        delta_map = view.deltas
 
         lines = ["<b>⟢♣♦ Зеро-рулетка ♥♠⟣</b>"]
         if gen_row:
@@ -8317,21 +10614,16 @@ def build_totals_block(game_id: str, creator_id: int) -> str:
         lines.append("⟢♣♦ Итоги игры ♥♠⟣")
 
         for i, uid in enumerate(order, start=1):
-            u = get_user(uid)
+            u = view.user(uid)
             name = u[2] if u and u[2] else "Игрок"
             uname = u[1] if u and u[1] else ""
             tail = f" (@{html_escape(uname)})" if uname else ""
             lines.append(f"{i}. <b>{html_escape(name)}</b>{tail}")
 
-            picks = zero_get_picks(game_id, uid)
+            picks = view.picks.get(int(uid), [])
             cells = zero_format_cells(picks, 5)
 
-            oc = db_one(
-                "SELECT COALESCE(combo,''), COALESCE(mult,1.0) FROM zero_outcomes WHERE game_id=? AND user_id=?",
-                (game_id, int(uid))
-            )
-            combo = (oc[0] if oc else "") or ""
-            mult = float((oc[1] if oc else 1.0) or 1.0)
+            combo, mult = view.outcomes.get(int(uid), ("", 1.0))
             combo_part = ""
             if combo and mult > 1.01:
                 combo_part = f" | {html_escape(combo)} ×{int(round(mult))}"
@@ -8343,20 +10635,12 @@ def build_totals_block(game_id: str, creator_id: int) -> str:
         lines.append("Хотите отыграться?")
         return "\n".join(lines)
 
-    cur.execute("""
-        SELECT gp.user_id,
-               COALESCE(gr.delta_cents, 0) AS delta
-        FROM game_players gp
-        LEFT JOIN game_results gr
-          ON gr.game_id = gp.game_id AND gr.user_id = gp.user_id
-        WHERE gp.game_id=?
-    """, (game_id,))
-    rows = cur.fetchall()
+    rows = [(uid, view.deltas.get(uid, 0)) for uid, _st in view.players] if view else []
     rows.sort(key=lambda r: int(r[1] or 0), reverse=True)
 
     lines = ["⟢♣♦ Итоги игры ♥♠⟣"]
     for i, (uid, delta) in enumerate(rows, start=1):
-        u = get_user(uid)
+        u = view.user(uid)
         name = u[2] if u and u[2] else "Игрок"
         name_html = f"<b>{html_escape(name)}</b>"
         if uid == creator_id:
@@ -8368,12 +10652,11 @@ def build_totals_block(game_id: str, creator_id: int) -> str:
     return "\n".join(lines)
 
 def render_game_totals(game_id: str, creator_id: int) -> Tuple[str, InlineKeyboardMarkup]:
-    text = build_totals_block(game_id, creator_id)
+    view = load_game_view(game_id, results=True, zero=True, votes=True)
+    text = build_totals_block(game_id, creator_id, view)
 
-    cur.execute("SELECT COUNT(*) FROM rematch_votes WHERE game_id=? AND vote='yes'", (game_id,))
-    yes_n = int(cur.fetchone()[0])
-    cur.execute("SELECT COUNT(*) FROM rematch_votes WHERE game_id=? AND vote='no'", (game_id,))
-    no_n = int(cur.fetchone()[0])
+    yes_n = view.votes.get("yes", 0) if view else 0
+    no_n = view.votes.get("no", 0) if view else 0
 
     kb = InlineKeyboardMarkup()
     kb.add(InlineKeyboardButton(f"Да {yes_n}", callback_data=f"rematch:vote:{game_id}:yes"))
@@ -8404,7 +10687,7 @@ def start_rematch_from_votes(call: CallbackQuery, old_game_id: str, yes_set: set
 
     if len(yes_order) < 2:
         end_text = "Игра завершена. Недостаточно игроков для продолжения (нужно минимум 2 «Да»)."
-        edit_inline_or_message(call, end_text, reply_markup=None, parse_mode="HTML")
+        edit_inline_or_message(call, end_text, reply_markup=None, parse_mode="HTML", priority=EDIT_PRIO_FINAL)
         return
 
     new_creator = old_creator if old_creator in yes_set else yes_order[0]
@@ -8449,7 +10732,7 @@ def start_rematch_from_votes(call: CallbackQuery, old_game_id: str, yes_set: set
         if names:
             extra = "\n\nПокидают эту игру:\n" + "\n".join(names)
         end_text = "Игра завершена. Недостаточно игроков для продолжения." + extra
-        edit_inline_or_message(call, end_text, reply_markup=None, parse_mode="HTML")
+        edit_inline_or_message(call, end_text, reply_markup=None, parse_mode="HTML", priority=EDIT_PRIO_FINAL)
         return
 
     new_state = "life_wait" if pending_life else "playing"
@@ -8469,7 +10752,7 @@ def start_rematch_from_votes(call: CallbackQuery, old_game_id: str, yes_set: set
             if st == "need_life":
                cur.execute("INSERT OR IGNORE INTO life_wait (game_id, user_id, stake_cents) VALUES (?,?,?)", (new_game_id, uid, int(stake_cents))) 
 
-    conn.commit()
+    db_commit()
     shop_bind_players_for_game(new_game_id)
     
     if pending_life:
@@ -8526,7 +10809,7 @@ def start_rematch_from_votes(call: CallbackQuery, old_game_id: str, yes_set: set
         edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
 
 
-def edit_game_message(game_id: str, text: str, reply_markup=None, parse_mode="HTML"):
+def edit_game_message(game_id: str, text: str, reply_markup=None, parse_mode="HTML", priority: int = EDIT_PRIO_MENU):
     row = db_one("SELECT origin_chat_id, origin_message_id, origin_inline_id FROM games WHERE game_id=?", (game_id,))
     if not row:
         return
@@ -8537,43 +10820,22 @@ def edit_game_message(game_id: str, text: str, reply_markup=None, parse_mode="HT
     state = (g[1] if g else "") or ""
 
     if game_type == "zero" and state != "lobby" and zero_media_enabled():
-        try:
-            if inline_id:
-                bot.edit_message_caption(
-                    inline_message_id=inline_id,
-                    caption=text,
-                    parse_mode=parse_mode,
-                    reply_markup=reply_markup
-                )
-                return
-            if chat_id and msg_id:
-                bot.edit_message_caption(
-                    chat_id=chat_id,
-                    message_id=msg_id,
-                    caption=text,
-                    parse_mode=parse_mode,
-                    reply_markup=reply_markup
-                )
-                return
-        except Exception:
-            pass
+        if inline_id:
+            limited_edit_message_caption(caption=text, inline_id=inline_id, reply_markup=reply_markup,
+                                         parse_mode=parse_mode, priority=priority, fallback_text=True)
+        elif chat_id and msg_id:
+            limited_edit_message_caption(caption=text, chat_id=chat_id, msg_id=msg_id, reply_markup=reply_markup,
+                                         parse_mode=parse_mode, priority=priority, fallback_text=True)
+        return
 
     if inline_id:
-        limited_edit_message_text(text=text, inline_id=inline_id, reply_markup=reply_markup, parse_mode=parse_mode)
+        limited_edit_message_text(text=text, inline_id=inline_id, reply_markup=reply_markup, parse_mode=parse_mode, priority=priority)
     elif chat_id and msg_id:
-        limited_edit_message_text(text=text, chat_id=chat_id, msg_id=msg_id, reply_markup=reply_markup, parse_mode=parse_mode)
+        limited_edit_message_text(text=text, chat_id=chat_id, msg_id=msg_id, reply_markup=reply_markup, parse_mode=parse_mode, priority=priority)
 
 def refresh_lobbies_for_user(uid: int):
     """После регистрации обновляет все лобби, где пользователь находится как 'Аноним'."""
-    rows = db_all(
-        """
-        SELECT gp.game_id
-        FROM game_players gp
-        JOIN games g ON g.game_id = gp.game_id
-        WHERE gp.user_id=? AND g.state='lobby'
-        """,
-        (int(uid),),
-    )
+    rows = db_all(HOT_SQL["refresh_lobbies_for_user"], (int(uid),))
     for (game_id,) in rows:
         db_exec(
             "UPDATE game_players SET status='ready' WHERE game_id=? AND user_id=?",
@@ -8656,7 +10918,7 @@ def handle_join(call: CallbackQuery, game_id: str):
         return
 
     cur.execute("INSERT INTO game_players (game_id, user_id, status) VALUES (?,?,?)", (game_id, uid, "ready"))
-    conn.commit()
+    db_commit()
     text, kb = render_lobby(game_id)
     edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
     bot.answer_callback_query(call.id)
@@ -8676,7 +10938,7 @@ def handle_extend(call: CallbackQuery, game_id: str):
         return
 
     cur.execute("UPDATE games SET reg_extended=1, reg_ends_ts=? WHERE game_id=?", (int(reg_ends_ts) + 30, game_id))
-    conn.commit()
+    db_commit()
     text, kb = render_lobby(game_id)
     edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
     bot.answer_callback_query(call.id)
@@ -8704,7 +10966,8 @@ def handle_cancel(call: CallbackQuery, game_id: str):
             add_balance(uid, comp)
 
     cur.execute("UPDATE games SET state='cancelled' WHERE game_id=?", (game_id,))
-    conn.commit()
+    db_commit()
+    shop_snapshot_drop(game_id)
 
     creator_name = get_user(creator_id)[2] if get_user(creator_id) else "Инициатор"
     text = (
@@ -8747,7 +11010,7 @@ def handle_continue(call: CallbackQuery, game_id: str):
         rfmt = cross_format_for_round(r)
         cur.execute("UPDATE games SET state='playing', roulette_format=?, cross_round=?, turn_index=0 WHERE game_id=?",
                     (rfmt, r, game_id))
-        conn.commit()
+        db_commit()
 
 
         order = turn_order_get(game_id)
@@ -8775,7 +11038,7 @@ def handle_continue(call: CallbackQuery, game_id: str):
         stake_cents = int((cur.fetchone() or (0,))[0] or 0)
     
         cur.execute("UPDATE games SET state='playing', turn_index=0 WHERE game_id=?", (game_id,))
-        conn.commit()
+        db_commit()
         shop_bind_players_for_game(game_id)
         try:
             zero_init_game(game_id)
@@ -8799,7 +11062,7 @@ def handle_continue(call: CallbackQuery, game_id: str):
         return
 
     cur.execute("UPDATE games SET state='choose_format' WHERE game_id=?", (game_id,))
-    conn.commit()
+    db_commit()
 
     text = (
         "Выберите формат рулетки:\n"
@@ -8837,7 +11100,7 @@ def on_rematch_vote(call: CallbackQuery):
         VALUES (?,?,?)
         ON CONFLICT(game_id, user_id) DO UPDATE SET vote=excluded.vote
     """, (game_id, uid, vote))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT creator_id FROM games WHERE game_id=?", (game_id,))
     row = cur.fetchone()
     if not row:
@@ -8860,11 +11123,13 @@ def on_rematch_vote(call: CallbackQuery):
     yes_uids = {int(r[0]) for r in cur.fetchall()}
 
     cur.execute("UPDATE games SET state='finished' WHERE game_id=?", (game_id,))
-    conn.commit()
+    db_commit()
+    shop_snapshot_drop(game_id)
+    award_broken_mouth(game_id)
 
     if len(yes_uids) < 2:
         end_text = text + "\n\nИгра завершена. Недостаточно игроков для продолжения игры (нужно минимум 2 «Да»)."
-        edit_inline_or_message(call, end_text, reply_markup=None, parse_mode="HTML")
+        edit_inline_or_message(call, end_text, reply_markup=None, parse_mode="HTML", priority=EDIT_PRIO_FINAL)
     else:
         start_rematch_from_votes(call, game_id, yes_uids)
 
@@ -8893,7 +11158,7 @@ def on_rfmt(call: CallbackQuery):
         return
 
     cur.execute("UPDATE games SET roulette_format=?, state='playing', turn_index=0 WHERE game_id=?", (fmt, game_id))
-    conn.commit()
+    db_commit()
     shop_bind_players_for_game(game_id)
 
     order = turn_order_get(game_id)
@@ -8984,7 +11249,7 @@ def on_turn_begin(call: CallbackQuery):
         INSERT OR REPLACE INTO spins (game_id, user_id, stage, msg_chat_id, msg_id, inline_id, grid_text, started_ts)
         VALUES (?,?,?,?,?,?,?,?)
         """, (game_id, uid, "ready", call.message.chat.id, call.message.message_id, None, empty_grid, now_ts()))
-    conn.commit()
+    db_commit()
 
     edit_inline_or_message(call, text, reply_markup=kb, parse_mode="HTML")
     bot.answer_callback_query(call.id)
@@ -9012,11 +11277,11 @@ def on_spin_pull(call: CallbackQuery):
     
     db_exec("UPDATE spins SET stage='spinning' WHERE game_id=? AND user_id=?", (game_id, uid), commit=True)
     
-    def _edit(text: str, kb=None):
+    def _edit(text: str, kb=None, priority: int = EDIT_PRIO_FINAL):
         if inline_id:
-            limited_edit_message_text(text=text, inline_id=inline_id, reply_markup=kb, parse_mode="HTML")
+            limited_edit_message_text(text=text, inline_id=inline_id, reply_markup=kb, parse_mode="HTML", priority=priority)
         else:
-            limited_edit_message_text(text=text, chat_id=msg_chat_id, msg_id=msg_id, reply_markup=kb, parse_mode="HTML")
+            limited_edit_message_text(text=text, chat_id=msg_chat_id, msg_id=msg_id, reply_markup=kb, parse_mode="HTML", priority=priority)
 
     def run_spin():
         try:
@@ -9078,7 +11343,7 @@ def on_spin_pull(call: CallbackQuery):
                     + f"Ход: <u>{html_escape(pname)}</u>\n"
                     + stake_line
                 )
-                _edit(text, kb=None)
+                _edit(text, kb=None, priority=EDIT_PRIO_ANIM)
                 time.sleep(sleep_s)
                     
             final_state = make_rand_state()
@@ -9086,233 +11351,245 @@ def on_spin_pull(call: CallbackQuery):
             delta = int(calc_delta_state(final_state))
             raw_delta = delta
                     
-            # Сначала узнаём активные усиления (чтобы страховка могла отключить негативные эффекты)
-            active = shop_get_active_for_game(uid, game_id)
-            print("DEBUG boosts:", uid, game_id, active)
-            pepper_on = active.get("devil_pepper", 0) > 0
-            active_for_display = dict(active)
-            boosts_line = render_active_boosts_line(pname, active_for_display)
-            boosts_block = (boosts_line + "\n\n") if boosts_line else ""
-
-            if pepper_on: delta = int(delta) * 2
-
-            # Применение страховки или пакета
-            insured = (active.get("insurance", 0) > 0) or (active.get("paket", 0) > 0)
-            insurance_triggered = False
-            chip_triggered = False
-
-            if insured and int(delta) < 0:
-                protected_amt = abs(int(delta))
-
-                # Приоритет: пакет превращает минус в плюс
-                if active.get("paket", 0) > 0:
-                    chip_triggered = True
-                    shop_mark_used(uid, game_id, "paket")
-                    delta = protected_amt
-                else:
-                    insurance_triggered = True
-                    shop_mark_used(uid, game_id, "insurance")
-                    delta = 0
+            # Весь расчёт хода — одна транзакция: баланс, доля владельцев, результаты, статистика,
+            # ход/раунд, усиления, демоны и освобождение рабов коммитятся вместе.
+            pending_edit = None
+            with db_tx():
+                # Сначала узнаём активные усиления (чтобы страховка могла отключить негативные эффекты)
+                active = shop_get_active_for_game(uid, game_id)
+                print("DEBUG boosts:", uid, game_id, active)
+                pepper_on = active.get("devil_pepper", 0) > 0
+                active_for_display = dict(active)
+                boosts_line = render_active_boosts_line(pname, active_for_display)
+                boosts_block = (boosts_line + "\n\n") if boosts_line else ""
+
+                if pepper_on: delta = int(delta) * 2
+
+                # Применение страховки или пакета
+                insured = (active.get("insurance", 0) > 0) or (active.get("paket", 0) > 0)
+                insurance_triggered = False
+                chip_triggered = False
+
+                if insured and int(delta) < 0:
+                    protected_amt = abs(int(delta))
+
+                    # Приоритет: пакет превращает минус в плюс
+                    if active.get("paket", 0) > 0:
+                        chip_triggered = True
+                        shop_mark_used(uid, game_id, "paket")
+                        delta = protected_amt
+                    else:
+                        insurance_triggered = True
+                        shop_mark_used(uid, game_id, "insurance")
+                        delta = 0
 
-                # Общий шанс рабства
-                maybe_make_slave_by_shop_trigger(uid, protected_amt, game_id)
+                    # Общий шанс рабства
+                    maybe_make_slave_by_shop_trigger(uid, protected_amt, game_id)
             
-            # Для отображения усилений в тексте результата
-            active_for_display = dict(active)
-            boosts_line = render_active_boosts_line(pname, active_for_display)
-            boosts_block = (boosts_line + "\n\n") if boosts_line else ""
-
-            # Негативные "черепные долги" применяем только если НЕТ страховки
-            if not insured:
-                debt_mult = debt_mult_from_skulls(final_state, rfmt)
-                if debt_mult > 0:
-                    strow2 = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, uid))
-                    pstatus2 = (strow2[0] if strow2 else "") or ""
-                    player2 = get_user(uid)
-                    is_demon2 = (player2 and int(player2[7] or 0) == 1)
+                # Для отображения усилений в тексте результата
+                active_for_display = dict(active)
+                boosts_line = render_active_boosts_line(pname, active_for_display)
+                boosts_block = (boosts_line + "\n\n") if boosts_line else ""
+
+                # Негативные "черепные долги" применяем только если НЕТ страховки
+                if not insured:
+                    debt_mult = debt_mult_from_skulls(final_state, rfmt)
+                    if debt_mult > 0:
+                        strow2 = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, uid))
+                        pstatus2 = (strow2[0] if strow2 else "") or ""
+                        player2 = get_user(uid)
+                        is_demon2 = (player2 and int(player2[7] or 0) == 1)
                     
-                    if (not is_demon2) and (pstatus2 != "life"):
-                        bal_now = get_balance_cents(uid)
-                        debt_cents = int(debt_mult) * int(stake_now)
-                        predicted = bal_now + int(delta)
-                        target = -debt_cents
-                        final_balance = min(predicted, bal_now, target)
-                        delta = int(final_balance - bal_now)
-                        if final_balance < 0:
-                            set_slave_buyout(uid, abs(int(final_balance)) * 100) # назначение цены рабу
+                        if (not is_demon2) and (pstatus2 != "life"):
+                            bal_now = get_balance_cents(uid)
+                            debt_cents = int(debt_mult) * int(stake_now)
+                            predicted = bal_now + int(delta)
+                            target = -debt_cents
+                            final_balance = min(predicted, bal_now, target)
+                            delta = int(final_balance - bal_now)
+                            if final_balance < 0:
+                                set_slave_buyout(uid, abs(int(final_balance)) * 100) # назначение цены рабу
                     
-            # Дьявольский перец
-            if pepper_on and pepper_triggers_demon(final_state, rfmt):
-                rr_pep = db_one("SELECT user_id FROM users WHERE demon=1 ORDER BY RANDOM() LIMIT 1")
-                if rr_pep:
-                    demon_id = int(rr_pep[0])
-                    slavery_add_owner(uid, demon_id, 6000)
+                # Дьявольский перец
+                if pepper_on and pepper_triggers_demon(final_state, rfmt):
+                    rr_pep = db_one(HOT_SQL["random_demon"])
+                    if rr_pep:
+                        demon_id = int(rr_pep[0])
+                        slavery_add_owner(uid, demon_id, 6000)
             
-            u = get_user(uid)
-            is_demon = (u and int(u[7] or 0) == 1)
-            if not is_demon:
-                if delta > 0:
-                    kept = apply_slave_cut(uid, delta, reason="roulette")
-                    add_balance(uid, kept)
-                else:
-                    add_balance(uid, delta)
-                
-            if game_type == "cross":
-                db_exec("""
-                        INSERT INTO game_results (game_id, user_id, delta_cents, finished)
-                        VALUES (?,?,?,1)
-                        ON CONFLICT(game_id, user_id) DO UPDATE SET
-                            delta_cents = COALESCE(game_results.delta_cents, 0) + excluded.delta_cents,
-                            finished = 1
-                        """, (game_id, uid, int(delta)), commit=True)
-            else:
-                db_exec("""
-                        INSERT INTO game_results (game_id, user_id, delta_cents, finished)
-                        VALUES (?,?,?,1)
-                        ON CONFLICT(game_id, user_id) DO UPDATE SET delta_cents=excluded.delta_cents, finished=1
-                        """, (game_id, uid, int(delta)), commit=True)
+                u = get_user(uid)
+                is_demon = (u and int(u[7] or 0) == 1)
+                if not is_demon:
+                    if delta > 0:
+                        kept = apply_slave_cut(uid, delta, reason="roulette")
+                        add_balance(uid, kept)
+                    else:
+                        add_balance(uid, delta)
                 
-            if game_type != "cross":
-                db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,), commit=True)
-                if delta >= 0:
-                    db_exec(
-                        "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
-                        (int(delta), uid), commit=True
-                    )
-                else:
-                    db_exec(
-                        "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
-                        (int(abs(delta)), uid), commit=True
-                    )
-                bump_game_type_stat(uid, game_type)
-            elif int(cross_round) >= 9:
-                rr_tot = db_one("SELECT delta_cents FROM game_results WHERE game_id=? AND user_id=?", (game_id, uid))
-                tot = int((rr_tot[0] if rr_tot else 0) or 0)
-                db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,), commit=True)
-                if tot >= 0:
-                    db_exec(
-                        "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
-                        (int(tot), uid), commit=True
-                    )
+                if game_type == "cross":
+                    db_exec("""
+                            INSERT INTO game_results (game_id, user_id, delta_cents, finished)
+                            VALUES (?,?,?,1)
+                            ON CONFLICT(game_id, user_id) DO UPDATE SET
+                                delta_cents = COALESCE(game_results.delta_cents, 0) + excluded.delta_cents,
+                                finished = 1
+                            """, (game_id, uid, int(delta)), commit=True)
                 else:
-                    db_exec(
-                        "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
-                        (int(abs(tot)), uid), commit=True
-                    )
-                bump_game_type_stat(uid, game_type)
+                    db_exec("""
+                            INSERT INTO game_results (game_id, user_id, delta_cents, finished)
+                            VALUES (?,?,?,1)
+                            ON CONFLICT(game_id, user_id) DO UPDATE SET delta_cents=excluded.delta_cents, finished=1
+                            """, (game_id, uid, int(delta)), commit=True)
+                
+                if game_type != "cross":
+                    db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,), commit=True)
+                    if delta >= 0:
+                        db_exec(
+                            "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
+                            (int(delta), uid), commit=True
+                        )
+                    else:
+                        db_exec(
+                            "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
+                            (int(abs(delta)), uid), commit=True
+                        )
+                    bump_game_type_stat(uid, game_type)
+                elif int(cross_round) >= 9:
+                    rr_tot = db_one("SELECT delta_cents FROM game_results WHERE game_id=? AND user_id=?", (game_id, uid))
+                    tot = int((rr_tot[0] if rr_tot else 0) or 0)
+                    db_exec("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,), commit=True)
+                    if tot >= 0:
+                        db_exec(
+                            "UPDATE game_stats SET games_total=games_total+1, wins=wins+1, max_win_cents=MAX(max_win_cents, ?) WHERE user_id=?",
+                            (int(tot), uid), commit=True
+                        )
+                    else:
+                        db_exec(
+                            "UPDATE game_stats SET games_total=games_total+1, losses=losses+1, max_lose_cents=MAX(max_lose_cents, ?) WHERE user_id=?",
+                            (int(abs(tot)), uid), commit=True
+                        )
+                    bump_game_type_stat(uid, game_type)
 
-            order = turn_order_get(game_id)
-            if not order:
-                return
+                order = turn_order_get(game_id)
+                if not order:
+                    return
                     
-            if (not is_demon) and (pstatus == "life") and (delta < 0) and creator_id:
-                set_slave_buyout(uid, abs(delta) * 100) # назначение цены рабу
-                owner_id = pick_life_owner(game_id, int(uid), int(creator_id) if creator_id else None)
-                if owner_id and int(owner_id) != int(uid):
-                    db_exec("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (int(uid),), commit=True)
-                    db_exec("UPDATE slave_meta SET strikes=strikes+1 WHERE slave_id=?", (int(uid),), commit=True)
-                    existed = db_one("SELECT 1 FROM slavery WHERE slave_id=? AND owner_id=?", (int(uid), int(owner_id)))
-                    db_exec(
-                        "INSERT OR REPLACE INTO slavery (slave_id, owner_id, share_bp) VALUES (?,?,?)",
-                        (int(uid), int(owner_id), 6000), commit=True
-                    )
+                if (not is_demon) and (pstatus == "life") and (delta < 0) and creator_id:
+                    set_slave_buyout(uid, abs(delta) * 100) # назначение цены рабу
+                    owner_id = pick_life_owner(game_id, int(uid), int(creator_id) if creator_id else None)
+                    if owner_id and int(owner_id) != int(uid):
+                        db_exec("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (int(uid),), commit=True)
+                        db_exec("UPDATE slave_meta SET strikes=strikes+1 WHERE slave_id=?", (int(uid),), commit=True)
+                        existed = db_one("SELECT 1 FROM slavery WHERE slave_id=? AND owner_id=?", (int(uid), int(owner_id)))
+                        db_exec(
+                            "INSERT OR REPLACE INTO slavery (slave_id, owner_id, share_bp) VALUES (?,?,?)",
+                            (int(uid), int(owner_id), 6000), commit=True
+                        )
+                        status_invalidate(uid)
             
-                    if not existed:
-                        ou = get_user(int(owner_id))
-                        oname = (ou[2] if ou and ou[2] else "Игрок")
-                        oun = (ou[1] if ou and ou[1] else "")
-                        o_tag = f" (@{html_escape(oun)})" if oun else ""
-                        notify_safe(uid, f"Ты проиграл свою свободу. С этого момента ты личная собственность: <b>{html_escape(oname)}</b>{o_tag}")
-                
-            current_pos = int(turn_index) % len(order)
-            is_round_last = (current_pos == len(order) - 1)
+                        if not existed:
+                            ou = get_user(int(owner_id))
+                            oname = (ou[2] if ou and ou[2] else "Игрок")
+                            oun = (ou[1] if ou and ou[1] else "")
+                            o_tag = f" (@{html_escape(oun)})" if oun else ""
+                            notify_safe(uid, f"Ты проиграл свою свободу. С этого момента ты личная собственность: <b>{html_escape(oname)}</b>{o_tag}")
                 
-            header = "⟢♣♦ Рулетка ♥♠⟣" if game_type != "cross" else "⟢♣♦ Марафон рулетка ♥♠⟣"
-            round_line = f"Раунд: <b>{int(cross_round)}</b>\n" if game_type == "cross" else ""
-            result_line = f"Результат <u>{html_escape(pname)}</u>: <b>{cents_to_money_str(delta)}</b>$"
+                current_pos = int(turn_index) % len(order)
+                is_round_last = (current_pos == len(order) - 1)
                 
-            strow = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, uid))
-            pstatus = (strow[0] if strow else "") or ""
-            if pstatus == "life":
-                stake_line = "Ставка: <b>1000$</b>"
-            else:
-                stake_line = f"Ставка: <b>{cents_to_money_str(int(stake_now))}</b>$"
-                if game_type == "cross":
-                    stake_line += f" + <b>{cents_to_money_str(int(add_cents))}</b>$"
+                header = "⟢♣♦ Рулетка ♥♠⟣" if game_type != "cross" else "⟢♣♦ Марафон рулетка ♥♠⟣"
+                round_line = f"Раунд: <b>{int(cross_round)}</b>\n" if game_type == "cross" else ""
+                result_line = f"Результат <u>{html_escape(pname)}</u>: <b>{cents_to_money_str(delta)}</b>$"
+                
+                strow = db_one("SELECT status FROM game_players WHERE game_id=? AND user_id=?", (game_id, uid))
+                pstatus = (strow[0] if strow else "") or ""
+                if pstatus == "life":
+                    stake_line = "Ставка: <b>1000$</b>"
+                else:
+                    stake_line = f"Ставка: <b>{cents_to_money_str(int(stake_now))}</b>$"
+                    if game_type == "cross":
+                        stake_line += f" + <b>{cents_to_money_str(int(add_cents))}</b>$"
                 
-            if game_type == "cross" and is_round_last and int(cross_round) < 9:
-                next_round = int(cross_round) + 1
-                next_fmt = cross_format_for_round(next_round)
-                db_exec("UPDATE games SET cross_round=?, roulette_format=?, turn_index=0 WHERE game_id=?",
-                                    (next_round, next_fmt, game_id), commit=True)
+                if game_type == "cross" and is_round_last and int(cross_round) < 9:
+                    next_round = int(cross_round) + 1
+                    next_fmt = cross_format_for_round(next_round)
+                    db_exec("UPDATE games SET cross_round=?, roulette_format=?, turn_index=0 WHERE game_id=?",
+                                        (next_round, next_fmt, game_id), commit=True)
                 
-                order = turn_order_get(game_id)
-                next_uid = int(order[0]) if order else int(uid)
+                    order = turn_order_get(game_id)
+                    next_uid = int(order[0]) if order else int(uid)
 
-                next_user = get_user(next_uid)
-                next_name = next_user[2] if next_user and next_user[2] else "Игрок"
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton(f"Ход {next_name}", callback_data=cb_pack(f"turn:begin:{game_id}", next_uid)))
+                    next_user = get_user(next_uid)
+                    next_name = next_user[2] if next_user and next_user[2] else "Игрок"
+                    kb = InlineKeyboardMarkup()
+                    kb.add(InlineKeyboardButton(f"Ход {next_name}", callback_data=cb_pack(f"turn:begin:{game_id}", next_uid)))
                 
-                final_text = (
-                    (f"<b>{header}</b>\n" + round_line + f"<b>Режим {title}</b>\n\n")
-                    + f"{final_grid}\n\n"
-                    + f"{result_line}\n"
-                    + f"{stake_line}\n\n"
-                    + boosts_block
-                    + f"Следующий раунд: <b>{next_round}</b>"
-                )
-                _edit(final_text, kb=kb)
+                    final_text = (
+                        (f"<b>{header}</b>\n" + round_line + f"<b>Режим {title}</b>\n\n")
+                        + f"{final_grid}\n\n"
+                        + f"{result_line}\n"
+                        + f"{stake_line}\n\n"
+                        + boosts_block
+                        + f"Следующий раунд: <b>{next_round}</b>"
+                    )
+                    pending_edit = (final_text, kb)
                 
-            elif is_round_last:
-                db_exec("UPDATE games SET state='finished' WHERE game_id=?", (game_id,), commit=True)
-                try:
-                    for pid in set(order):
-                        shop_tick_after_game(int(pid), game_id)
-                except Exception:
-                    pass
+                elif is_round_last:
+                    db_exec("UPDATE games SET state='finished' WHERE game_id=?", (game_id,), commit=True)
+                    shop_snapshot_drop(game_id)
+                    if game_type == "cross":
+                        award_broken_mouth(game_id)
+                    try:
+                        for pid in set(order):
+                            shop_tick_after_game(int(pid), game_id)
+                    except Exception:
+                        pass
             
-                apply_demon_life_settlement(game_id)
-                update_demon_streak_after_game(game_id)   
-                emancipate_slaves_after_game(game_id)
+                    apply_demon_life_settlement(game_id)
+                    update_demon_streak_after_game(game_id)   
+                    emancipate_slaves_after_game(game_id)
                 
-                rr2 = db_one("SELECT creator_id FROM games WHERE game_id=?", (game_id,))
-                creator_id2 = int((rr2[0] if rr2 else 0) or 0)
-                totals_text, totals_kb = render_game_totals(game_id, creator_id2)
+                    rr2 = db_one("SELECT creator_id FROM games WHERE game_id=?", (game_id,))
+                    creator_id2 = int((rr2[0] if rr2 else 0) or 0)
+                    totals_text, totals_kb = render_game_totals(game_id, creator_id2)
                 
-                final_text = (
-                    (f"<b>{header}</b>\n" + round_line + f"<b>Режим {title}</b>\n\n")
-                    + f"{final_grid}\n\n"
-                    + f"{result_line}\n"
-                    + f"{stake_line}\n\n"
-                    + boosts_block
-                    + f"{totals_text}"
-                )
-                _edit(final_text, kb=totals_kb)
+                    final_text = (
+                        (f"<b>{header}</b>\n" + round_line + f"<b>Режим {title}</b>\n\n")
+                        + f"{final_grid}\n\n"
+                        + f"{result_line}\n"
+                        + f"{stake_line}\n\n"
+                        + boosts_block
+                        + f"{totals_text}"
+                    )
+                    pending_edit = (final_text, totals_kb)
                 
-            else:
-                next_index = current_pos + 1
-                next_uid = order[next_index]
-                next_user = get_user(next_uid)
-                next_name = next_user[2] if next_user and next_user[2] else "Игрок"
+                else:
+                    next_index = current_pos + 1
+                    next_uid = order[next_index]
+                    next_user = get_user(next_uid)
+                    next_name = next_user[2] if next_user and next_user[2] else "Игрок"
                 
-                db_exec("UPDATE games SET turn_index=? WHERE game_id=?", (next_index, game_id), commit=True)
+                    db_exec("UPDATE games SET turn_index=? WHERE game_id=?", (next_index, game_id), commit=True)
                 
-                kb = InlineKeyboardMarkup()
-                kb.add(InlineKeyboardButton(
-                    f"Ход {next_name}",
-                    callback_data=cb_pack(f"turn:begin:{game_id}", next_uid)
-                ))
+                    kb = InlineKeyboardMarkup()
+                    kb.add(InlineKeyboardButton(
+                        f"Ход {next_name}",
+                        callback_data=cb_pack(f"turn:begin:{game_id}", next_uid)
+                    ))
                 
-                text = (
-                    (f"<b>{header}</b>\n" + round_line + f"<b>Режим {title}</b>\n\n")
-                    + f"{final_grid}\n\n"
-                    + f"{result_line}\n"
-                    + f"{stake_line}\n\n"
-                    + boosts_block
-                )
-                _edit(text, kb=kb)
+                    text = (
+                        (f"<b>{header}</b>\n" + round_line + f"<b>Режим {title}</b>\n\n")
+                        + f"{final_grid}\n\n"
+                        + f"{result_line}\n"
+                        + f"{stake_line}\n\n"
+                        + boosts_block
+                    )
+                    pending_edit = (text, kb)
         
+
+            if pending_edit:
+                _edit(pending_edit[0], kb=pending_edit[1])
+
         except Exception as e:
             try:
                 print("run_spin crashed:", repr(e))
@@ -9353,7 +11630,7 @@ def on_life_accept(call: CallbackQuery):
         return
 
     cur.execute("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (clicker,))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT COALESCE(life_uses,0) FROM slave_meta WHERE slave_id=?", (clicker,))
     life_uses = int((cur.fetchone() or (0,))[0] or 0)
     if life_uses >= MAX_LIFE_STAKES:
@@ -9380,13 +11657,13 @@ def on_life_accept(call: CallbackQuery):
 
     cur.execute("UPDATE game_players SET status='life' WHERE game_id=? AND user_id=?", (game_id, clicker))
     cur.execute("DELETE FROM life_wait WHERE game_id=? AND user_id=?", (game_id, clicker))
-    conn.commit()
+    db_commit()
 
     cur.execute("SELECT COUNT(*) FROM life_wait WHERE game_id=?", (game_id,))
     pending = int(cur.fetchone()[0] or 0)
     if pending == 0:
         cur.execute("UPDATE games SET state='playing' WHERE game_id=?", (game_id,))
-        conn.commit()
+        db_commit()
 
         order = turn_order_get(game_id)
         if len(order) >= 2:
@@ -9412,16 +11689,16 @@ def on_life_accept(call: CallbackQuery):
     bot.answer_callback_query(call.id, "С вами приятно иметь дело.")
 
 def is_slave(uid: int) -> bool:
-    cur.execute("SELECT 1 FROM slavery WHERE slave_id=? LIMIT 1", (uid,))
+    cur.execute(HOT_SQL["is_slave"], (uid,))
     return cur.fetchone() is not None
 
 def owns_slaves(uid: int) -> bool:
-    cur.execute("SELECT 1 FROM slavery WHERE owner_id=? LIMIT 1", (uid,))
+    cur.execute(HOT_SQL["owns_slaves"], (uid,))
     return cur.fetchone() is not None
 
 def get_game_stats(uid: int) -> Tuple[int,int,int,int,int]:
     cur.execute("INSERT OR IGNORE INTO game_stats (user_id) VALUES (?)", (uid,))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT games_total, wins, losses, max_win_cents, max_lose_cents FROM game_stats WHERE user_id=?", (uid,))
     row = cur.fetchone()
     return tuple(int(x or 0) for x in row)
@@ -9431,11 +11708,7 @@ def build_profile_summary_text(view_uid: int) -> Optional[str]:
     if not u or not u[2]:
         return None
 
-    cur.execute("SELECT user_id FROM users WHERE demon=0")
-    uids = [int(r[0]) for r in cur.fetchall()]
-    uids.sort(key=lambda x: top_value_cents(x), reverse=True)
-
-    place = (uids.index(int(view_uid)) + 1) if (int(u[7] or 0) == 0 and int(view_uid) in uids) else "-"
+    place = (LEADERBOARD.rank(int(view_uid)) or "-") if int(u[7] or 0) == 0 else "-"
     status = compute_status(int(view_uid))
 
     base = (
@@ -9523,6 +11796,7 @@ def slavery_add_owner(slave_id: int, owner_id: int, share_bp: int = 6000) -> boo
         (ts, slave_id, owner_id),
         commit=True
     )
+    status_invalidate(slave_id)
 
     inserted = (rc or 0) > 0
     return inserted and (not existed)
@@ -9530,10 +11804,7 @@ def slavery_add_owner(slave_id: int, owner_id: int, share_bp: int = 6000) -> boo
 def slave_profit_lasth(slave_id: int, owner_id: int) -> int:
     """Сумма выплат от раба владельцу за последние часы."""
     ts0 = now_ts() - 4 * 3600 # время последней выплаты
-    row = db_one(
-        "SELECT COALESCE(SUM(amount_cents),0) FROM slave_earn_log WHERE slave_id=? AND owner_id=? AND ts>=?",
-        (int(slave_id), int(owner_id), int(ts0))
-    )
+    row = db_one(HOT_SQL["slave_profit_lasth"], (int(slave_id), int(owner_id), int(ts0)))
     return int((row[0] if row else 0) or 0)
 
 def slave_last_credit(slave_id: int, owner_id: int) -> Optional[int]:
@@ -9541,12 +11812,12 @@ def slave_last_credit(slave_id: int, owner_id: int) -> Optional[int]:
     Последнее зачисление (в центах), которое этот раб перечислил конкретному владельцу.
     Если начислений не было — None.
     """
-    row = db_one(
-        "SELECT amount_cents FROM slave_earn_log "
-        "WHERE slave_id=? AND owner_id=? "
-        "ORDER BY ts DESC LIMIT 1",
-        (int(slave_id), int(owner_id))
-    )
+    row = db_one(HOT_SQL["slave_last_credit"], (int(slave_id), int(owner_id)))
+    if not row:
+        row = db_one(
+            "SELECT last_amount_cents FROM slave_earn_rollup WHERE slave_id=? AND owner_id=? AND cnt>0",
+            (int(slave_id), int(owner_id))
+        )
     if not row:
         return None
     return int(row[0] or 0)
@@ -9647,24 +11918,28 @@ def get_slave_owners(slave_id: int):
     return [(int(o), int(bp or 0)) for (o, bp) in rows]
 
 def notify_safe(uid: int, text: str):
-    try:
-        bot.send_message(int(uid), text, parse_mode="HTML")
-    except Exception:
-        pass
+    def _send():
+        try:
+            bot.send_message(int(uid), text, parse_mode="HTML")
+        except Exception:
+            pass
+    db_after_commit(_send)
 
 def remove_owner_from_slave(slave_id: int, owner_id: int) -> bool:
     cur.execute("SELECT 1 FROM slavery WHERE slave_id=? AND owner_id=?", (int(slave_id), int(owner_id)))
     existed = cur.fetchone() is not None
     if existed:
         cur.execute("DELETE FROM slavery WHERE slave_id=? AND owner_id=?", (int(slave_id), int(owner_id)))
-        conn.commit()
+        db_commit()
+        status_invalidate(slave_id)
     return existed
 
 def free_slave_fully(slave_id: int, reason: str):
     """Полное освобождение: удаляем все доли владельцев + обнуляем buyout."""
     owners = get_slave_owners(slave_id)
     cur.execute("DELETE FROM slavery WHERE slave_id=?", (int(slave_id),))
-    conn.commit()
+    db_commit()
+    status_invalidate(slave_id)
     clear_slave_buyout(slave_id)
 
     su = get_user(slave_id)
@@ -9889,16 +12164,12 @@ def apply_demon_life_settlement(game_id: str):
         set_slave_buyout(loser_id, int(demon_bal) * 25) # цена выкупа
 
         if inserted:
-            try:
-                un = l[3] if l else ""
-                uname = f" (@{un})" if un else ""
-                bot.send_message(
-                    loser_id,
-                    f"Ты проиграл свою свободу. С этого момента ты личная собственность <b>{html_escape(w[2] or 'Демон')}</b>{uname}",
-                    parse_mode="HTML"
-                )
-            except Exception:
-                pass
+            un = l[3] if l else ""
+            uname = f" (@{un})" if un else ""
+            notify_safe(
+                loser_id,
+                f"Ты проиграл свою свободу. С этого момента ты личная собственность <b>{html_escape(w[2] or 'Демон')}</b>{uname}"
+            )
         return
 
     # демон победил демона: победителю отправляем список рабов проигравшего (команда /get)
@@ -9925,10 +12196,13 @@ def apply_demon_life_settlement(game_id: str):
 
         lines.append("")
         lines.append("Забрать раба: /get @username")
-        try:
-            bot.send_message(winner_id, "\n".join(lines))
-        except Exception:
-            pass
+
+        def _send_loot():
+            try:
+                bot.send_message(winner_id, "\n".join(lines))
+            except Exception:
+                pass
+        db_after_commit(_send_loot)
 
 # DEV COMMANDS
 @bot.message_handler(commands=["devil"])
@@ -9941,19 +12215,20 @@ def cmd_devil(message):
     target = message.from_user.id
     if len(parts) >= 2 and parts[1].startswith("@"):
         uname = parts[1][1:]
-        cur.execute("SELECT user_id FROM users WHERE username=?", (uname,))
+        cur.execute(HOT_SQL["user_id_by_username"], (uname,))
         r = cur.fetchone()
         if r:
             target = int(r[0])
     upsert_user(target, None)
     cur.execute("UPDATE users SET demon=1 WHERE user_id=?", (target,))
-    conn.commit()
+    db_commit()
+    LEADERBOARD.touch(target)
     bot.reply_to(message, "Статус \"Демон\" установлен.")
 
 def _work_daemon():
     while True:
         try:
-            cur.execute("SELECT user_id FROM work_shift WHERE ends_ts <= ?", (now_ts(),))
+            cur.execute(HOT_SQL["_work_daemon"], (now_ts(),))
             uids = [int(r[0]) for r in cur.fetchall()]
             for uid in uids:
                 finish_shift(uid)
@@ -9961,10 +12236,20 @@ def _work_daemon():
             send_error_report("_work_daemon")
         time.sleep(2)
 
+def _dbprof_dump_daemon():
+    while True:
+        time.sleep(DB_PROFILE_DUMP_SEC)
+        try:
+            if DB_PROF.enabled:
+                DB_PROF.dump(DB_PROFILE_PATH)
+        except Exception:
+            pass
+
 # Димоны
 threading.Thread(target=_work_daemon, daemon=True).start()
 threading.Thread(target=_mail_daemon, daemon=True).start()
 threading.Thread(target=_pm_autodelete_daemon, daemon=True).start()
+threading.Thread(target=_dbprof_dump_daemon, daemon=True).start()
 
 @bot.message_handler(commands=["human"])
 def cmd_human(message):
@@ -9976,7 +12261,7 @@ def cmd_human(message):
     target = message.from_user.id
     if len(parts) >= 2 and parts[1].startswith("@"):
         uname = parts[1][1:]
-        cur.execute("SELECT user_id FROM users WHERE username=?", (uname,))
+        cur.execute(HOT_SQL["user_id_by_username"], (uname,))
         r = cur.fetchone()
         if r:
             target = int(r[0])
@@ -9984,7 +12269,8 @@ def cmd_human(message):
     r = cur.fetchone()
     gift = int(r[0] or 0) if r else 0
     cur.execute("UPDATE users SET demon=0, balance_cents=? WHERE user_id=?", (gift, target))
-    conn.commit()
+    db_commit()
+    LEADERBOARD.touch(target)
     bot.reply_to(message, "Статус \"Демон\" снят, профиль откатан.")
 
 @bot.message_handler(commands=["finance"])
@@ -10030,7 +12316,7 @@ def cmd_finance(message):
     payload = base64.urlsafe_b64encode((comment or "").encode("utf-8")).decode("ascii")
 
     if mode == "single":
-        r = db_one("SELECT user_id FROM users WHERE username=?", (uname,))
+        r = db_one(HOT_SQL["user_id_by_username"], (uname,))
         if not r:
             bot.reply_to(message, "Пользователь не найден в базе.")
             return
@@ -10109,7 +12395,7 @@ def cmd_take(message):
     if amt < 0:
         amt = -amt
 
-    r = db_one("SELECT user_id FROM users WHERE username=?", (uname,))
+    r = db_one(HOT_SQL["user_id_by_username"], (uname,))
     if not r:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10140,7 +12426,7 @@ def cmd_addstatus(message):
         return
 
     uname = target[1:].strip()
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(HOT_SQL["user_id_by_username"], (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10228,7 +12514,7 @@ def cmd_work(message):
     uname = parts[1][1:].strip()
     job_query = parts[2].strip() if len(parts) >= 3 else ""
 
-    r = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    r = db_one(HOT_SQL["user_id_by_username"], (uname,))
     if not r:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10299,7 +12585,7 @@ def cmd_delstat(message):
         return
 
     uname = parts[1][1:].strip()
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(HOT_SQL["user_id_by_username"], (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10733,7 +13019,7 @@ def cmd_del(message):
         return
 
     uname = parts[1][1:].strip()
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(HOT_SQL["user_id_by_username"], (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10758,6 +13044,7 @@ def cmd_del(message):
 
             c.execute("DELETE FROM slavery WHERE slave_id=? OR owner_id=?", (target_id, target_id))
             c.execute("DELETE FROM slave_earn_log WHERE slave_id=? OR owner_id=?", (target_id, target_id))
+            c.execute("DELETE FROM slave_earn_rollup WHERE slave_id=? OR owner_id=?", (target_id, target_id))
             c.execute("DELETE FROM slave_meta WHERE slave_id=?", (target_id,))
 
             c.execute("DELETE FROM demon_loot WHERE winner_id=? OR loser_id=? OR slave_id=?",
@@ -10775,10 +13062,12 @@ def cmd_del(message):
             c.execute("DELETE FROM work_stats WHERE user_id=?", (target_id,))
             c.execute("DELETE FROM work_shift WHERE user_id=?", (target_id,))
             c.execute("DELETE FROM work_history WHERE user_id=?", (target_id,))
+            c.execute("DELETE FROM work_history_rollup WHERE user_id=?", (target_id,))
 
             c.execute("DELETE FROM shop_inv WHERE user_id=?", (target_id,))
             c.execute("DELETE FROM shop_active WHERE user_id=?", (target_id,))
             c.execute("DELETE FROM shop_bind WHERE user_id=?", (target_id,))
+            shop_effects_invalidate(target_id)
             c.execute("DELETE FROM shop_used WHERE user_id=?", (target_id,))
 
             c.execute("DELETE FROM continue_tokens WHERE user_id=?", (target_id,))
@@ -10789,6 +13078,7 @@ def cmd_del(message):
             c.execute("DELETE FROM credit_loans WHERE user_id=?", (target_id,))
 
             c.execute("DELETE FROM user_custom_status WHERE user_id=?", (target_id,))
+            c.execute("DELETE FROM user_achievements WHERE user_id=?", (target_id,))
             c.execute("DELETE FROM transfers WHERE from_id=? OR to_id=?", (target_id, target_id))
 
             c.execute("DELETE FROM game_players WHERE user_id=?", (target_id,))
@@ -10797,7 +13087,7 @@ def cmd_del(message):
             c.execute("DELETE FROM users WHERE user_id=?", (target_id,))
 
             for sid in affected_slaves:
-                c.execute("SELECT 1 FROM slavery WHERE slave_id=? LIMIT 1", (sid,))
+                c.execute(HOT_SQL["is_slave"], (sid,))
                 still_slave = c.fetchone() is not None
                 if not still_slave:
                     c.execute("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (sid,))
@@ -10817,6 +13107,7 @@ def cmd_del(message):
             except Exception:
                 pass
 
+    LEADERBOARD.remove(target_id)
     bot.reply_to(message, f"Готово. Пользователь @{uname} полностью удалён из базы.")
 
 @bot.message_handler(commands=["ban"])
@@ -10853,7 +13144,7 @@ def cmd_ban(message):
     reason = reason_nl if reason_nl else extra_reason
     reason = (reason or "").strip()
 
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(HOT_SQL["user_id_by_username"], (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10902,7 +13193,7 @@ def cmd_unban(message):
     uname = (m.group(1) or "").strip()
     reason = (m.group(2) or "").strip()
 
-    rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (uname,))
+    rr = db_one(HOT_SQL["user_id_by_username"], (uname,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -10940,7 +13231,7 @@ def cmd_add_admin(message):
         if len(parts) >= 2:
             ref = parts[1].strip()
             if ref.startswith("@"):
-                rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (ref[1:],))
+                rr = db_one(HOT_SQL["user_id_by_username"], (ref[1:],))
                 target_id = int(rr[0]) if rr else None
             elif ref.isdigit():
                 target_id = int(ref)
@@ -10980,7 +13271,7 @@ def cmd_remove_admin(message):
         if len(parts) >= 2:
             ref = parts[1].strip()
             if ref.startswith("@"):
-                rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (ref[1:],))
+                rr = db_one(HOT_SQL["user_id_by_username"], (ref[1:],))
                 target_id = int(rr[0]) if rr else None
             elif ref.isdigit():
                 target_id = int(ref)
@@ -11010,12 +13301,334 @@ def cmd_db(message):
         bot.reply_to(message, "Команда /db доступна только в личных сообщениях с ботом.")
         return
 
+    # /db — свежий согласованный снимок, /db last — последний готовый бэкап, /db status — сводка
+    parts = (message.text or "").split()
+    arg = parts[1].lower() if len(parts) >= 2 else ""
+
+    if arg == "status":
+        st = BACKUP_ENGINE.last
+        lines = [
+            "💾 Бэкапы БД",
+            f"Запусков: <b>{BACKUP_ENGINE.runs}</b>, ошибок: {BACKUP_ENGINE.failures}"
+            + (" (идёт сейчас)" if BACKUP_ENGINE.busy() else ""),
+            f"Расписание: {'каждые ' + str(BACKUP_EVERY_SEC // 60) + ' мин' if BACKUP_EVERY_SEC > 0 else 'выключено'}, хранится {BACKUP_KEEP}",
+            f"Файлов: <b>{len(BACKUP_ENGINE.list())}</b>",
+        ]
+        if st:
+            lines += [
+                "",
+                f"Последний: <code>{html_escape(os.path.basename(st['path']))}</code> ({html_escape(st['reason'])})",
+                f"Страниц: {st['pages']}, пачек: {st['steps']}",
+                f"Размер: {st['raw_bytes'] // 1024} КБ → {st['gz_bytes'] // 1024} КБ",
+                f"Копирование: {st['copy_ms']} мс, сжатие: {st['gzip_ms']} мс",
+                f"DB_LOCK: всего {st['lock_held_ms']} мс, макс за пачку {st['lock_max_ms']} мс",
+            ]
+        bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+        return
+
     try:
-        with open(DB_PATH, "rb") as f:
-            bot.send_document(message.chat.id, f, caption="База данных бота")
+        if arg == "last":
+            files = BACKUP_ENGINE.list()
+            if not files:
+                bot.reply_to(message, "Готовых бэкапов нет.")
+                return
+            path = files[-1]
+        else:
+            path = BACKUP_ENGINE.run("/db")
+        with open(path, "rb") as f:
+            bot.send_document(message.chat.id, f, caption=f"База данных бота ({os.path.basename(path)})")
     except Exception as e:
         bot.reply_to(message, f"Не удалось отправить базу данных: {e}")
 
+@bot.message_handler(commands=["archive"])
+def cmd_archive(message):
+    """/archive — сводка, /archive run — перенести старые строки в архив сейчас."""
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+
+    parts = (message.text or "").split()
+    if len(parts) >= 2 and parts[1].lower() == "run":
+        if ARCHIVER.busy():
+            bot.reply_to(message, "Архивация уже идёт.")
+            return
+        bot.reply_to(message, "Архивация запущена.")
+
+        def _job():
+            try:
+                res = ARCHIVER.run("/archive")
+                moved = ", ".join(f"{k}: {v}" for k, v in sorted(res["moved"].items())) or "нечего переносить"
+                bot.send_message(message.chat.id, f"📦 Архивация за {res['ms']} мс\n{moved}")
+            except Exception as e:
+                bot.send_message(message.chat.id, f"Архивация не удалась: {e}")
+
+        threading.Thread(target=_job, daemon=True).start()
+        return
+
+    lines = [
+        "📦 Архив",
+        f"Горизонт: {ARCHIVE_DAYS} дн. (удалённые ЛС — {ARCHIVE_PM_DAYS} дн.), "
+        f"расписание: {'каждые ' + str(ARCHIVE_EVERY_SEC // 60) + ' мин' if ARCHIVE_EVERY_SEC > 0 else 'выключено'}",
+        f"Запусков: <b>{ARCHIVER.runs}</b>, ошибок: {ARCHIVER.failures}" + (" (идёт сейчас)" if ARCHIVER.busy() else ""),
+    ]
+    try:
+        lines.append(f"Файл архива: {os.path.getsize(ARCHIVE_DB_PATH) // 1024} КБ")
+    except Exception:
+        pass
+    if ARCHIVER.moved:
+        lines.append("Перенесено всего: " + ", ".join(f"{k} {v}" for k, v in sorted(ARCHIVER.moved.items())))
+    last = ARCHIVER.last
+    if last:
+        moved = ", ".join(f"{k} {v}" for k, v in sorted(last["moved"].items())) or "ничего"
+        lines.append(f"Последний ({html_escape(last['reason'])}): {last['ms']} мс — {moved}")
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+
+@bot.message_handler(commands=["dbpool"])
+def cmd_dbpool(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+
+    st = db_pool_stats()
+    lines = [
+        "🗄 Пул чтения БД",
+        f"Соединений: <b>{st['opened']}</b>/{st['size']} (свободно {st['idle']})",
+        f"Выдач: <b>{st['checkouts']}</b>, с ожиданием: <b>{st['waits']}</b>",
+        f"Ожидание: всего {st['wait_total_ms']} мс, среднее {st['wait_avg_ms']} мс, макс {st['wait_max_ms']} мс",
+        f"Чтений через писателя: <b>{st['writer_reads']}</b>",
+    ]
+    ws = db_writer_stats()
+    lines += [
+        "",
+        "✍️ Очередь записи",
+        f"В очереди: <b>{ws['pending']}</b>, записей: <b>{ws['jobs']}</b>, ошибок: {ws['errors']}",
+        f"Коммитов: <b>{ws['batches']}</b>, записей на коммит: {ws['avg_batch']} (макс {ws['max_batch']})",
+        f"Коммит: среднее {ws['commit_avg_ms']} мс",
+        f"Ждали чужую транзакцию: {ws['foreign_waits']} (дольше {DB_WRITE_FOREIGN_REPORT_SEC:g} с: {ws['foreign_timeouts']})",
+        f"db_tx ждали чужую транзакцию: {DB_TX_FOREIGN_STATS['waits']} (не дождались: {DB_TX_FOREIGN_STATS['timeouts']})",
+    ]
+    us = USER_CACHE.stats()
+    lines += [
+        "",
+        "👤 Кэш пользователей",
+        f"Записей: <b>{us['size']}</b>/{us['max']}, TTL {us['ttl']:g} с",
+        f"Попаданий: <b>{us['hits']}</b> ({us['hit_pct']}%), промахов: {us['misses']}, "
+        f"сбросов: {us['invalidations']}, пропущено заполнений: {us['skipped_fills']}",
+    ]
+    gs = GROUP_SEEN_STATS
+    lines.append(
+        f"Групповые чаты: отметок {gs['calls']}, сразу записано {gs['writes']}, "
+        f"сбросов {gs['flushes']} ({gs['flushed_rows']} строк), в очереди {len(_GROUP_SEEN_PENDING)}"
+    )
+    ps = POLICY_CACHE.stats()
+    lines.append(
+        f"Политики (баны/админы/настройки/состояния): {ps['size']} записей, "
+        f"попаданий {ps['hits']} ({ps['hit_pct']}%), промахов {ps['misses']}, сбросов {ps['invalidations']}"
+    )
+    ks = KNOWN_USERS.stats()
+    lines.append(
+        f"upsert_user: записей {ks['writes']}, пропущено {ks['skipped']}; известных {ks['size']}, "
+        f"сверок {ks['reconciles']}, расхождений {ks['drift']}"
+    )
+    cs = CHECKPOINTER.stats()
+    last = cs["last"]
+    lines += [
+        "",
+        "🧾 WAL / чекпоинты",
+        f"WAL: <b>{cs['wal_kb']}</b> КБ (макс {cs['wal_max_kb']} КБ), рост {cs['rate_kbps']} КБ/с",
+        f"PASSIVE {cs['runs'].get('PASSIVE', 0)}, RESTART {cs['runs'].get('RESTART', 0)}, "
+        f"TRUNCATE {cs['runs'].get('TRUNCATE', 0)}; busy {cs['busy']}, ошибок {cs['errors']}",
+        f"Кадров перенесено: <b>{cs['frames']}</b>, время: среднее {cs['avg_ms']} мс, макс {cs['max_ms']} мс",
+    ]
+    if last:
+        lines.append(
+            f"Последний: {last['mode']}, {last['ms']} мс, кадров {last['moved']} "
+            f"({last['ckpt']}/{last['log']}{', busy' if last['busy'] else ''})"
+        )
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+
+@bot.message_handler(commands=["dbprof"])
+def cmd_dbprof(message):
+    """
+    /dbprof            — топ-15 запросов по суммарному времени
+    /dbprof N [поле]   — топ-N, сортировка по total_ms/wait_ms/count/p95_ms/max_ms/rows
+    /dbprof on|off|reset|dump
+    """
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+
+    parts = (message.text or "").split()
+    arg = parts[1].lower() if len(parts) >= 2 else ""
+    if arg in ("on", "off"):
+        DB_PROF.enabled = (arg == "on")
+        if DB_PROF.enabled:
+            DB_PROF.reset()
+        bot.send_message(message.chat.id, f"Профайлер БД: {'включён' if DB_PROF.enabled else 'выключен'}.")
+        return
+    if arg == "reset":
+        DB_PROF.reset()
+        bot.send_message(message.chat.id, "Профайлер БД: статистика сброшена.")
+        return
+    if arg == "dump":
+        try:
+            DB_PROF.dump(DB_PROFILE_PATH)
+            bot.send_message(message.chat.id, f"Профайлер БД: записано в {DB_PROFILE_PATH}")
+        except Exception as e:
+            bot.send_message(message.chat.id, f"Профайлер БД: не удалось записать: {e}")
+        return
+
+    top = int(arg) if arg.isdigit() else 15
+    key = parts[2].lower() if len(parts) >= 3 else "total_ms"
+    if key not in ("total_ms", "wait_ms", "count", "p50_ms", "p95_ms", "max_ms", "rows"):
+        key = "total_ms"
+
+    rows = DB_PROF.report(min(top, 40), key=key)
+    state = "включён" if DB_PROF.enabled else "выключен (/dbprof on)"
+    lines = [f"⏱ Профайлер БД: {state}", f"Сортировка: {key}", ""]
+    if not rows:
+        lines.append("Нет данных.")
+    size = sum(len(x) + 1 for x in lines)
+    for i, r in enumerate(rows, 1):
+        sql = r["sql"] if len(r["sql"]) <= 160 else r["sql"][:157] + "..."
+        item = (
+            f"{i}. <b>{r['total_ms']}</b> мс, ожид. {r['wait_ms']} мс, ×{r['count']}, "
+            f"p50 {r['p50_ms']} / p95 {r['p95_ms']} / max {r['max_ms']} мс, строк {r['rows']}\n"
+            f"<code>{html_escape(sql)}</code>"
+        )
+        size += len(item) + 1
+        if size > 3900:
+            break
+        lines.append(item)
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+
+@bot.message_handler(commands=["ranksnap"])
+def cmd_ranksnap(message):
+    """/ranksnap — состояние снимков топа, /ranksnap run — снять сейчас."""
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+
+    parts = (message.text or "").split()
+    if len(parts) > 1 and parts[1].lower() == "run":
+        snap_id, n = RANK_SNAPSHOTS.take()
+        bot.send_message(
+            message.chat.id,
+            f"📸 Снимок #{snap_id}: игроков {n}, {RANK_SNAPSHOTS.last_bytes} байт, {RANK_SNAPSHOTS.last_ms} мс"
+        )
+        return
+
+    r = db_one("SELECT COUNT(*), COALESCE(SUM(LENGTH(packed)),0), COALESCE(MAX(ts),0) FROM rank_snapshots", ())
+    cnt, size, last_ts = (int(r[0] or 0), int(r[1] or 0), int(r[2] or 0)) if r else (0, 0, 0)
+    lines = [
+        "📸 Снимки денежного топа",
+        f"Снимков: <b>{cnt}</b>, всего {size // 1024} КБ, интервал {RANK_SNAPSHOT_SEC // 60} мин, "
+        f"хранение {RANK_SNAPSHOT_KEEP_DAYS} дн.",
+        f"Последний: {_fmt_ts(last_ts) if last_ts else '—'}",
+    ]
+    if RANK_SNAPSHOTS.taken:
+        lines.append(f"В этом процессе: {RANK_SNAPSHOTS.taken}, последний {RANK_SNAPSHOTS.last_bytes} байт за {RANK_SNAPSHOTS.last_ms} мс")
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+
+def _limiter_hist_line(title: str, h: dict) -> str:
+    if not h["n"]:
+        return f"{title}: —"
+    parts = []
+    for bound, c in h["buckets"]:
+        parts.append(f"≤{bound:g}с:{c}" if bound is not None else f"&gt;{_LatencyHist.BOUNDS[-1]:g}с:{c}")
+    return (
+        f"{title}: {h['n']} шт, среднее {h['avg_ms']} мс, p50 ≤{h['p50_ms']} мс, "
+        f"p95 ≤{h['p95_ms']} мс, макс {h['max_ms']} мс\n    " + " ".join(parts)
+    )
+
+@bot.message_handler(commands=["limiter"])
+def cmd_limiter(message):
+    """
+    /limiter        — состояние очереди правок сообщений
+    /limiter reset  — сбросить счётчики и гистограммы
+    """
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+
+    parts = (message.text or "").split()
+    if len(parts) >= 2 and parts[1].lower() == "reset":
+        EDIT_LIMITER.reset_stats()
+        bot.send_message(message.chat.id, "Лимитер правок: статистика сброшена.")
+        return
+
+    st = EDIT_LIMITER.stats()
+    age = max(1.0, time.time() - st["since"])
+    lines = [
+        "✏️ Лимитер правок",
+        f"Воркеров: {st['workers']}, глобальный интервал {st['global_gap']:g} с, "
+        f"на сообщение {st['per_target_gap']:g} с",
+        f"Очередь: <b>{st['queue']}</b> (макс {st['max_queue']}), ожидают: {st['pending']}, "
+        f"в полёте: {st['inflight']}, припаркованы: {st['parked']}",
+        f"Цели: {st['targets']}, интервалы: {st['last_target']}, вёдра: {st['buckets']}, "
+        f"хэши: {st['dedup']}; вычищено {st['pruned']}",
+        "",
+        f"За {int(age)} с: поставлено <b>{st['enqueued']}</b>, применено <b>{st['applied']}</b> "
+        f"({round(st['applied'] / age, 2)}/с)",
+        f"Слито: {st['coalesced']}, без изменений: {st['skipped_same']}, "
+        f"кадров отброшено: {st['dropped_anim']}, отложено бюджетом: {st['deferred']}",
+        f"429: <b>{st['retry_after']}</b> (сумма ожидания {st['retry_after_sec']} с), "
+        f"not modified: {st['not_modified']}, ошибок: {st['errors']}, откатов в текст: {st['fallbacks']}",
+        "",
+        "Задержка постановка → применение:",
+        _limiter_hist_line("  итог", st["lat"][EDIT_PRIO_FINAL]),
+        _limiter_hist_line("  меню", st["lat"][EDIT_PRIO_MENU]),
+        _limiter_hist_line("  анимация", st["lat"][EDIT_PRIO_ANIM]),
+        _limiter_hist_line("Запрос к API", st["api"]),
+    ]
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+
+@bot.message_handler(commands=["lbcheck"])
+def cmd_lbcheck(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+
+    st = LEADERBOARD.check(repair=True)
+    lines = [
+        "🏆 Денежный топ",
+        f"Пользователей: <b>{st['users']}</b>, расхождений: <b>{st['mismatched']}</b>"
+        + (" (исправлено)" if st["mismatched"] else ""),
+        f"Обновлений: {LEADERBOARD.touches}, перестроений: {LEADERBOARD.rebuilds}, "
+        f"проверок: {LEADERBOARD.checks}, расхождений всего: {LEADERBOARD.mismatches}",
+    ]
+    if st["sample"]:
+        lines.append("Примеры: " + ", ".join(f"<code>{u}</code>" for u in st["sample"]))
+    ms = STATUS_MEMO_STATS
+    lines.append(
+        f"Кэш статусов: {len(_STATUS_MEMO)} записей, попаданий {ms['hits']}, "
+        f"промахов {ms['misses']}, сбросов {ms['invalidations']}, пропущено заполнений {ms['skipped_fills']}"
+    )
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+
+@bot.message_handler(commands=["dbplan"])
+def cmd_dbplan(message):
+    if message.from_user.id != OWNER_ID:
+        return
+    if message.chat.type != "private":
+        return
+
+    bad = hot_query_plan_regressions()
+    if not bad:
+        bot.send_message(message.chat.id, f"✅ Все горячие запросы ({len(HOT_QUERY_PLANS)}) идут по индексам.")
+        return
+
+    lines = ["⚠️ Запросы с полным SCAN:"]
+    for name, detail in bad:
+        lines.append(f"• <b>{html_escape(name)}</b>: <code>{html_escape(detail)}</code>")
+    bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
+
 @bot.message_handler(commands=["bot_off"])
 def cmd_bot_off(message):
     if message.from_user.id != OWNER_ID:
@@ -11169,7 +13782,7 @@ def cmd_get(message):
         return
 
     target_un = parts[1][1:]
-    rr = db_one("SELECT user_id, short_name, username FROM users WHERE username=?", (target_un,))
+    rr = db_one(HOT_SQL["user_by_username"], (target_un,))
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
         return
@@ -11250,7 +13863,7 @@ def cmd_profile(message):
             return
 
         target_un = target_ref[1:].strip()
-        rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (target_un,))
+        rr = db_one(HOT_SQL["user_id_by_username"], (target_un,))
         if not rr:
             bot.reply_to(message, "Пользователь не найден в базе.")
             return
@@ -11389,8 +14002,7 @@ def on_report_content(message):
     if banned_now and cat != "appeal":
         report_clear_state(uid)
         try:
-            r = db_one("SELECT COALESCE(until_ts,0) FROM bans WHERE user_id=? LIMIT 1", (int(uid),))
-            until_ts = int((r[0] if r else 0) or 0)
+            until_ts = int(get_ban_info(uid)[1] or 0)
         except Exception:
             until_ts = 0
 
@@ -11565,7 +14177,7 @@ def cmd_pay(message):
             return
 
         target_un = target_ref[1:].strip()
-        rr = db_one("SELECT user_id FROM users WHERE username=? COLLATE NOCASE", (target_un,))
+        rr = db_one(HOT_SQL["user_id_by_username"], (target_un,))
         if not rr:
             bot.reply_to(message, "Пользователь не найден в базе данных нашей организации :(")
             return
@@ -11689,7 +14301,7 @@ def cmd_rabs(message):
 
     owner_un = parts[1][1:].strip()
     rr = db_one(
-        "SELECT user_id FROM users WHERE username=? COLLATE NOCASE",
+        HOT_SQL["user_id_by_username"],
         (owner_un,)
     )
     if not rr:
@@ -11725,7 +14337,7 @@ def cmd_buyrab(message):
                 return
 
         rr = db_one(
-            "SELECT user_id, short_name, username FROM users WHERE username=? COLLATE NOCASE",
+            HOT_SQL["user_by_username"],
             (target_uname,),
         )
         if not rr:
@@ -11781,7 +14393,7 @@ def cmd_buyrab(message):
             return
 
     rr = db_one(
-        "SELECT user_id, short_name, username FROM users WHERE username=? COLLATE NOCASE",
+        HOT_SQL["user_by_username"],
         (target_uname,),
     )
     if not rr:
@@ -11945,7 +14557,7 @@ def cmd_buyout(message):
         return
 
     cur.execute("INSERT OR IGNORE INTO slave_meta (slave_id) VALUES (?)", (uid,))
-    conn.commit()
+    db_commit()
     cur.execute("SELECT buyout_cents FROM slave_meta WHERE slave_id=?", (uid,))
     buyout_cents = int((cur.fetchone() or (0,))[0] or 0)
 
@@ -12070,7 +14682,7 @@ def cmd_buy(message):
         bot.reply_to(message, "Неверная цена.")
         return
 
-    cur.execute("SELECT user_id, short_name, username FROM users WHERE username=?", (slave_un,))
+    cur.execute(HOT_SQL["user_by_username"], (slave_un,))
     rr = cur.fetchone()
     if not rr:
         bot.reply_to(message, "Пользователь не найден в базе.")
@@ -12119,7 +14731,7 @@ def cmd_buy(message):
     )
     for oid in other_owners:
         cur.execute("INSERT OR IGNORE INTO buy_offer_resp (offer_id, owner_id, status) VALUES (?,?,0)", (offer_id, oid))
-    conn.commit()
+    db_commit()
 
     buyer_u = get_user(buyer_id)
     buyer_name = (buyer_u[2] if buyer_u and buyer_u[2] else "Игрок")
@@ -12168,6 +14780,405 @@ def cmd_shop(message):
     kb = shop_menu_kb(uid)
     bot.send_message(message.chat.id, text, parse_mode="HTML", reply_markup=kb)
 
+# BACKUP
+# Онлайн-бэкап через sqlite3 backup API. Источник — сам conn (писатель): страницы, которые он
+# меняет во время копирования, sqlite сам досылает в копию, поэтому копирование не перезапускается
+# под нагрузкой и снимок получается согласованным (вместе с WAL). DB_LOCK держится только на одну
+# пачку страниц (BACKUP_PAGES) и отпускается между пачками — хендлеры ждут максимум одну пачку.
+BACKUP_DIR = os.path.join(DATA_DIR, "backups")
+BACKUP_EVERY_SEC = max(0, int(os.environ.get("BACKUP_EVERY_SEC", str(6 * 3600)) or 0))  # 0 = не по расписанию
+BACKUP_KEEP = max(1, int(os.environ.get("BACKUP_KEEP", "8") or 8))
+BACKUP_PAGES = max(1, int(os.environ.get("BACKUP_PAGES", "256") or 256))
+BACKUP_YIELD_SEC = 0.005  # пауза между пачками, чтобы писатели успели забрать DB_LOCK
+
+class BackupEngine:
+    def __init__(self, src_path: str, out_dir: str, keep: int, pages: int):
+        self.src_path = src_path
+        self.out_dir = out_dir
+        self.keep = max(1, int(keep))
+        self.pages = max(1, int(pages))
+        self._busy = threading.Lock()
+        self.last: dict = {}
+        self.runs = 0
+        self.failures = 0
+
+    def busy(self) -> bool:
+        return self._busy.locked()
+
+    def run(self, reason: str = "manual") -> str:
+        """Делает снимок, сжимает в .db.gz, чистит старые. Возвращает путь к архиву."""
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("бэкап уже идёт")
+        try:
+            return self._run(reason)
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            self._busy.release()
+
+    def _run(self, reason: str) -> str:
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        base = os.path.splitext(os.path.basename(self.src_path))[0]
+        raw = os.path.join(self.out_dir, f"{base}-{stamp}.db.tmp")
+        out = os.path.join(self.out_dir, f"{base}-{stamp}.db.gz")
+
+        t_start = time.perf_counter()
+        st = {"steps": 0, "held": 0.0, "held_max": 0.0, "t": time.perf_counter()}
+
+        def _progress(status, remaining, total):
+            # вызывается после каждой пачки (DB_LOCK взят) — отпускаем его между пачками
+            held = time.perf_counter() - st["t"]
+            st["steps"] += 1
+            st["held"] += held
+            st["held_max"] = max(st["held_max"], held)
+            st["pages"] = int(total)
+            DB_LOCK.release()
+            try:
+                time.sleep(BACKUP_YIELD_SEC)
+            finally:
+                DB_LOCK.acquire()
+                st["t"] = time.perf_counter()
+
+        dst = sqlite3.connect(raw)
+        try:
+            DB_LOCK.acquire()
+            try:
+                conn.backup(dst, pages=self.pages, progress=_progress, sleep=0)
+            finally:
+                DB_LOCK.release()
+            t_copy = time.perf_counter() - t_start
+            ok = dst.execute("PRAGMA quick_check;").fetchone()
+            if not ok or ok[0] != "ok":
+                raise RuntimeError(f"quick_check: {ok[0] if ok else '?'}")
+        finally:
+            dst.close()
+
+        t0 = time.perf_counter()
+        with open(raw, "rb") as f_in, gzip.open(out + ".tmp", "wb", compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+        os.replace(out + ".tmp", out)
+        raw_size = os.path.getsize(raw)
+        os.remove(raw)
+        t_gzip = time.perf_counter() - t0
+
+        self.prune()
+        self.runs += 1
+        self.last = {
+            "path": out,
+            "reason": reason,
+            "ts": now_ts(),
+            "pages": int(st.get("pages", 0)),
+            "steps": st["steps"],
+            "raw_bytes": raw_size,
+            "gz_bytes": os.path.getsize(out),
+            "copy_ms": round(t_copy * 1000, 1),
+            "gzip_ms": round(t_gzip * 1000, 1),
+            "lock_held_ms": round(st["held"] * 1000, 1),
+            "lock_max_ms": round(st["held_max"] * 1000, 2),
+        }
+        return out
+
+    def list(self) -> List[str]:
+        try:
+            names = [n for n in os.listdir(self.out_dir) if n.endswith(".db.gz")]
+        except Exception:
+            return []
+        return [os.path.join(self.out_dir, n) for n in sorted(names)]
+
+    def prune(self) -> None:
+        files = self.list()
+        for path in files[:-self.keep]:
+            try:
+                os.remove(path)
+            except Exception:
+                pass
+        # хвосты от прерванных запусков (prune зовётся внутри run, параллельного бэкапа нет)
+        try:
+            for n in os.listdir(self.out_dir):
+                if n.endswith(".tmp"):
+                    os.remove(os.path.join(self.out_dir, n))
+        except Exception:
+            pass
+
+BACKUP_ENGINE = BackupEngine(DB_PATH, BACKUP_DIR, BACKUP_KEEP, BACKUP_PAGES)
+
+def _backup_daemon():
+    while True:
+        time.sleep(BACKUP_EVERY_SEC)
+        try:
+            BACKUP_ENGINE.run("schedule")
+        except Exception:
+            send_error_report("_backup_daemon")
+
+if BACKUP_EVERY_SEC > 0:
+    threading.Thread(target=_backup_daemon, daemon=True).start()
+
+# ARCHIVE
+# Ретеншн растущих таблиц: строки старше горизонта пачками переносятся в отдельный файл
+# (data/archive.db) и удаляются из живой базы. На каждую пачку: INSERT OR IGNORE в архив
+# с исходным rowid и коммит архива, потом в живой базе одна db_tx — свёртки + DELETE.
+# Падение между шагами даёт только повторную вставку, которая игнорируется.
+# То, что бот ещё читает из истории, остаётся в основной базе в свёртках:
+# - slave_earn_rollup   — последняя выплата раба владельцу (slave_last_credit) и суммы;
+# - work_history_rollup — факт трудового стажа (has_work_history);
+# - user_achievements   — "Ломаный рот этой рулетки" (обычно уже выдан при завершении игры);
+# - known_group_chats   — чаты из архивируемых переводов и игр.
+# slave_profit_lasth и анти-фрод переводов смотрят на последние часы/сутки — горизонт всегда больше.
+ARCHIVE_DB_PATH = os.path.join(DATA_DIR, "archive.db")
+ARCHIVE_EVERY_SEC = max(0, int(os.environ.get("ARCHIVE_EVERY_SEC", str(6 * 3600)) or 0))  # 0 = не по расписанию
+ARCHIVE_DAYS = max(2, int(os.environ.get("ARCHIVE_DAYS", "30") or 30))
+ARCHIVE_PM_DAYS = max(1, int(os.environ.get("ARCHIVE_PM_DAYS", "3") or 3))
+ARCHIVE_BATCH = 500
+ARCHIVE_PAUSE_SEC = 0.05  # между пачками, чтобы не занимать писателя надолго
+
+# журналы только дописываются, rowid растёт вместе со временем: берём самые старые по rowid
+# и останавливаемся на первой свежей строке — индекс по времени не нужен
+ARCHIVE_LOGS = [
+    ("slave_earn_log", "ts"),
+    ("work_history", "ends_ts"),
+    ("transfers", "ts"),
+    ("transfer_block_log", "created_ts"),
+]
+ARCHIVE_GAME_TABLES = [
+    "game_players", "game_results", "spins", "zero_bets", "zero_state", "zero_outcomes",
+    "zero_lock", "turn_orders", "rematch_votes", "life_wait",
+]
+
+class Archiver:
+    def __init__(self, path: str, batch: int):
+        self.path = path
+        self.batch = max(1, int(batch))
+        self._busy = threading.Lock()
+        self._cols: Dict[str, List[str]] = {}
+        self.moved: Dict[str, int] = {}
+        self.runs = 0
+        self.failures = 0
+        self.last: dict = {}
+
+    def busy(self) -> bool:
+        return self._busy.locked()
+
+    def _open(self) -> sqlite3.Connection:
+        a = sqlite3.connect(self.path, check_same_thread=False)
+        a.execute("PRAGMA journal_mode=WAL;")
+        a.execute("PRAGMA synchronous=NORMAL;")
+        return a
+
+    def _columns(self, a: sqlite3.Connection, table: str) -> List[str]:
+        """Колонки живой таблицы; в архиве таблица создаётся/дополняется под них."""
+        cols = [str(r[1]) for r in db_all(f"PRAGMA table_info({table})")]
+        if self._cols.get(table) == cols:
+            return cols
+        have = [str(r[1]) for r in a.execute(f"PRAGMA table_info({table})").fetchall()]
+        if not have:
+            r = db_one("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
+            a.execute(r[0])
+        else:
+            for col in cols:
+                if col not in have:
+                    a.execute(f"ALTER TABLE {table} ADD COLUMN {col}")
+        a.commit()
+        self._cols[table] = cols
+        return cols
+
+    def _copy(self, a: sqlite3.Connection, table: str, cols: List[str], rows: list) -> None:
+        marks = ",".join("?" * (len(cols) + 1))
+        a.executemany(f"INSERT OR IGNORE INTO {table} (rowid,{','.join(cols)}) VALUES ({marks})", rows)
+
+    def _delete(self, table: str, rowids: List[int]) -> None:
+        for i in range(0, len(rowids), 500):
+            part = rowids[i:i + 500]
+            db_exec(f"DELETE FROM {table} WHERE rowid IN ({','.join('?' * len(part))})", tuple(part))
+
+    def _count(self, table: str, n: int) -> None:
+        self.moved[table] = self.moved.get(table, 0) + n
+
+    def _rollup(self, table: str, cols: List[str], rows: list) -> None:
+        """Вызывается внутри db_tx, до DELETE."""
+        recs = [dict(zip(cols, r[1:])) for r in rows]
+        if table == "slave_earn_log":
+            agg: Dict[Tuple[int, int], list] = {}
+            for x in recs:
+                key = (int(x["slave_id"] or 0), int(x["owner_id"] or 0))
+                ts, amt = int(x["ts"] or 0), int(x["amount_cents"] or 0)
+                a = agg.setdefault(key, [0, 0, -1, 0])
+                a[0] += 1
+                a[1] += amt
+                if ts >= a[2]:
+                    a[2], a[3] = ts, amt
+            for (sid, oid), (cnt, total, ts, amt) in agg.items():
+                db_exec(
+                    "INSERT INTO slave_earn_rollup (slave_id, owner_id, cnt, total_cents, last_ts, last_amount_cents) "
+                    "VALUES (?,?,?,?,?,?) "
+                    "ON CONFLICT(slave_id, owner_id) DO UPDATE SET "
+                    "cnt=cnt+excluded.cnt, total_cents=total_cents+excluded.total_cents, "
+                    "last_amount_cents=CASE WHEN excluded.last_ts>=last_ts THEN excluded.last_amount_cents ELSE last_amount_cents END, "
+                    "last_ts=MAX(last_ts, excluded.last_ts)",
+                    (sid, oid, cnt, total, ts, amt)
+                )
+        elif table == "work_history":
+            agg2: Dict[int, list] = {}
+            for x in recs:
+                a = agg2.setdefault(int(x["user_id"] or 0), [0, 0, 0])
+                a[0] += 1
+                a[1] += int(x["paid_cents"] or 0)
+                a[2] = max(a[2], int(x["ends_ts"] or 0))
+            for uid, (shifts, paid, ts) in agg2.items():
+                db_exec(
+                    "INSERT INTO work_history_rollup (user_id, shifts, paid_cents, last_ts) VALUES (?,?,?,?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET shifts=shifts+excluded.shifts, "
+                    "paid_cents=paid_cents+excluded.paid_cents, last_ts=MAX(last_ts, excluded.last_ts)",
+                    (uid, shifts, paid, ts)
+                )
+        elif table in ("transfers", "games"):
+            col_chat, col_ts = ("chat_id", "ts") if table == "transfers" else ("origin_chat_id", "created_ts")
+            for x in recs:
+                chat_id = int(x.get(col_chat) or 0)
+                if chat_id < 0:
+                    ts = int(x.get(col_ts) or 0)
+                    db_exec(
+                        "INSERT OR IGNORE INTO known_group_chats (chat_id, added_ts, last_seen_ts) VALUES (?,?,?)",
+                        (chat_id, ts, ts)
+                    )
+
+    def _archive_log(self, a: sqlite3.Connection, table: str, ts_col: str, cutoff: int) -> int:
+        cols = self._columns(a, table)
+        i_ts = cols.index(ts_col) + 1
+        total = 0
+        while True:
+            rows = db_all(f"SELECT rowid,{','.join(cols)} FROM {table} ORDER BY rowid LIMIT ?", (self.batch,)) or []
+            old = []
+            for r in rows:
+                if int(r[i_ts] or 0) >= cutoff:
+                    break
+                old.append(r)
+            if not old:
+                return total
+            self._copy(a, table, cols, old)
+            a.commit()
+            with db_tx():
+                self._rollup(table, cols, old)
+                self._delete(table, [int(r[0]) for r in old])
+            total += len(old)
+            self._count(table, len(old))
+            if len(old) < len(rows) or len(rows) < self.batch:
+                return total
+            time.sleep(ARCHIVE_PAUSE_SEC)
+
+    def _archive_where(self, a: sqlite3.Connection, table: str, where: str, params: tuple) -> int:
+        cols = self._columns(a, table)
+        total = 0
+        while True:
+            rows = db_all(f"SELECT rowid,{','.join(cols)} FROM {table} WHERE {where} LIMIT ?", params + (self.batch,)) or []
+            if not rows:
+                return total
+            self._copy(a, table, cols, rows)
+            a.commit()
+            with db_tx():
+                self._delete(table, [int(r[0]) for r in rows])
+            total += len(rows)
+            self._count(table, len(rows))
+            if len(rows) < self.batch:
+                return total
+            time.sleep(ARCHIVE_PAUSE_SEC)
+
+    def _archive_games(self, a: sqlite3.Connection, cutoff: int) -> int:
+        gcols = self._columns(a, "games")
+        ccols = {t: self._columns(a, t) for t in ARCHIVE_GAME_TABLES}
+        total = 0
+        while True:
+            games = db_all(
+                HOT_SQL["archive:games"].format(cols=",".join(gcols)),
+                (cutoff, min(self.batch, 200))
+            ) or []
+            if not games:
+                return total
+            i_gid = gcols.index("game_id") + 1
+            gids = [str(r[i_gid]) for r in games]
+            marks = ",".join("?" * len(gids))
+            children = {}
+            for t in ARCHIVE_GAME_TABLES:
+                children[t] = db_all(f"SELECT rowid,{','.join(ccols[t])} FROM {t} WHERE game_id IN ({marks})", tuple(gids)) or []
+                self._copy(a, t, ccols[t], children[t])
+            self._copy(a, "games", gcols, games)
+            a.commit()
+
+            # "Ломаный рот этой рулетки": крестовая игра до 9+ раунда и минус от 1 млн $
+            g_recs = {str(x["game_id"]): x for x in (dict(zip(gcols, r[1:])) for r in games)}
+            broken = []
+            for r in children["game_results"]:
+                x = dict(zip(ccols["game_results"], r[1:]))
+                g = g_recs.get(str(x["game_id"])) or {}
+                if (g.get("game_type") == "cross" and g.get("state") == "finished"
+                        and int(g.get("cross_round") or 0) >= 9 and int(x["delta_cents"] or 0) <= -1_000_000 * 100):
+                    broken.append((int(x["user_id"]), str(x["game_id"]), int(g.get("created_ts") or 0)))
+
+            with db_tx():
+                self._rollup("games", gcols, games)
+                for uid, gid, ts in broken:
+                    db_exec(
+                        "INSERT OR IGNORE INTO user_achievements (user_id, status, game_id, ts) VALUES (?,?,?,?)",
+                        (uid, "Ломаный рот этой рулетки", gid, ts)
+                    )
+                for t in ARCHIVE_GAME_TABLES:
+                    self._delete(t, [int(r[0]) for r in children[t]])
+                    self._count(t, len(children[t]))
+                self._delete("games", [int(r[0]) for r in games])
+            total += len(games)
+            self._count("games", len(games))
+            if len(games) < min(self.batch, 200):
+                return total
+            time.sleep(ARCHIVE_PAUSE_SEC)
+
+    def run(self, reason: str = "manual") -> dict:
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("архивация уже идёт")
+        t0 = time.perf_counter()
+        before = dict(self.moved)
+        a = None
+        try:
+            a = self._open()
+            now = now_ts()
+            cutoff = now - ARCHIVE_DAYS * 86400
+            for table, ts_col in ARCHIVE_LOGS:
+                self._archive_log(a, table, ts_col, cutoff)
+            self._archive_games(a, cutoff)
+            self._archive_where(a, "demon_loot", "taken=1 AND COALESCE(ts,0) < ?", (cutoff,))
+            self._archive_where(a, "pm_bot_messages", "deleted=1 AND delete_after_ts < ?", (now - ARCHIVE_PM_DAYS * 86400,))
+            self.runs += 1
+        except Exception:
+            self.failures += 1
+            raise
+        finally:
+            if a is not None:
+                try:
+                    a.close()
+                except Exception:
+                    pass
+            self.last = {
+                "reason": reason,
+                "ts": now_ts(),
+                "ms": round((time.perf_counter() - t0) * 1000, 1),
+                "moved": {k: v - before.get(k, 0) for k, v in self.moved.items() if v - before.get(k, 0) > 0},
+            }
+            self._busy.release()
+        return self.last
+
+ARCHIVER = Archiver(ARCHIVE_DB_PATH, ARCHIVE_BATCH)
+
+def _archive_daemon():
+    while True:
+        time.sleep(ARCHIVE_EVERY_SEC)
+        try:
+            ARCHIVER.run("schedule")
+        except Exception:
+            send_error_report("_archive_daemon")
+
+if ARCHIVE_EVERY_SEC > 0:
+    threading.Thread(target=_archive_daemon, daemon=True).start()
+
 def integrity_ok(c: sqlite3.Connection) -> bool:
     try:
         r = c.execute("PRAGMA integrity_check;").fetchone()
@@ -12175,16 +15186,162 @@ def integrity_ok(c: sqlite3.Connection) -> bool:
     except Exception:
         return False
 
-def _checkpoint_daemon(): #checkpoint
-    while True:
-        time.sleep(1800)  # раз в 30 минут (600 = раз в 10 минут)
-        with DB_LOCK:
+# CHECKPOINT
+# Планировщик чекпоинтов по размеру -wal и скорости записи. Работает со своего соединения
+# и без DB_LOCK: PASSIVE никого не блокирует, RESTART/TRUNCATE ждут читателей busy-таймаутом,
+# писатели в это время ждут своим busy_timeout, а не на глобальном локе.
+# - WAL растёт (идёт запись) и меньше soft  -> ничего (авточекпоинт sqlite остаётся страховкой);
+# - затишье (WAL не растёт, очередь записи пуста) -> PASSIVE, а при WAL >= soft -> TRUNCATE;
+# - WAL >= soft под нагрузкой                     -> PASSIVE;
+# - WAL >= hard                                    -> RESTART, при >= 4*hard -> TRUNCATE.
+CHECKPOINT_TICK_SEC = 5.0
+CHECKPOINT_WAL_SOFT = max(1, int(os.environ.get("CHECKPOINT_WAL_SOFT_MB", "16") or 16)) * 1024 * 1024
+CHECKPOINT_WAL_HARD = max(2, int(os.environ.get("CHECKPOINT_WAL_HARD_MB", "64") or 64)) * 1024 * 1024
+
+class CheckpointScheduler:
+    def __init__(self, path: str, soft: int, hard: int, tick: float):
+        self.path = path
+        self.wal_path = path + "-wal"
+        self.soft = int(soft)
+        self.hard = max(int(hard), int(soft))
+        self.tick = float(tick)
+        self._c: Optional[sqlite3.Connection] = None
+        self._page = 4096
+        self._data_version = -1
+        self._prev_size = 0
+        self._prev_t = time.time()
+        self._clean = False  # последний чекпоинт перенёс весь WAL и с тех пор записи не было
+        self._last_log = 0
+        self._last_ckpt = 0
+        self.rate_bps = 0.0
+        self.wal_size = 0
+        self.wal_max = 0
+        self.runs: Dict[str, int] = {"PASSIVE": 0, "RESTART": 0, "TRUNCATE": 0}
+        self.busy = 0
+        self.errors = 0
+        self.frames = 0
+        self.dur_total = 0.0
+        self.dur_max = 0.0
+        self.last: dict = {}
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._c is None:
+            c = sqlite3.connect(self.path, check_same_thread=False)
+            # RESTART/TRUNCATE, пока ждут читателей, держат писателей — ждём недолго,
+            # при busy просто повторим на следующем тике
+            c.execute("PRAGMA busy_timeout=200;")
+            self._page = int(c.execute("PRAGMA page_size;").fetchone()[0] or 4096)
+            self._c = c
+        return self._c
+
+    def _wal_size(self) -> int:
+        try:
+            return os.path.getsize(self.wal_path)
+        except Exception:
+            return 0
+
+    def choose(self, size: int, idle: bool) -> Optional[str]:
+        if size >= self.hard * 4:
+            return "TRUNCATE"
+        if size >= self.hard:
+            return "TRUNCATE" if idle else "RESTART"
+        if size >= self.soft:
+            return "TRUNCATE" if idle else "PASSIVE"
+        if idle and size > 0 and not self._clean:
+            return "PASSIVE"
+        return None
+
+    def checkpoint(self, mode: str) -> Tuple[int, int, int]:
+        size_before = self._wal_size()
+        t0 = time.perf_counter()
+        try:
+            r = self._conn().execute(f"PRAGMA wal_checkpoint({mode});").fetchone()
+        except Exception:
+            self.errors += 1
+            try:
+                self._c.close()
+            except Exception:
+                pass
+            self._c = None
+            raise
+        dt = time.perf_counter() - t0
+        busy, log, ckpt = (int(x if x is not None else 0) for x in (r or (1, 0, 0)))
+        # кадры, перенесённые этим вызовом (тот же WAL, что и в прошлый раз, — считаем разницу)
+        if mode == "TRUNCATE" and not busy:
+            # после TRUNCATE sqlite отдаёт (0, 0, 0) — оцениваем по размеру WAL до чекпоинта
+            log = max(0, (size_before - 32) // (self._page + 24))
+            ckpt = log
+        moved = ckpt - self._last_ckpt if (log >= self._last_log and ckpt >= self._last_ckpt) else ckpt
+        self._last_log, self._last_ckpt = log, ckpt
+        if mode in ("RESTART", "TRUNCATE") and not busy:
+            self._last_log = self._last_ckpt = 0
+        self.runs[mode] = self.runs.get(mode, 0) + 1
+        self.frames += max(0, moved)
+        self.busy += 1 if busy else 0
+        self.dur_total += dt
+        self.dur_max = max(self.dur_max, dt)
+        self._clean = (not busy) and ckpt >= log
+        self.last = {
+            "mode": mode, "busy": busy, "log": log, "ckpt": ckpt, "moved": max(0, moved),
+            "ms": round(dt * 1000, 2), "ts": now_ts(),
+        }
+        return busy, log, ckpt
+
+    def step(self) -> Optional[str]:
+        now = time.time()
+        size = self._wal_size()
+        dt = max(1e-6, now - self._prev_t)
+        # data_version меняется при коммите любого другого соединения — ловит и запись,
+        # которая пошла по WAL с начала (размер файла при этом не меняется)
+        try:
+            dv = int(self._conn().execute("PRAGMA data_version;").fetchone()[0])
+        except Exception:
+            dv = self._data_version
+        grew = size != self._prev_size or dv != self._data_version
+        self._data_version = dv
+        if grew:
+            self._clean = False
+        self.rate_bps = 0.7 * self.rate_bps + 0.3 * (max(0, size - self._prev_size) / dt)
+        self._prev_size, self._prev_t = size, now
+        self.wal_size = size
+        self.wal_max = max(self.wal_max, size)
+
+        try:
+            pending = DB_WRITER.stats()["pending"]
+        except Exception:
+            pending = 0
+        idle = (not grew) and pending == 0
+        mode = self.choose(size, idle)
+        if mode:
+            self.checkpoint(mode)
+            self._prev_size = self._wal_size()
+        return mode
+
+    def stats(self) -> dict:
+        n = max(1, sum(self.runs.values()))
+        return {
+            "wal_kb": self.wal_size // 1024,
+            "wal_max_kb": self.wal_max // 1024,
+            "rate_kbps": round(self.rate_bps / 1024, 1),
+            "runs": dict(self.runs),
+            "busy": self.busy,
+            "errors": self.errors,
+            "frames": self.frames,
+            "avg_ms": round(self.dur_total * 1000 / n, 2),
+            "max_ms": round(self.dur_max * 1000, 2),
+            "last": dict(self.last),
+        }
+
+    def run_forever(self):
+        while True:
+            time.sleep(self.tick)
             try:
-                conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+                self.step()
             except Exception:
                 pass
 
-threading.Thread(target=_checkpoint_daemon, daemon=True).start()
+CHECKPOINTER = CheckpointScheduler(DB_PATH, CHECKPOINT_WAL_SOFT, CHECKPOINT_WAL_HARD, CHECKPOINT_TICK_SEC)
+threading.Thread(target=CHECKPOINTER.run_forever, name="db-checkpoint", daemon=True).start()
 
 # RUN
 print(f"Contest bot started as @{BOT_USERNAME}")